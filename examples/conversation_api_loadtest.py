@@ -0,0 +1,120 @@
+"""
+Load test for the remote conversation mode, end to end on one machine.
+
+Starts the reference conversation API (pywaai.conversation_api) in a subprocess, then
+simulates many users doing WhatsApp-like turns through LocalOrRemoteConversation:
+append the user message, read the history, append the reply.
+
+    python examples/conversation_api_loadtest.py --users 200 --turns 10
+
+Use --url to benchmark an already running server instead.
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "unused")
+
+from pywaai import ai_utils
+from pywaai.auth import StaticTokenCache
+from pywaai.http_client import create_http_client
+
+
+async def simulate_user(
+    phone_number: str, turns: int, base_url: str, http_client, latencies: list
+):
+    for turn in range(turns):
+        start = time.perf_counter()
+        conv = ai_utils.LocalOrRemoteConversation(
+            phone_number=phone_number,
+            use_remote_api=True,
+            remote_base_url=base_url,
+            http_client=http_client,
+        )
+        await conv.append_message({"role": "user", "content": f"Pregunta {turn}"})
+        await conv.get_messages()
+        await conv.append_message(
+            {"role": "assistant", "content": f"Respuesta {turn} " + "x" * 200}
+        )
+        await conv.flush()
+        latencies.append(time.perf_counter() - start)
+
+
+async def wait_for_server(base_url: str, http_client, timeout: float = 15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            await http_client.get(f"{base_url}/docs")
+            return
+        except Exception:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} did not start")
+
+
+async def run(args):
+    ai_utils.set_token_cache(StaticTokenCache())
+    http_client = create_http_client(
+        max_connections=args.connections, max_keepalive_connections=args.connections
+    )
+    await wait_for_server(args.url, http_client)
+
+    latencies: list[float] = []
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            simulate_user(f"+1555{i:07d}", args.turns, args.url, http_client, latencies)
+            for i in range(args.users)
+        )
+    )
+    elapsed = time.perf_counter() - start
+    await http_client.aclose()
+
+    latencies.sort()
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"{len(latencies)} turns in {elapsed:.2f}s ({len(latencies) / elapsed:.0f} turns/s)")
+    print(
+        f"turn latency p50={quantiles[49] * 1000:.1f}ms "
+        f"p95={quantiles[94] * 1000:.1f}ms p99={quantiles[98] * 1000:.1f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Remote conversation API load test")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--url", help="Benchmark a running server instead of starting one")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    server = None
+    if not args.url:
+        db_path = os.path.join(tempfile.mkdtemp(), "conversations.db")
+        args.url = f"http://127.0.0.1:{args.port}"
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "pywaai.conversation_api",
+                "--db",
+                db_path,
+                "--port",
+                str(args.port),
+            ]
+        )
+    try:
+        asyncio.run(run(args))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
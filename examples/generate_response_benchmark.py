@@ -0,0 +1,169 @@
+"""
+End-to-end benchmark of generate_response without calling OpenAI.
+
+Simulates many users chatting at once against a local SQLite conversation store, with
+pywaai.fake_openai standing in for the model. Reports the time each turn spends in every
+stage except the (simulated) model, i.e. the overhead pywaai adds to the LLM latency.
+
+    python examples/generate_response_benchmark.py --users 2000 --turns 3
+    python examples/generate_response_benchmark.py --stream --tool-rate 0.3
+
+Use --latency 0 to measure the overhead under maximum load. When the event loop is
+saturated, the time a turn waits for it is counted in the stage it is waiting in.
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "unused")
+
+from pywaai import ai_utils
+from pywaai.conversation_db import ConversationManager
+from pywaai.fake_openai import (
+    FakeOpenAI,
+    FakeReply,
+    constant_latency,
+    lognormal_latency,
+)
+from pywaai.metrics import DB_WRITE, LLM, MetricsRegistry
+
+# Geometric buckets from 0.1ms to ~50s, for reasonably precise quantiles
+BUCKETS = [0.0001 * 1.2**i for i in range(72)]
+
+REPLY = (
+    "Claro, con gusto te ayudo. Nuestro horario es de lunes a viernes de 9 a 18 horas. "
+    "Si necesitas algo más, no dudes en escribirnos."
+)
+
+
+class LookupOrder:
+    """A tool the fake model can call."""
+
+    openai_schema = {
+        "name": "LookupOrder",
+        "description": "Look up the status of an order",
+        "parameters": {
+            "type": "object",
+            "properties": {"order_id": {"type": "string"}},
+            "required": ["order_id"],
+        },
+    }
+
+    def __init__(self, order_id: str):
+        self.order_id = order_id
+
+    async def run(self):
+        return f"Order {self.order_id} was shipped yesterday"
+
+
+def quantile(histogram: dict, q: float) -> float:
+    """Estimate a quantile from cumulative histogram buckets."""
+    target = q * histogram["count"]
+    previous_bound, previous_count = 0.0, 0
+    for le, count in histogram["buckets"].items():
+        bound = float(le) if le != "+Inf" else previous_bound
+        if count >= target:
+            if count == previous_count:
+                return bound
+            fraction = (target - previous_count) / (count - previous_count)
+            return previous_bound + (bound - previous_bound) * fraction
+        previous_bound, previous_count = bound, count
+    return previous_bound
+
+
+async def simulate_user(phone_number: str, args, client, manager, registry, semaphore):
+    for turn in range(args.turns):
+        async with semaphore:
+            kwargs = dict(
+                phone_number=phone_number,
+                message_text=f"Hola, pregunta número {turn}",
+                user_name="Benchmark",
+                openai_client=client,
+                tool_functions=[LookupOrder] if args.tool_rate else None,
+                conversation_manager=manager,
+                metrics=registry,
+            )
+            if args.stream:
+                async for _ in ai_utils.generate_response_stream(**kwargs):
+                    pass
+            else:
+                await ai_utils.generate_response(**kwargs)
+
+
+async def run(args):
+    db_path = args.db or os.path.join(tempfile.mkdtemp(), "conversations.db")
+    manager = ConversationManager(db_path=db_path, pool_size=args.pool_size)
+    client = FakeOpenAI(
+        responder=lambda request: FakeReply(REPLY),
+        latency=lognormal_latency(args.latency, args.sigma, seed=0)
+        if args.latency
+        else constant_latency(0.0),
+        tokens_per_second=args.tokens_per_second,
+        tool_call_rate=args.tool_rate,
+        seed=0,
+    )
+    registry = MetricsRegistry(buckets=BUCKETS)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            simulate_user(f"+1555{i:07d}", args, client, manager, registry, semaphore)
+            for i in range(args.users)
+        )
+    )
+    elapsed = time.perf_counter() - start
+    # Replies are stored in the background, after the turns end
+    await ai_utils.wait_for_pending_writes()
+    await manager.history.pool.close_all()
+
+    metrics = registry.to_dict()
+    turns = sum(t["count"] for t in metrics["turns"].values())
+    print(f"{turns} turns in {elapsed:.2f}s ({turns / elapsed:.0f} turns/s), "
+          f"{client.calls} model calls")
+    print(f"{'stage':<12}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}  (ms per turn)")
+    overhead = 0.0
+    for stage in metrics["stages"]:
+        if stage["stage"] == LLM:
+            continue
+        # Quantiles are over the turns that had the stage, the mean over all turns
+        mean = stage["sum"] / turns
+        # Writes run in the background, they don't delay the reply
+        background = stage["stage"] == DB_WRITE
+        if not background:
+            overhead += mean
+        print(
+            f"{stage['stage']:<12}{mean * 1000:>10.2f}"
+            + "".join(f"{quantile(stage, q) * 1000:>10.2f}" for q in (0.5, 0.95, 0.99))
+            + ("  (background)" if background else "")
+        )
+    llm = next((s for s in metrics["stages"] if s["stage"] == LLM), None)
+    if llm:
+        print(f"model time (excluded) mean={llm['sum'] / turns * 1000:.1f}ms per turn")
+    print(f"overhead mean={overhead * 1000:.2f}ms per turn")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="generate_response benchmark")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=500,
+                        help="Maximum turns in flight")
+    parser.add_argument("--latency", type=float, default=0.5,
+                        help="Median simulated model latency in seconds (0 for none)")
+    parser.add_argument("--sigma", type=float, default=0.5,
+                        help="Spread of the log-normal model latency")
+    parser.add_argument("--tokens-per-second", type=float, default=None)
+    parser.add_argument("--tool-rate", type=float, default=0.0,
+                        help="Probability that the model calls a tool")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--pool-size", type=int, default=5)
+    parser.add_argument("--db", help="SQLite database (a temporary one by default)")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -12,8 +12,8 @@ from pydantic import BaseModel, Field
 from typing import List, AsyncGenerator
 import asyncio
 from datetime import datetime, timedelta
-from asyncio import Task
-from typing import Any
+
+from pywaai.coalescer import MessageCoalescer
 
 from fastapi import FastAPI
 import argparse
@@ -36,13 +36,6 @@ openai_client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 # Initialize the ConversationHistory
 conversation_history: defaultdict[str, list[dict[str, str]]] = defaultdict(list)
 
-# Store the last message timestamp for each user
-last_message_time: dict[str, datetime] = {}
-
-# Store the tasks for each user
-user_tasks: dict[str, Task[Any]] = {}
-
-
 async def get_openai_response(message: str, phone_number: str) -> str:
     """
     Requests a response from OpenAI based on the input message and conversation history.
@@ -66,67 +59,47 @@ async def get_openai_response(message: str, phone_number: str) -> str:
     return response.choices[0].message.content.strip()
 
 
-async def process_and_respond(client: WhatsApp, msg: Message):
+async def process_and_respond(wa_id: str, texts: List[str]):
     """
-    Process the message and send a response after a delay.
+    Respond once to the messages a user sent in a row.
     """
+    message = "\n".join(text for text in texts if text)
     try:
-        if msg.text is None:
+        if not message:
             raise ValueError("Message text is None")
 
-        conversation_history[msg.from_user.wa_id].append(
-            {"role": "user", "content": msg.text}
-        )
-
-        # Wait for 5 seconds before processing
-        await asyncio.sleep(5)
-
-        # Check if this task has been cancelled
-        if asyncio.current_task().cancelled():
-            return
+        response = await get_openai_response(message, wa_id)
 
-        response = await get_openai_response(msg.text, msg.from_user.wa_id)
-
-        client.send_message(to=msg.from_user.wa_id, text=response)
-        conversation_history[msg.from_user.wa_id].append(
-            {"role": "assistant", "content": response}
-        )
-        logging.info(f"SENT,{msg.from_user.wa_id},{response}")
+        conversation_history[wa_id].append({"role": "user", "content": message})
+        wa.send_message(to=wa_id, text=response)
+        conversation_history[wa_id].append({"role": "assistant", "content": response})
+        logging.info(f"SENT,{wa_id},{response}")
 
     except ValueError as ve:
         logging.error(f"ValueError: {ve}")
-        client.send_message(
-            to=msg.from_user.wa_id,
+        wa.send_message(
+            to=wa_id,
             text="Sorry, I couldn't process your message. Please try again.",
         )
-    except asyncio.CancelledError:
-        logging.info(f"Task cancelled for user {msg.from_user.wa_id}")
     except Exception as e:
         logging.error(f"Error processing message: {e}")
-        client.send_message(
-            to=msg.from_user.wa_id,
+        wa.send_message(
+            to=wa_id,
             text="Sorry, I couldn't generate a response right now. Please try again later.",
         )
 
 
+# Waits until the user stops typing (1-5s, depending on how fast they type) and
+# cancels outdated replies when more messages arrive
+coalescer = MessageCoalescer(process_and_respond, min_delay=1.0, max_delay=5.0)
+
+
 @wa.on_message()
 async def respond_message(client: WhatsApp, msg: Message):
     """
-    Handles all incoming messages, moderates them, and responds with an OpenAI-generated response.
+    Buffers the messages of each user and responds to them with a single OpenAI-generated response.
     """
-    current_time = datetime.now()
-    user_id = msg.from_user.wa_id
-
-    # Cancel any existing task for this user
-    if user_id in user_tasks:
-        user_tasks[user_id].cancel()
-
-    # Create a new task for this message
-    task = asyncio.create_task(process_and_respond(client, msg))
-    user_tasks[user_id] = task
-
-    # Update the last message time for this user
-    last_message_time[user_id] = current_time
+    coalescer.add(msg.from_user.wa_id, msg.text)
 
 
 def start_server():
@@ -16,6 +16,8 @@ import uvicorn
 # Setup logging
 from loguru import logger
 
+from pywaai.scheduler import FollowUpScheduler, ScheduledJob
+
 # Environment variables
 mng = os.getenv("WHATSAPP_MANAGER_TOKEN")
 openai_api_key = os.environ.get("OPENAI_API_KEY")
@@ -38,8 +40,6 @@ openai_client = AsyncOpenAI(api_key=openai_api_key)
 
 # Conversation and user state management
 conversation_history: Dict[str, List[Dict[str, str]]] = defaultdict(list)
-last_message_time: Dict[str, datetime] = {}
-user_tasks: Dict[str, asyncio.Task] = {}
 
 # Follow-up schedule (in minutes)
 FOLLOW_UP_SCHEDULE = [1, 2, 3]  # 5 min, 30 min, 4 hours
@@ -85,22 +85,30 @@ async def get_openai_response(message: str, phone_number: str) -> str:
     return response.choices[0].message.content
 
 
-async def send_follow_up(client: WhatsApp, user_id: str, delay: int):
-    """Send a follow-up message after the specified delay."""
-    await asyncio.sleep(delay * 60)  # Convert minutes to seconds
-    if datetime.now() - last_message_time[user_id] >= timedelta(minutes=delay):
-        follow_up_message = await get_openai_generation(user_id)
-        client.send_message(to=user_id, text=follow_up_message)
-        logger.info(f"Sent follow-up to {user_id} after {delay} minutes")
-        conversation_history[user_id].append(
-            {"role": "assistant", "content": follow_up_message}
-        )
+async def send_follow_up(job: ScheduledJob):
+    """Send a follow-up message (the user has not written since it was scheduled)."""
+    user_id = job.phone_number
+    follow_up_message = await get_openai_generation(user_id)
+    wa.send_message(to=user_id, text=follow_up_message)
+    logger.info(f"Sent follow-up to {user_id} after {job.payload['delay']} minutes")
+    conversation_history[user_id].append(
+        {"role": "assistant", "content": follow_up_message}
+    )
+
+
+# Persistent: follow-ups scheduled before a restart are still sent
+scheduler = FollowUpScheduler(send_follow_up, db_path="followups.db")
 
 
-async def schedule_follow_ups(client: WhatsApp, user_id: str):
+@app.on_event("startup")
+async def start_scheduler():
+    await scheduler.start()
+
+
+async def schedule_follow_ups(user_id: str):
     """Schedule follow-up messages for a user."""
     for delay in FOLLOW_UP_SCHEDULE:
-        asyncio.create_task(send_follow_up(client, user_id, delay))
+        await scheduler.schedule(user_id, delay * 60, payload={"delay": delay})
 
 
 async def process_and_respond(client: WhatsApp, msg: Message):
@@ -117,9 +125,7 @@ async def process_and_respond(client: WhatsApp, msg: Message):
         conversation_history[user_id].append({"role": "assistant", "content": response})
         logger.info(f"SENT,{user_id},{response}")
 
-        # Update last message time and schedule follow-ups
-        last_message_time[user_id] = datetime.now()
-        await schedule_follow_ups(client, user_id)
+        await schedule_follow_ups(user_id)
 
     except Exception as e:
         logger.error(f"Error processing message: {e}")
@@ -131,16 +137,10 @@ async def process_and_respond(client: WhatsApp, msg: Message):
 
 @wa.on_message()
 async def respond_message(client: WhatsApp, msg: Message):
-    """Handle incoming messages and manage user tasks."""
-    user_id = msg.from_user.wa_id
-
-    # Cancel any existing follow-up tasks for this user
-    if user_id in user_tasks:
-        user_tasks[user_id].cancel()
-
-    # Create a new task for processing this message
-    task = asyncio.create_task(process_and_respond(client, msg))
-    user_tasks[user_id] = task
+    """Handle incoming messages and reschedule the user's follow-ups."""
+    # The user replied: their pending follow-ups are outdated
+    await scheduler.cancel(msg.from_user.wa_id)
+    await process_and_respond(client, msg)
 
 
 def start_server():
@@ -14,6 +14,8 @@ import httpx
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
+from pywaai.moderation import Moderator
+
 flask_app = flask.Flask(__name__)
 
 # Make sure to replace these with your actual credentials
@@ -25,6 +27,8 @@ wa = WhatsApp(
 )
 
 openai_client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+# Batches the checks of concurrent messages and caches the verdicts of repeated texts
+moderator = Moderator(openai_client)
 
 @wa.on_message()
 async def respond_message(client: WhatsApp, msg: Message):
@@ -36,9 +40,9 @@ async def respond_message(client: WhatsApp, msg: Message):
             raise ValueError("Message text is None")
         
         # Moderate the incoming message
-        moderation = await openai_client.moderations.create(input=msg.text)
-        if moderation.results[0].flagged:
-            msg.reply_text(text="I'm sorry, but I can't respond to that kind of message.")
+        moderation = await moderator.check(msg.text)
+        if moderation.flagged:
+            msg.reply_text(text=moderator.refusal)
             logging.warning(f"Flagged message from {msg.from_user.wa_id}: {msg.text}")
             return
         else:
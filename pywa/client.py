@@ -22,6 +22,7 @@ import httpx
 
 from . import utils
 from .api import WhatsAppCloudApi
+from .idempotency import IdempotencyStore
 from .handlers import (
     Handler,
     HandlerDecorators,
@@ -99,6 +100,7 @@ class WhatsApp(Server, HandlerDecorators):
         continue_handling: bool = True,
         skip_duplicate_updates: bool = True,
         validate_updates: bool = True,
+        idempotency_store: IdempotencyStore | None = None,
         **kwargs: Any,
     ) -> None:
         """
@@ -166,6 +168,9 @@ class WhatsApp(Server, HandlerDecorators):
             continue_handling: Whether to continue handling updates after a handler has been found (default: ``True``).
             skip_duplicate_updates: Whether to skip duplicate updates (default: ``True``).
             validate_updates: Whether to validate updates payloads (default: ``True``, ``app_secret`` required).
+            idempotency_store: A store of already processed update IDs, to also skip updates that WhatsApp
+             re-delivers after they were handled (optional, requires ``skip_duplicate_updates``. See
+             :mod:`pywa.idempotency`).
         """
         if not token:
             raise ValueError(
@@ -229,6 +234,7 @@ class WhatsApp(Server, HandlerDecorators):
             continue_handling=continue_handling,
             skip_duplicate_updates=skip_duplicate_updates,
             validate_updates=validate_updates,
+            idempotency_store=idempotency_store,
         )
 
     def _setup_api(
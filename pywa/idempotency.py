@@ -0,0 +1,182 @@
+"""Idempotency stores that remember which webhook updates were already processed."""
+
+from __future__ import annotations
+
+__all__ = [
+    "IdempotencyStore",
+    "MemoryIdempotencyStore",
+    "SQLiteIdempotencyStore",
+]
+
+import abc
+import collections
+import sqlite3
+import threading
+import time
+
+
+class IdempotencyStore(abc.ABC):
+    """
+    Base class for stores that deduplicate webhook updates by their ID.
+
+    - WhatsApp re-delivers webhook updates when it does not receive a response in time, so
+      the same message may arrive again after it was already handled.
+    - Pass a store to the client (``WhatsApp(..., idempotency_store=...)``) to skip those
+      re-deliveries before any handler is called.
+    - :meth:`add` and :meth:`discard` are called in a worker thread, so they may block on I/O.
+    """
+
+    @abc.abstractmethod
+    def add(self, update_id: str) -> bool:
+        """
+        Mark the update as processed.
+
+        Args:
+            update_id: The ID of the update.
+
+        Returns:
+            ``True`` if the update was not seen before, ``False`` if it is a duplicate.
+        """
+
+    @abc.abstractmethod
+    def discard(self, update_id: str) -> None:
+        """Forget the update (e.g. when processing failed and a re-delivery should be handled)."""
+
+
+class MemoryIdempotencyStore(IdempotencyStore):
+    """
+    An in-memory set of update IDs with a TTL and a bounded size.
+
+    Example:
+
+        >>> from pywa import WhatsApp
+        >>> from pywa.idempotency import MemoryIdempotencyStore
+        >>> wa = WhatsApp(..., idempotency_store=MemoryIdempotencyStore(ttl=3600))
+
+    Args:
+        ttl: How long (in seconds) to remember an update ID (default: 24 hours).
+        maxsize: The maximum number of IDs to remember, the oldest are evicted first.
+    """
+
+    def __init__(self, ttl: float = 24 * 60 * 60, maxsize: int = 100_000):
+        self._ttl = ttl
+        self._maxsize = maxsize
+        self._ids = collections.OrderedDict[str, float]()
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float) -> None:
+        while self._ids:
+            update_id, expires_at = next(iter(self._ids.items()))
+            if expires_at > now and len(self._ids) <= self._maxsize:
+                break
+            del self._ids[update_id]
+
+    def __contains__(self, update_id: str) -> bool:
+        with self._lock:
+            expires_at = self._ids.get(update_id)
+            return expires_at is not None and expires_at > time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, update_id: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            expires_at = self._ids.get(update_id)
+            if expires_at is not None and expires_at > now:
+                return False
+            self._ids[update_id] = now + self._ttl
+            self._ids.move_to_end(update_id)
+            self._expire(now)
+            return True
+
+    def discard(self, update_id: str) -> None:
+        with self._lock:
+            self._ids.pop(update_id, None)
+
+
+class SQLiteIdempotencyStore(IdempotencyStore):
+    """
+    A SQLite-backed store, shared by all the worker processes that use the same database file.
+
+    - Recently seen IDs are also kept in a :class:`MemoryIdempotencyStore` in front of the
+      database, so most re-deliveries are rejected without touching the disk.
+    - Claiming an ID is a single ``INSERT OR IGNORE``, so two workers that receive the same
+      update at the same time cannot both process it.
+
+    Example:
+
+        >>> from pywa import WhatsApp
+        >>> from pywa.idempotency import SQLiteIdempotencyStore
+        >>> wa = WhatsApp(..., idempotency_store=SQLiteIdempotencyStore("updates.db"))
+
+    Args:
+        db_path: The path of the SQLite database file.
+        ttl: How long (in seconds) to remember an update ID (default: 24 hours).
+        cache_size: The maximum number of IDs to keep in the in-memory cache.
+        cleanup_interval: Delete expired IDs from the database every this many new IDs.
+    """
+
+    def __init__(
+        self,
+        db_path: str = "pywa_updates.db",
+        ttl: float = 24 * 60 * 60,
+        cache_size: int = 100_000,
+        cleanup_interval: int = 1000,
+    ):
+        self._ttl = ttl
+        self._cache = MemoryIdempotencyStore(ttl=ttl, maxsize=cache_size)
+        self._cleanup_interval = cleanup_interval
+        self._inserts = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            db_path, timeout=30, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS processed_updates ("
+            "update_id TEXT PRIMARY KEY, processed_at REAL NOT NULL)"
+        )
+
+    def add(self, update_id: str) -> bool:
+        if update_id in self._cache:
+            return False
+        now = time.time()
+        with self._lock:
+            inserted = (
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO processed_updates VALUES (?, ?)",
+                    (update_id, now),
+                ).rowcount
+                == 1
+            )
+            if not inserted:
+                # Seen by another worker, unless its entry already expired
+                inserted = (
+                    self._conn.execute(
+                        "UPDATE processed_updates SET processed_at = ? "
+                        "WHERE update_id = ? AND processed_at < ?",
+                        (now, update_id, now - self._ttl),
+                    ).rowcount
+                    == 1
+                )
+            self._inserts += 1
+            if self._inserts % self._cleanup_interval == 0:
+                self._conn.execute(
+                    "DELETE FROM processed_updates WHERE processed_at < ?",
+                    (now - self._ttl,),
+                )
+        self._cache.add(update_id)
+        return inserted
+
+    def discard(self, update_id: str) -> None:
+        self._cache.discard(update_id)
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM processed_updates WHERE update_id = ?", (update_id,)
+            )
+
+    def close(self) -> None:
+        """Close the database connection."""
+        self._conn.close()
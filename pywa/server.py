@@ -2,11 +2,13 @@
 
 __all__ = ["Server"]
 
+import asyncio
 import logging
 import threading
 from typing import TYPE_CHECKING, Callable, TypedDict
 
 from . import utils, handlers, errors
+from .idempotency import IdempotencyStore
 from .handlers import (
     Handler,
     ChatOpenedHandler,
@@ -103,6 +105,7 @@ class Server:
         continue_handling: bool,
         skip_duplicate_updates: bool,
         validate_updates: bool,
+        idempotency_store: IdempotencyStore | None = None,
     ):
         self._server = server
         self._verify_token = verify_token
@@ -117,6 +120,7 @@ class Server:
         self._continue_handling = continue_handling
         self._skip_duplicate_updates = skip_duplicate_updates
         self._updates_ids_in_process = set[str]()
+        self._idempotency_store = idempotency_store
 
         if server is utils.MISSING:
             return
@@ -279,13 +283,26 @@ class Server:
                     update_id,
                 )
                 return "ok", 200
+            if (
+                self._idempotency_store is not None
+                and not await asyncio.to_thread(self._idempotency_store.add, update_id)
+            ):
+                _logger.warning(
+                    "Webhook ('%s') received an update with an ID that was already processed: %s",
+                    self._webhook_endpoint,
+                    update_id,
+                )
+                return "ok", 200
             self._updates_ids_in_process.add(update_id)
-        await self._call_handlers(update)
-        if self._skip_duplicate_updates:
-            try:
-                self._updates_ids_in_process.remove(update_id)
-            except KeyError:
-                pass
+        handled = False
+        try:
+            handled = await self._call_handlers(update)
+        finally:
+            if update_id:
+                self._updates_ids_in_process.discard(update_id)
+                if not handled and self._idempotency_store is not None:
+                    # Let the re-delivery of a failed update be handled
+                    await asyncio.to_thread(self._idempotency_store.discard, update_id)
         return "ok", 200
 
     def _register_routes(self: "WhatsApp") -> None:
@@ -368,8 +385,13 @@ class Server:
                     f"The `server` must be one of {utils.ServerType.protocols_names()} or None for a custom server"
                 )
 
-    async def _call_handlers(self: "WhatsApp", update: dict) -> None:
-        """Call the handlers for the given update."""
+    async def _call_handlers(self: "WhatsApp", update: dict) -> bool:
+        """
+        Call the handlers for the given update.
+
+        Returns:
+            ``False`` if the update could not be constructed or one of the handlers raised an error.
+        """
         try:
             handler_type = self._get_handler(update=update)
             if handler_type is None:
@@ -392,26 +414,28 @@ class Server:
                 update,
                 exc_info=None,
             )
-            return
+            return True
 
+        ok = True
         if handler_type is not None:
             try:
                 constructed_update = self._handlers_to_update_constractor[handler_type](
                     self, update
                 )
-                await self._call_callbacks(handler_type, constructed_update)
+                ok = await self._call_callbacks(handler_type, constructed_update)
             except Exception:
                 _logger.exception("Failed to construct update: %s", update)
+                ok = False
 
-        await self._call_callbacks(RawUpdateHandler, update)
+        return await self._call_callbacks(RawUpdateHandler, update) and ok
 
     async def _call_callbacks(
         self: "WhatsApp",
         handler_type: type[Handler],
         constructed_update: BaseUpdate | dict,
-    ) -> None:
-        """Call the handler type callbacks for the given update."""
-        handled = False
+    ) -> bool:
+        """Call the handler type callbacks for the given update, returns ``False`` if one of them failed."""
+        handled, ok = False, True
         for handler in self._handlers[handler_type]:
             try:
                 handled = await handler.handle(self, constructed_update)
@@ -424,8 +448,10 @@ class Server:
                     "An error occurred while %s was handling an update",
                     handler.callback.__name__,
                 )
+                ok = False
             if handled and not self._continue_handling:
                 break
+        return ok
 
     def _get_handler(self: "WhatsApp", update: dict) -> type[Handler] | None:
         """Get the handler for the given update."""
@@ -56,6 +56,7 @@ from .types import (
 )
 from . import utils
 from .api import WhatsAppCloudApiAsync
+from .idempotency import IdempotencyStore
 
 from .types import (
     BusinessProfile,
@@ -108,6 +109,7 @@ class WhatsApp(_WhatsApp):
         continue_handling: bool = True,
         skip_duplicate_updates: bool = True,
         validate_updates: bool = True,
+        idempotency_store: IdempotencyStore | None = None,
         business_account_id: str | int | None = None,
         callback_url: str | None = None,
         webhook_fields: Iterable[str] | None = None,
@@ -198,6 +200,9 @@ class WhatsApp(_WhatsApp):
             flows_response_encryptor: The global flows response encryptor implementation to use to encrypt Flows responses.
             continue_handling: Whether to continue handling updates after a handler has been found (default: ``True``).
             skip_duplicate_updates: Whether to skip duplicate updates (default: ``True``).
+            idempotency_store: A store of already processed update IDs, to also skip updates that WhatsApp
+             re-delivers after they were handled (optional, requires ``skip_duplicate_updates``. See
+             :mod:`pywa.idempotency`).
         """
         self._session_sync = session_sync
         super().__init__(
@@ -223,6 +228,7 @@ class WhatsApp(_WhatsApp):
             continue_handling=continue_handling,
             skip_duplicate_updates=skip_duplicate_updates,
             validate_updates=validate_updates,
+            idempotency_store=idempotency_store,
             **kwargs,
         )
 
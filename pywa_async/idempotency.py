@@ -0,0 +1 @@
+from pywa.idempotency import *  # noqa
@@ -1,6 +1,19 @@
-from pywa import __version__
-from pywa import *
+import importlib.util
 
 __version__ = "0.0.18"
 __author__ = "Gabriel Puliatti, Emptor, Inc."
 __license__ = "MIT"
+
+
+def __getattr__(name: str):
+    # The names of pywa (e.g. ``from pywaai import WhatsApp``) are still available, but
+    # pywa is only imported when one of them is first used. Submodules
+    # (``from pywaai import ai_utils``) are left to the import system.
+    if name.startswith("__") or importlib.util.find_spec(f"{__name__}.{name}"):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import pywa
+
+    try:
+        return getattr(pywa, name)
+    except AttributeError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
@@ -1,77 +1,206 @@
-from openai import OpenAI
-import instructor
-from pydantic import BaseModel, Field
-from typing import List
+"""LLM replies for WhatsApp conversations stored locally or behind the remote conversation API.
+
+openai, instructor, pydantic, httpx and pywa are imported on first use, not with this
+module, so that importing pywaai stays fast (see ``tests/test_import_time.py``).
+"""
+
+from __future__ import annotations
+
+import functools
+import warnings
+import weakref
 import os
-from pywa import WhatsApp
-from typing import List, Dict, Optional, Type
-from .conversation_db import ConversationManager
+from typing import (
+    AsyncIterator,
+    Callable,
+    List,
+    Dict,
+    Optional,
+    Set,
+    Type,
+    TYPE_CHECKING,
+)
+from .auth import TokenCache
+from .http_client import create_http_client, get_http_client
+from . import metrics as _metrics
+from .coalescer import mark_committed
+from .metrics import MetricsRegistry, TurnMetrics, get_metrics_registry
+from .moderation import Moderator
+from .prompt import PromptBuilder
+from .rate_limit import Priority, estimate_tokens, get_llm_limiter, retry_after
+from .response_cache import CachedResponse, ResponseCache
+from .routing import ModelRouter, get_model_router, turn_features
+from .splitter import MessageSplitter, RewritePolicy, split_message
 from datetime import datetime
 from zoneinfo import ZoneInfo
-from openai import AsyncOpenAI
-from instructor import OpenAISchema
-import httpx
+
+if TYPE_CHECKING:
+    import httpx
+    import instructor
+    import openai
+    from instructor import OpenAISchema
+    from openai import AsyncOpenAI
+    from pywa import WhatsApp
+
+    from .conversation_db import ConversationManager
+
+_token_cache: Optional[TokenCache] = None
+
+
+def get_token_cache() -> TokenCache:
+    """Get the shared Auth0 token cache (created from the env vars on first use)."""
+    global _token_cache
+    if _token_cache is None:
+        # Resolved on each fetch: the shared client is recreated after it is closed
+        _token_cache = TokenCache(http_client=get_http_client)
+    return _token_cache
+
+
+def set_token_cache(token_cache: TokenCache) -> None:
+    """Replace the shared token cache (e.g. with one using other credentials)."""
+    global _token_cache
+    _token_cache = token_cache
+
 
 async def get_access_token() -> str:
     """
     Get an access token from Auth0 for M2M authentication.
+
+    The token is cached until shortly before it expires (see :class:`TokenCache`).
     
     Returns:
         str: The access token for making authenticated requests
     """
-    AUTH0_DOMAIN = os.getenv("AUTH0_DOMAIN")
-    AUTH0_APP_CLIENT_ID = os.getenv("AUTH0_APP_CLIENT_ID")
-    AUTH0_APP_CLIENT_SECRET = os.getenv("AUTH0_APP_CLIENT_SECRET")
-    AUDIENCE_IDENTIFIER = os.getenv("CONVERSATIONS_AUDIENCE_IDENTIFIER")
-    
-    payload = {
-        "client_id": AUTH0_APP_CLIENT_ID,
-        "client_secret": AUTH0_APP_CLIENT_SECRET,
-        "audience": AUDIENCE_IDENTIFIER,
-        "grant_type": "client_credentials"
-    }
-    
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"https://{AUTH0_DOMAIN}/oauth/token",
-            json=payload,
-            headers={"Content-Type": "application/json"}
-        )
-        response.raise_for_status()
-        return response.json()["access_token"]
+    return await get_token_cache().get_token()
 
-try:
-    import logfire as logger
 
-    logger.configure()
-except ImportError:
+def _get_logger():
     try:
-        from loguru import logger
+        import logfire
+
+        logfire.configure()
+        return logfire
     except ImportError:
-        import logging
+        try:
+            from loguru import logger
+        except ImportError:
+            import logging
+
+            logger = logging.getLogger(__name__)
+        return logger
 
-        logger = logging.getLogger(__name__)
 
-shortener_tokens_used = 0
+class _LazyLogger:
+    """Picks (and configures) logfire, loguru or logging on the first log call."""
+
+    _logger = None
+
+    def __getattr__(self, name):
+        if self._logger is None:
+            type(self)._logger = _get_logger()
+        return getattr(self._logger, name)
+
+
+logger = _LazyLogger()
 
 
 def update_token_count(response):
-    global shortener_tokens_used
-    shortener_tokens_used += response.usage.total_tokens
+    """
+    Record the token usage of a shortener call.
+
+    .. deprecated::
+        The usage is recorded in the shared :class:`~pywaai.metrics.MetricsRegistry`, read
+        it from there (``get_metrics_registry().to_dict()``).
+    """
+    warnings.warn(
+        "update_token_count is deprecated, token usage is recorded in the metrics "
+        "registry (see pywaai.metrics)",
+        DeprecationWarning,
+        stacklevel=2,
+    )
+    get_metrics_registry().record_usage(
+        getattr(response, "model", None) or "", _metrics.SHORTENER, response.usage
+    )
     logger.info(f"Shortener tokens used in this call: {response.usage.total_tokens}")
-    logger.info(f"Total shortener tokens used in this session: {shortener_tokens_used}")
 
 
-class ShorterResponses(BaseModel):
-    """A rewritten list of messages based on the original response, but more succint, interesting and modular across multiple messages."""
+@functools.lru_cache(maxsize=None)
+def _shorter_responses_model():
+    from pydantic import BaseModel, Field
+
+    class ShorterResponses(BaseModel):
+        """A rewritten list of messages based on the original response, but more succint, interesting and modular across multiple messages."""
+
+        messages: List[str] = Field(..., description="A list of 2-4 shorter messages")
+
+        def dict(self):
+            return {"messages": [message for message in self.messages]}
+
+    return ShorterResponses
+
+
+def __getattr__(name: str):
+    # ShorterResponses is built on first use so that pydantic is not imported with pywaai
+    if name == "ShorterResponses":
+        return _shorter_responses_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+_shortener_clients: "weakref.WeakKeyDictionary[AsyncOpenAI, instructor.AsyncInstructor]" = (
+    weakref.WeakKeyDictionary()
+)
+_default_openai_client: Optional[AsyncOpenAI] = None
 
-    messages: List[str] = Field(..., description="A list of 2-4 shorter messages")
 
-    def dict(self):
-        return {"messages": [message for message in self.messages]}
+def _get_default_openai_client() -> AsyncOpenAI:
+    """Get the shared async OpenAI client (created on first use)."""
+    global _default_openai_client
+    if _default_openai_client is None:
+        from openai import AsyncOpenAI
 
+        _default_openai_client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+    return _default_openai_client
 
-async def get_shorter_responses(response: str) -> List[str]:
+
+def _get_shortener_client(
+    openai_client: Optional[AsyncOpenAI] = None,
+) -> "instructor.AsyncInstructor":
+    """Get the (cached) instructor wrapper of the given or the shared async OpenAI client."""
+    openai_client = openai_client or _get_default_openai_client()
+    client = _shortener_clients.get(openai_client)
+    if client is None:
+        import instructor
+
+        client = instructor.from_openai(openai_client)
+        _shortener_clients[openai_client] = client
+    return client
+
+
+async def get_shorter_responses(
+    response: str,
+    openai_client: Optional[AsyncOpenAI] = None,
+    model: str = "gpt-4o",
+    timeout: float = 30.0,
+    priority: int = Priority.REPLY,
+    turn: Optional[TurnMetrics] = None,
+) -> List[str]:
+    """
+    Split a long response into 2-4 shorter WhatsApp messages using the LLM.
+
+    The instructor wrapper around the async OpenAI client is built once and reused, so
+    connections are kept alive across calls and the event loop is never blocked.
+
+    Args:
+        response: The response to split.
+        openai_client: The client to use (defaults to a shared client built on first use).
+        model: The model to use.
+        timeout: The request timeout in seconds.
+        priority: The priority of the call in the shared LLM limiter.
+        turn: The metrics of the turn the call belongs to (see :mod:`pywaai.metrics`).
+
+    Returns:
+        List[str]: The shorter messages, or ``[response]`` if the request failed.
+    """
     shortener_prompt = """
     Eres un asistente encargado de dividir un mensaje largo en 2-4 mensajes más cortos adecuados para WhatsApp.
     Cada mensaje debe ser completo y tener sentido por sí mismo.
@@ -85,20 +214,29 @@ async def get_shorter_responses(response: str) -> List[str]:
     ]
 
     try:
-        shortener_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-        shortener_client = instructor.from_openai(shortener_client)
-        shorter_responses, raw_response = (
-            shortener_client.chat.completions.create_with_completion(
-                model="gpt-4o",
-                messages=messages,
-                max_tokens=800,
-                response_model=ShorterResponses,
+        shortener_client = _get_shortener_client(openai_client)
+        async with get_llm_limiter().acquire(
+            model, priority, estimate_tokens(messages, 800)
+        ) as permit:
+            shorter_responses, raw_response = (
+                await shortener_client.chat.completions.create_with_completion(
+                    model=model,
+                    messages=messages,
+                    max_tokens=800,
+                    response_model=_shorter_responses_model(),
+                    timeout=timeout,
+                )
             )
-        )
+            permit.record(raw_response.usage)
 
         logger.info(f"Shorter responses: {shorter_responses.dict()}")
 
-        update_token_count(raw_response)
+        if turn is not None:
+            turn.record_usage(raw_response.usage, model, _metrics.SHORTENER)
+        else:
+            get_metrics_registry().record_usage(
+                model, _metrics.SHORTENER, raw_response.usage
+            )
 
         return shorter_responses.dict()["messages"]
     except Exception as e:
@@ -109,8 +247,11 @@ async def get_shorter_responses(response: str) -> List[str]:
 
 async def send_message(wa_client: WhatsApp, phone_number: str, message: str = ""):
     print(message)
+    registry = get_metrics_registry()
     if message:
+        started = time.perf_counter()
         wa_client.send_message(to=phone_number, text=message)
+        registry.observe_stage(_metrics.SEND, time.perf_counter() - started)
     else:
         responses = await generate_response(
             conversation_history=ConversationHistory(),
@@ -123,39 +264,109 @@ async def send_message(wa_client: WhatsApp, phone_number: str, message: str = ""
 
         for response in responses:
             print(response["content"])
+            started = time.perf_counter()
             wa_client.send_message(to=phone_number, text=response["content"])
+            registry.observe_stage(_metrics.SEND, time.perf_counter() - started)
             logger.info(f"SENT,{phone_number},{response['content']}")
 
 
 import asyncio
 import json
+import time
+from contextlib import aclosing, nullcontext
+from dataclasses import dataclass, field
+from cachetools import LRUCache
+
+
+@dataclass
+class _RemoteTail:
+    """The locally cached messages of a remote conversation."""
+
+    messages: List[Dict[str, str]] = field(default_factory=list)
+    cursor: Optional[int] = None  # number of messages on the server we have
+    etag: Optional[str] = None
+    compacted: int = 0  # number of messages the server replaced by a summary
+
 
-async def execute_tools(tool_calls, tool_functions):
-    results = []
-    for call in tool_calls:
-        for func in tool_functions:
-            if func.__name__ == call.function.name:
-                args = json.loads(call.function.arguments)
-                tool_instance = func(**args)
-                
-                # Call run() and get the result or coroutine
-                potential_coroutine = tool_instance.run()
-                
-                # Check if the result is a coroutine
-                if asyncio.iscoroutine(potential_coroutine):
-                    # If it's a coroutine, await it
-                    result = await potential_coroutine
-                else:
-                    # If it's not a coroutine, it's already the actual result
-                    result = potential_coroutine
-                    
-                results.append(result)
-    return results if results else None
+# (remote_base_url, phone_number, conversation_id) -> _RemoteTail
+_remote_tails: "LRUCache[tuple[str, str, str], _RemoteTail]" = LRUCache(maxsize=1024)
+
+async def _execute_tool(call, tools_by_name, default_timeout: Optional[float]):
+    name = call.function.name
+    func = tools_by_name.get(name)
+    if func is None:
+        logger.error(f"Model called unknown tool: {name}")
+        return f"Error: unknown tool {name}"
+    # A tool class can set its own `timeout` (in seconds)
+    timeout = getattr(func, "timeout", default_timeout)
+    try:
+        tool_instance = func(**json.loads(call.function.arguments))
+        if asyncio.iscoroutinefunction(tool_instance.run):
+            result = await asyncio.wait_for(tool_instance.run(), timeout)
+        else:
+            # Sync tools run in the default thread pool to keep the event loop free
+            result = await asyncio.wait_for(
+                asyncio.to_thread(tool_instance.run), timeout
+            )
+        if asyncio.iscoroutine(result):
+            result = await asyncio.wait_for(result, timeout)
+        return result
+    except asyncio.TimeoutError:
+        logger.error(f"Tool {name} timed out after {timeout}s")
+        return f"Error: tool {name} timed out"
+    except Exception as e:
+        logger.error(f"Error executing tool {name}: {e}")
+        return f"Error: tool {name} failed: {e}"
+
+
+async def execute_tools(
+    tool_calls, tool_functions, timeout: Optional[float] = 30.0
+) -> Optional[list]:
+    """
+    Execute the tool calls of a completion concurrently.
+
+    Tools are looked up by name once, independent calls run concurrently, and each call
+    gets its own timeout and error handling: a failing or timed out tool produces an
+    error message for the model instead of failing the whole turn.
+
+    Args:
+        tool_calls: The tool calls of the completion message.
+        tool_functions: The tool classes (``OpenAISchema`` subclasses with a ``run`` method),
+            or a mapping of tool names to tool classes.
+        timeout: The default timeout per tool call in seconds (``None`` to wait forever).
+
+    Returns:
+        The results in the same order as ``tool_calls``, or ``None`` if there were none.
+    """
+    if not tool_calls:
+        return None
+    tools_by_name = (
+        tool_functions
+        if isinstance(tool_functions, dict)
+        else {func.__name__: func for func in tool_functions or ()}
+    )
+    return list(
+        await asyncio.gather(
+            *(_execute_tool(call, tools_by_name, timeout) for call in tool_calls)
+        )
+    )
 
 class LocalOrRemoteConversation:
     """
     A helper class to abstract over using a local ConversationManager
     or a remote conversation API.
+
+    Remote calls go through a keep-alive ``httpx.AsyncClient``. Pass ``http_client`` to share
+    a pool between conversations (as ``generate_response`` does), otherwise a client is
+    created for this conversation and closed by ``aclose()`` or on leaving
+    ``async with``.
+
+    In remote mode the messages are cached locally between turns, and only the messages
+    after the cached cursor are fetched (``GET .../messages?since=<cursor>`` with
+    ``If-None-Match``). The cache is reloaded when the server has summarized older messages
+    (``X-Compacted``). Appended messages are sent right away, unless ``buffer_writes`` is
+    set: then they are sent in a single POST on the next read, on :meth:`flush` or in
+    :meth:`aclose`, and are lost if none of these happen.
     """
 
     def __init__(
@@ -164,39 +375,70 @@ class LocalOrRemoteConversation:
         use_remote_api: bool = False,
         remote_base_url: Optional[str] = None,
         conversation_manager: Optional[ConversationManager] = None,
+        http_client: Optional[httpx.AsyncClient] = None,
+        buffer_writes: bool = False,
     ):
         self.phone_number = phone_number
         self.use_remote_api = use_remote_api
         self.remote_base_url = remote_base_url
         self.conversation_manager = conversation_manager
         self.conversation_id = None
+        self._owns_http_client = use_remote_api and http_client is None
+        self.http_client = (
+            create_http_client() if self._owns_http_client else http_client
+        )
+        self.buffer_writes = buffer_writes
+        self._pending_messages: List[Dict[str, str]] = []
+
+    async def __aenter__(self) -> "LocalOrRemoteConversation":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    async def aclose(self):
+        """Flush pending messages and close the HTTP client if it was created for this conversation."""
+        try:
+            await self.flush()
+        finally:
+            if self._owns_http_client:
+                await self.http_client.aclose()
+
+    async def _remote_request(
+        self, method: str, path: str, headers: Optional[Dict[str, str]] = None, **kwargs
+    ) -> httpx.Response:
+        """Send an authenticated request, retrying once with a new token on 401."""
+        url = f"{self.remote_base_url}{path}"
+        for attempt in range(2):
+            token = await get_access_token()
+            r = await self.http_client.request(
+                method,
+                url,
+                headers={**(headers or {}), "Authorization": f"Bearer {token}"},
+                **kwargs,
+            )
+            if r.status_code != 401 or attempt:
+                return r
+            get_token_cache().invalidate()
 
     async def _get_or_create_conversation_id_local(self):
-        conv = await self.conversation_manager.get_latest_conversation(
+        # Reuses the latest conversation or rolls over after the manager's inactivity timeout
+        return await self.conversation_manager.get_active_conversation_id(
             self.phone_number
         )
-        if not conv:
-            # Create new conversation
-            conv = await self.conversation_manager.create_conversation(
-                self.phone_number
-            )
-        return conv.conversation_id
 
     async def _get_or_create_conversation_id_remote(self):
-        token = await get_access_token()
-        headers = {"Authorization": f"Bearer {token}"}
-        async with httpx.AsyncClient() as client:
-            url = f"{self.remote_base_url}/conversations/{self.phone_number}/latest"
-            r = await client.get(url, headers=headers)
-            if r.status_code == 404:
-                # Create a new conversation
-                create_url = f"{self.remote_base_url}/conversations/{self.phone_number}"
-                c = await client.post(create_url, headers=headers)
-                c.raise_for_status()
-                return c.json()["conversation_id"]
-            else:
-                r.raise_for_status()
-                return r.json()["conversation_id"]
+        r = await self._remote_request(
+            "GET", f"/conversations/{self.phone_number}/latest"
+        )
+        if r.status_code == 404:
+            # Create a new conversation
+            c = await self._remote_request("POST", f"/conversations/{self.phone_number}")
+            c.raise_for_status()
+            return c.json()["conversation_id"]
+        else:
+            r.raise_for_status()
+            return r.json()["conversation_id"]
 
     async def get_or_create_conversation_id(self):
         if self.conversation_id:
@@ -208,37 +450,103 @@ class LocalOrRemoteConversation:
             self.conversation_id = await self._get_or_create_conversation_id_local()
         return self.conversation_id
 
+    def _tail_key(self, cid: str) -> tuple[str, str, str]:
+        return self.remote_base_url, self.phone_number, cid
+
+    async def _get_messages_remote(self, cid: str) -> List[Dict[str, str]]:
+        await self.flush()
+        tail = _remote_tails.get(self._tail_key(cid))
+        params, headers = {}, {}
+        if tail is not None:
+            if tail.cursor is not None:
+                params["since"] = tail.cursor
+            if tail.etag:
+                headers["If-None-Match"] = tail.etag
+        r = await self._remote_request(
+            "GET",
+            f"/conversations/{self.phone_number}/{cid}/messages",
+            headers=headers,
+            params=params,
+        )
+        if r.status_code == 304:
+            return list(tail.messages)
+        r.raise_for_status()
+        cursor = r.headers.get("X-Next-Cursor")
+        compacted = int(r.headers.get("X-Compacted", 0))
+        if tail is not None and compacted != tail.compacted and "since" in params:
+            # Older messages were summarized on the server: reload the compacted list
+            _remote_tails.pop(self._tail_key(cid), None)
+            return await self._get_messages_remote(cid)
+        if tail is None or cursor is None or tail.cursor is None:
+            # First fetch, or a server that always returns the full list
+            tail = _RemoteTail(messages=r.json(), compacted=compacted)
+        else:
+            tail.messages.extend(r.json())
+        tail.cursor = int(cursor) if cursor is not None else None
+        tail.etag = r.headers.get("ETag")
+        _remote_tails[self._tail_key(cid)] = tail
+        return list(tail.messages)
+
     async def get_messages(self) -> List[Dict[str, str]]:
         cid = await self.get_or_create_conversation_id()
         if self.use_remote_api:
-            token = await get_access_token()
-            headers = {"Authorization": f"Bearer {token}"}
-            async with httpx.AsyncClient() as client:
-                url = f"{self.remote_base_url}/conversations/{self.phone_number}/{cid}/messages"
-                r = await client.get(url, headers=headers)
-                r.raise_for_status()
-                return r.json()
+            return await self._get_messages_remote(cid)
         else:
             return await self.conversation_manager.get_messages(self.phone_number, cid)
 
-    async def append_message(self, message: Dict[str, str]):
+    async def flush(self):
+        """Send the buffered messages to the remote API in a single request."""
+        if not self._pending_messages:
+            return
         cid = await self.get_or_create_conversation_id()
+        pending, self._pending_messages = self._pending_messages, []
+        try:
+            r = await self._remote_request(
+                "POST",
+                f"/conversations/{self.phone_number}/{cid}/messages",
+                # A single message is sent as an object, as understood by every server
+                json=pending if len(pending) > 1 else pending[0],
+            )
+            r.raise_for_status()
+        except Exception:
+            self._pending_messages = pending + self._pending_messages
+            raise
+        tail = _remote_tails.get(self._tail_key(cid))
+        cursor = r.headers.get("X-Next-Cursor")
+        compacted = int(r.headers.get("X-Compacted", tail.compacted if tail else 0))
+        if tail is not None and tail.cursor is not None and cursor is not None:
+            if compacted == tail.compacted and int(cursor) == tail.cursor + len(pending):
+                # Nobody else wrote in between: our messages are the new tail
+                tail.messages.extend(pending)
+                tail.cursor = int(cursor)
+                tail.etag = r.headers.get("ETag")
+
+    async def append_message(self, message: Dict[str, str]):
         if self.use_remote_api:
-            token = await get_access_token()
-            headers = {"Authorization": f"Bearer {token}"}
-            async with httpx.AsyncClient() as client:
-                url = f"{self.remote_base_url}/conversations/{self.phone_number}/{cid}/messages"
-                r = await client.post(url, headers=headers, json=message)
-                r.raise_for_status()
+            self._pending_messages.append(message)
+            if not self.buffer_writes:
+                await self.flush()
         else:
+            cid = await self.get_or_create_conversation_id()
             await self.conversation_manager.add_message(self.phone_number, message, cid)
 
+    async def extend_messages(self, messages: List[Dict[str, str]]):
+        """Append several messages to the conversation in a single write."""
+        if not messages:
+            return
+        if self.use_remote_api:
+            self._pending_messages.extend(messages)
+            if not self.buffer_writes:
+                await self.flush()
+        else:
+            cid = await self.get_or_create_conversation_id()
+            await self.conversation_manager.add_messages(self.phone_number, messages, cid)
+
     async def append_tool(self, tool_call: dict, tool_content: str):
         """Append tool calls and tool responses to the conversation."""
         # tool_call is like {"role": "assistant", "tool_calls": [tool_call_data]}
         # tool_content is from the tool response
-        await self.append_message(tool_call)
-        
+
         # Get the tool_call_id from the tool_call
         # The structure should be properly accessed based on the model_dump() output
         if "tool_calls" in tool_call and isinstance(tool_call["tool_calls"], list) and len(tool_call["tool_calls"]) > 0:
@@ -258,12 +566,417 @@ class LocalOrRemoteConversation:
             logger.error(f"Unexpected tool_call structure: {tool_call}")
             raise ValueError("Unexpected tool_call structure")
         
-        # Append tool result message with the tool_call_id
-        await self.append_message({
-            "role": "tool", 
-            "content": tool_content,
-            "tool_call_id": tool_call_id
-        })
+        # Append the call and the tool result message with the tool_call_id in one write
+        await self.extend_messages([
+            tool_call,
+            {
+                "role": "tool",
+                "content": tool_content,
+                "tool_call_id": tool_call_id
+            },
+        ])
+
+
+def _tool_result_content(result) -> str:
+    """Tool messages must have string content."""
+    if isinstance(result, str):
+        return result
+    return json.dumps(result, default=str)
+
+
+def _tool_round_messages(content: Optional[str], tool_calls, results) -> List[Dict]:
+    """The assistant message with the tool calls of a round, followed by the tool results."""
+    return [
+        {
+            "role": "assistant",
+            "content": content,
+            "tool_calls": [tool_call.model_dump() for tool_call in tool_calls],
+        }
+    ] + [
+        {
+            "role": "tool",
+            "content": _tool_result_content(result),
+            "tool_call_id": tool_call.id,
+        }
+        for tool_call, result in zip(tool_calls, results)
+    ]
+
+
+def _tools_kwargs(tool_functions: Optional[List[Type[OpenAISchema]]]) -> dict:
+    if not tool_functions:
+        return {}
+    return {
+        "tools": [
+            {"type": "function", "function": func.openai_schema}
+            for func in tool_functions
+        ],
+        "tool_choice": "auto",
+    }
+
+
+def _conversation_for(
+    phone_number: str,
+    use_remote_api: bool,
+    remote_base_url: Optional[str],
+    conversation_manager: Optional[ConversationManager],
+    http_client: Optional[httpx.AsyncClient],
+) -> LocalOrRemoteConversation:
+    if use_remote_api and not remote_base_url:
+        raise ValueError("remote_base_url must be provided if use_remote_api=True")
+    if not use_remote_api and not conversation_manager:
+        raise ValueError(
+            "conversation_manager must be provided if use_remote_api=False"
+        )
+    return LocalOrRemoteConversation(
+        phone_number=phone_number,
+        use_remote_api=use_remote_api,
+        remote_base_url=remote_base_url,
+        conversation_manager=conversation_manager,
+        http_client=http_client or (get_http_client() if use_remote_api else None),
+        # _TurnWriter flushes the messages of each turn
+        buffer_writes=True,
+    )
+
+
+# (max_tokens, model) -> builder, so that token counts are cached across turns
+_prompt_builders: Dict[tuple, PromptBuilder] = {}
+
+
+async def _get_prompt_builder(max_tokens: int, model: str) -> PromptBuilder:
+    builder = _prompt_builders.get((max_tokens, model))
+    if builder is None:
+        # Loading the tokenizer reads (and may download) its encoding, so not on the loop
+        builder = await asyncio.to_thread(
+            PromptBuilder, max_tokens=max_tokens, model=model
+        )
+        builder = _prompt_builders.setdefault((max_tokens, model), builder)
+    return builder
+
+
+# (store, phone number) -> the background writes of its turns (see _TurnWriter)
+_pending_writes: Dict[tuple, Set[asyncio.Task]] = {}
+# (store, phone number) -> messages whose writes failed, stored first by the next write
+_unstored_writes: Dict[tuple, List[Dict]] = {}
+
+
+def _write_key(conv: LocalOrRemoteConversation) -> tuple:
+    """The key of the writes of a conversation: its store (manager or API) and phone number."""
+    store = conv.remote_base_url if conv.use_remote_api else id(conv.conversation_manager)
+    return store, conv.phone_number
+
+
+def _forget_write(key: tuple, task: asyncio.Task):
+    tasks = _pending_writes.get(key)
+    if tasks is not None:
+        tasks.discard(task)
+        if not tasks:
+            del _pending_writes[key]
+
+
+async def _wait_for_writes(match: Callable[[tuple], bool]) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        tasks = {
+            task
+            for key, key_tasks in list(_pending_writes.items())
+            if match(key)
+            for task in key_tasks
+        }
+        # Tasks of a loop that is gone can't be waited for
+        tasks = {task for task in tasks if task.get_loop() is loop and not task.done()}
+        if not tasks:
+            return
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def wait_for_pending_writes(phone_number: Optional[str] = None) -> None:
+    """Wait until the messages of the finished turns are stored.
+
+    :func:`generate_response` and :func:`generate_response_stream` return before the
+    replies are persisted. Call this before shutting down (or before reading the history
+    of ``phone_number`` from elsewhere), so that no message is lost.
+
+    Raises:
+        RuntimeError: If some messages could not be stored (they are kept, and stored
+            first by the next turn of their conversation).
+    """
+    await _wait_for_writes(lambda key: phone_number in (None, key[1]))
+    unstored = sum(
+        len(messages)
+        for key, messages in _unstored_writes.items()
+        if phone_number in (None, key[1])
+    )
+    if unstored:
+        raise RuntimeError(f"{unstored} messages could not be stored")
+
+
+class _TurnWriter:
+    """Persists the messages of a turn in order, off the critical path of the reply.
+
+    The messages given to :meth:`write` are stored by a background task, batched while
+    an earlier write is running, and retried on errors. The task is registered in
+    ``_pending_writes``, so that the next turn of the user reads the history after it.
+    Messages that still can't be stored are kept in ``_unstored_writes`` and go first in
+    the next write of the conversation.
+    """
+
+    def __init__(
+        self,
+        conv: LocalOrRemoteConversation,
+        registry: MetricsRegistry,
+        model: str,
+        retries: int = 2,
+    ):
+        self.conv = conv
+        self.registry = registry
+        self.model = model
+        self.retries = retries
+        self.key = _write_key(conv)
+        self._queue: List[Dict] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def write(self, messages: List[Dict]) -> None:
+        self._queue.extend(messages)
+        if self._task is None:
+            self._task = asyncio.create_task(self._drain())
+            _pending_writes.setdefault(self.key, set()).add(self._task)
+            self._task.add_done_callback(functools.partial(_forget_write, self.key))
+
+    async def _drain(self):
+        started = time.perf_counter()
+        try:
+            while self._queue:
+                batch = _unstored_writes.pop(self.key, []) + self._queue
+                self._queue = []
+                if not await self._persist(batch):
+                    # Kept in order for the next write
+                    unstored = _unstored_writes.setdefault(self.key, [])
+                    unstored.extend(batch + self._queue)
+                    self._queue = []
+        finally:
+            self._task = None
+        self.registry.observe_stage(
+            _metrics.DB_WRITE, time.perf_counter() - started, self.model
+        )
+
+    async def _persist(self, messages: List[Dict]) -> bool:
+        buffered = False
+        for attempt in range(self.retries + 1):
+            try:
+                # Remote messages stay buffered when the flush fails, so only the
+                # flush is retried
+                if not buffered:
+                    await self.conv.extend_messages(messages)
+                    buffered = True
+                await self.conv.flush()
+                return True
+            except Exception as e:
+                if attempt == self.retries:
+                    logger.error(
+                        f"Could not store {len(messages)} messages of "
+                        f"{self.conv.phone_number}, keeping them for the next turn: {e}"
+                    )
+                    # They are written again from _unstored_writes
+                    self.conv._pending_messages = []
+                    return False
+                await asyncio.sleep(0.1 * 2**attempt)
+
+
+async def _start_turn(
+    conv: LocalOrRemoteConversation,
+    writer: _TurnWriter,
+    message_text: str,
+    user_name: str,
+    timezone: str,
+    system_prompt: str,
+    prompt_builder: Optional[PromptBuilder] = None,
+    moderator: Optional[Moderator] = None,
+) -> Optional[List[Dict]]:
+    """Load the history, queue the user message for storing and build the messages for the model.
+
+    Returns ``None`` if the ``moderator`` flags the message, which is then not stored.
+    """
+    # The history as of the end of the user's previous turn
+    await _wait_for_writes(lambda key: key == writer.key)
+    if moderator is None:
+        messages_history = await conv.get_messages()
+    else:
+        messages_history, moderation = await asyncio.gather(
+            conv.get_messages(), moderator.check(message_text)
+        )
+        if moderation.flagged:
+            logger.warning(
+                f"Flagged message from {conv.phone_number}: {moderation.categories}"
+            )
+            return None
+
+    # Stored while the model works on the reply
+    user_message = {"role": "user", "content": message_text}
+    writer.write([user_message])
+    # A coalescer cancelling this turn must not hand the message over again
+    mark_committed()
+    # Messages of earlier turns that could not be stored yet are written first
+    unstored = _unstored_writes.get(writer.key, [])
+    messages_history = messages_history + unstored + [user_message]
+
+    current_time = datetime.now()
+    local_time = current_time.astimezone(ZoneInfo(timezone))
+    formatted_date = local_time.date().isoformat()
+
+    system_prompt_formatted = (
+        system_prompt
+        + f" Today's date is {formatted_date}."
+        + f" The user's phone number is: {conv.phone_number}."
+        + f" The user's name is: {user_name}."
+    )
+
+    # Build the messages for openai
+    system_message = {"role": "system", "content": system_prompt_formatted}
+    if prompt_builder is None:
+        return [system_message] + messages_history
+    return prompt_builder.build(system_message, messages_history)
+
+
+async def _create_completion(
+    openai_client: AsyncOpenAI,
+    priority: int = Priority.REPLY,
+    rate_limit_retries: int = 2,
+    turn: Optional[TurnMetrics] = None,
+    **kwargs,
+):
+    """Create a chat completion through the shared LLM limiter.
+
+    A 429 response pauses the model's queue for the ``retry-after`` delay, after which the
+    call is queued again (up to ``rate_limit_retries`` times). The call is timed and its
+    usage recorded in ``turn``.
+    """
+    import openai
+
+    limiter = get_llm_limiter()
+    model = kwargs["model"]
+    tokens = estimate_tokens(kwargs["messages"], kwargs.get("max_tokens", 0))
+    with turn.stage(_metrics.LLM) if turn is not None else nullcontext():
+        for attempt in range(rate_limit_retries + 1):
+            async with limiter.acquire(model, priority, tokens) as permit:
+                try:
+                    response = await openai_client.chat.completions.create(**kwargs)
+                except openai.RateLimitError as e:
+                    if attempt == rate_limit_retries:
+                        raise
+                    limiter.pause(model, retry_after(e, attempt))
+                    continue
+                usage = getattr(response, "usage", None)
+                permit.record(usage)
+                if turn is not None:
+                    turn.record_usage(usage, model)
+                return response
+
+
+async def _routed_completion(
+    openai_client: AsyncOpenAI,
+    router: Optional[ModelRouter],
+    priority: int,
+    turn: TurnMetrics,
+    kwargs: dict,
+):
+    """Create a chat completion, moving to the router's fallback model when the call fails
+    and to its escalation model when the reply falls short.
+
+    ``kwargs["model"]`` and the turn's model are updated to the model that answered, so
+    that the next calls of the turn use it too.
+    """
+    import openai
+
+    tried = {kwargs["model"]}
+    while True:
+        model = kwargs["model"]
+        try:
+            response = await _create_completion(
+                openai_client, priority, turn=turn, **kwargs
+            )
+        except openai.APIError as e:
+            target = router.fallback(model) if router is not None else None
+            if target is None or target in tried:
+                raise
+            logger.warning(f"Call to {model} failed ({e}), falling back to {target}")
+        else:
+            target = router.escalation(model, response) if router is not None else None
+            if target is None or target in tried:
+                return response
+            logger.info(f"Escalating the reply of {model} to {target}")
+        tried.add(target)
+        kwargs["model"] = turn.model = target
+
+
+_STREAM_END = object()
+
+
+async def _stream_completion(
+    openai_client: AsyncOpenAI,
+    priority: int,
+    turn: TurnMetrics,
+    kwargs: dict,
+) -> AsyncIterator:
+    """Stream a chat completion through the shared LLM limiter.
+
+    A task holding the limiter permit reads the stream into a queue, so the permit is
+    released when the model is done rather than when the caller is done with the chunks
+    (e.g. after sending them to the user). The usage is recorded in ``turn``.
+    """
+    limiter = get_llm_limiter()
+    tokens = estimate_tokens(kwargs["messages"], kwargs.get("max_tokens", 0))
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def read():
+        try:
+            async with limiter.acquire(kwargs["model"], priority, tokens) as permit:
+                stream = await openai_client.chat.completions.create(**kwargs)
+                async for chunk in stream:
+                    usage = getattr(chunk, "usage", None)
+                    if usage is not None:
+                        permit.record(usage)
+                        turn.record_usage(usage)
+                    queue.put_nowait(chunk)
+        except Exception as e:
+            queue.put_nowait(e)
+        finally:
+            queue.put_nowait(_STREAM_END)
+
+    reader = asyncio.create_task(read())
+    try:
+        while (item := await queue.get()) is not _STREAM_END:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        reader.cancel()
+
+
+def _cache_scope(timezone: str, cache_scope: Optional[str]) -> str:
+    """The scope of cached replies: the caller's scope and the date (replies may use it)."""
+    date = datetime.now(ZoneInfo(timezone)).date().isoformat()
+    return date if cache_scope is None else f"{cache_scope} {date}"
+
+
+def _is_personal(content: str, phone_number: str, user_name: str) -> bool:
+    """Whether a reply mentions the user, and so can't be sent to others."""
+    text = content.casefold()
+    name = user_name.strip().casefold()
+    return phone_number in text or bool(name) and name in text
+
+
+def _can_use_cache(
+    response_cache: Optional[ResponseCache],
+    tool_functions: Optional[List[Type[OpenAISchema]]],
+    messages: List[Dict],
+) -> bool:
+    """Whether a cached reply can answer the latest message of the prompt."""
+    if response_cache is None or tool_functions:
+        return False
+    # The reply may depend on earlier messages (but not on summaries or the system prompt)
+    earlier = sum(1 for message in messages[:-1] if message.get("role") != "system")
+    return earlier <= response_cache.max_history_messages
+
 
 async def generate_response(
     phone_number: str,
@@ -273,11 +986,23 @@ async def generate_response(
     system_prompt: str = "You are a helpful assistant.",
     model: str = "gpt-4o",
     max_message_chars: int = 300,
-    openai_client: AsyncOpenAI = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY")),
+    openai_client: Optional[AsyncOpenAI] = None,
     tool_functions: Optional[List[Type[OpenAISchema]]] = None,
     use_remote_api: bool = False,
     remote_base_url: Optional[str] = None,
     conversation_manager: Optional[ConversationManager] = None,
+    http_client: Optional[httpx.AsyncClient] = None,
+    tool_timeout: Optional[float] = 30.0,
+    max_tool_rounds: int = 5,
+    rewrite_policy: Optional[RewritePolicy] = None,
+    max_prompt_tokens: Optional[int] = None,
+    prompt_builder: Optional[PromptBuilder] = None,
+    response_cache: Optional[ResponseCache] = None,
+    cache_scope: Optional[str] = None,
+    priority: int = Priority.REPLY,
+    metrics: Optional[MetricsRegistry] = None,
+    router: Optional[ModelRouter] = None,
+    moderator: Optional[Moderator] = None,
 ) -> List[Dict[str, str]]:
     """
     Generate a response from the OpenAI model using either:
@@ -286,99 +1011,373 @@ async def generate_response(
 
     If use_remote_api=True, remote_base_url must be provided.
     Otherwise conversation_manager must be provided.
+
+    Remote calls share the pooled ``http_client`` (defaults to the client of
+    :func:`pywaai.http_client.get_http_client`).
+
+    Tool calls are executed for up to ``max_tool_rounds`` rounds, after which the model is
+    asked for a final answer without tools.
+
+    The history is read once; the user message, each round's assistant message and tool
+    results, and the reply are stored in order by a background task, while the model
+    works and the reply is sent. The next turn of the user waits for them, and
+    :func:`wait_for_pending_writes` waits for all of them (e.g. before shutting down).
+
+    Replies longer than ``max_message_chars`` are split locally (see
+    :func:`pywaai.splitter.split_message`). They are rewritten by the LLM
+    (:func:`get_shorter_responses`) only when ``rewrite_policy`` returns ``True`` for the
+    reply and its local split, e.g. ``rewrite_policy=rewrite_if_more_than(4)``.
+
+    The whole history is sent by default. With ``max_prompt_tokens`` (e.g. ``16000``), the
+    prompt keeps only the most recent messages within that budget, see
+    :class:`pywaai.prompt.PromptBuilder`. Pass ``prompt_builder`` to use a custom builder
+    instead.
+
+    With a ``response_cache`` (see :class:`pywaai.response_cache.ResponseCache`), a repeated
+    question is answered from the cache without calling the model, also for other users.
+    Replies are keyed by ``system_prompt``, ``model``, the date and ``cache_scope`` (e.g.
+    a tenant or language, ``None`` shares them across every caller), and replies that
+    mention the user's name or phone number are not cached. The cache is skipped when
+    ``tool_functions`` are given or when the conversation has earlier messages.
+
+    LLM calls wait in the shared limiter (see :mod:`pywaai.rate_limit`) in the ``priority``
+    lane, e.g. ``Priority.FOLLOW_UP`` for messages the user did not just ask for.
+
+    Stage timings, token usage and cache hits of the turn are recorded in ``metrics``
+    (defaults to the shared :class:`pywaai.metrics.MetricsRegistry`).
+
+    With a ``router`` (defaults to :func:`pywaai.routing.get_model_router`), the turn is
+    answered by the model it picks instead of ``model``, e.g. a smaller model for "ok" or
+    "thanks". Failed calls are retried with the router's fallback model, and replies that
+    fall short with its escalation model. ``model`` still keys the response cache.
+
+    With a ``moderator`` (see :class:`pywaai.moderation.Moderator`), the message is checked
+    while the history is loaded. Flagged messages are answered with ``moderator.refusal``,
+    without calling the model or storing them.
     """
-    if use_remote_api and not remote_base_url:
-        raise ValueError("remote_base_url must be provided if use_remote_api=True")
-    if not use_remote_api and not conversation_manager:
-        raise ValueError(
-            "conversation_manager must be provided if use_remote_api=False"
+    openai_client = openai_client or _get_default_openai_client()
+    registry = metrics or get_metrics_registry()
+    turn = registry.turn(phone_number, model)
+    try:
+        conv = _conversation_for(
+            phone_number, use_remote_api, remote_base_url, conversation_manager, http_client
         )
+        writer = _TurnWriter(conv, registry, model)
+        if prompt_builder is None and max_prompt_tokens is not None:
+            prompt_builder = await _get_prompt_builder(max_prompt_tokens, model)
+        with turn.stage(_metrics.DB_READ):
+            messages = await _start_turn(
+                conv,
+                writer,
+                message_text,
+                user_name,
+                timezone,
+                system_prompt,
+                prompt_builder,
+                moderator,
+            )
+        turn.conversation_id = conv.conversation_id
+        if messages is None:
+            return [{"role": "assistant", "content": moderator.refusal}]
 
-    conv = LocalOrRemoteConversation(
-        phone_number=phone_number,
-        use_remote_api=use_remote_api,
-        remote_base_url=remote_base_url,
-        conversation_manager=conversation_manager,
-    )
+        use_cache = _can_use_cache(response_cache, tool_functions, messages)
+        if use_cache:
+            scope = _cache_scope(timezone, cache_scope)
+            cached = await response_cache.get(
+                system_prompt, model, message_text, context=scope
+            )
+            turn.record_cache(cached is not None)
+            if cached is not None:
+                writer.write([{"role": "assistant", "content": cached.content}])
+                return [{"role": "assistant", "content": msg} for msg in cached.messages]
 
-    # Append user message first
-    await conv.append_message({"role": "user", "content": message_text})
+        router = router or get_model_router()
+        if router is not None:
+            turn.model = router.route(
+                turn_features(message_text, messages, tool_functions), model
+            )
+        chat_completion_kwargs = {
+            "model": turn.model,
+            "messages": messages,
+            "max_tokens": 800,
+            **_tools_kwargs(tool_functions),
+        }
 
-    current_time = datetime.now()
-    local_time = current_time.astimezone(ZoneInfo(timezone))
-    formatted_date = local_time.date().isoformat()
+        response = await _routed_completion(
+            openai_client, router, priority, turn, chat_completion_kwargs
+        )
 
-    system_prompt_formatted = (
-        system_prompt
-        + f" Today's date is {formatted_date}."
-        + f" The user's phone number is: {phone_number}."
-        + f" The user's name is: {user_name}."
-    )
+        # Handle tool calls, round after round
+        tool_rounds = 0
+        tools_by_name = {func.__name__: func for func in tool_functions or ()}
+        while response.choices[0].message.tool_calls:
+            tool_calls = response.choices[0].message.tool_calls
+            tool_rounds += 1
+            with turn.stage(_metrics.TOOLS):
+                assistant_responses = await execute_tools(
+                    tool_calls, tools_by_name, timeout=tool_timeout
+                )
 
-    # Retrieve all conversation messages
-    messages_history = await conv.get_messages()
+            round_messages = _tool_round_messages(
+                response.choices[0].message.content, tool_calls, assistant_responses
+            )
+            # Stored in the background, and no re-read: the history is extended in memory
+            writer.write(round_messages)
+            messages.extend(round_messages)
 
-    # Build the messages for openai
-    messages = [
-        {"role": "system", "content": system_prompt_formatted}
-    ] + messages_history
+            if tool_rounds >= max_tool_rounds:
+                logger.warning(
+                    f"Reached {max_tool_rounds} tool rounds, asking for a final answer"
+                )
+                chat_completion_kwargs.pop("tools", None)
+                chat_completion_kwargs.pop("tool_choice", None)
+            response = await _routed_completion(
+                openai_client, router, priority, turn, chat_completion_kwargs
+            )
 
-    chat_completion_kwargs = {
-        "model": model,
-        "messages": messages,
-        "max_tokens": 800,
-    }
+        content = (
+            response.choices[0].message.content.strip()
+            if response.choices[0].message.content
+            else "I'm sorry, I couldn't retrieve the requested information."
+        )
 
-    if tool_functions:
-        chat_completion_kwargs["tools"] = [
-            {"type": "function", "function": func.openai_schema}
-            for func in tool_functions
-        ]
-        chat_completion_kwargs["tool_choice"] = "auto"
+        # The full reply is stored while it is rewritten (or sent)
+        writer.write([{"role": "assistant", "content": content}])
+        replies = [content]
+        if len(content) > max_message_chars:
+            replies = split_message(content, max_chars=max_message_chars)
+        if len(content) > max_message_chars and (
+            rewrite_policy is not None and rewrite_policy(content, replies)
+        ):
+            with turn.stage(_metrics.SHORTENER):
+                replies = await get_shorter_responses(
+                    content, openai_client=openai_client, priority=priority, turn=turn
+                )
 
-    response = await openai_client.chat.completions.create(**chat_completion_kwargs)
+        if (
+            use_cache
+            and response.choices[0].message.content
+            and not _is_personal(content, phone_number, user_name)
+        ):
+            await response_cache.put(
+                system_prompt,
+                model,
+                message_text,
+                CachedResponse(content, replies),
+                context=scope,
+            )
+        return [{"role": "assistant", "content": msg} for msg in replies]
+    finally:
+        turn.finish()
 
-    # Handle tool calls
-    if response.choices[0].message.tool_calls:
-        tool_calls = response.choices[0].message.tool_calls
-        assistant_responses = await execute_tools(tool_calls, tool_functions)
 
-        for i, tool_call in enumerate(tool_calls):
-            await conv.append_tool(
-                {"role": "assistant", "tool_calls": [tool_call.model_dump()]},
-                assistant_responses[i],
-            )
+def _merge_tool_call_deltas(tool_calls: Dict[int, dict], deltas) -> None:
+    """Accumulate the streamed fragments of tool calls by index."""
+    for delta in deltas:
+        call = tool_calls.setdefault(
+            delta.index,
+            {"id": "", "type": "function", "function": {"name": "", "arguments": ""}},
+        )
+        if delta.id:
+            call["id"] = delta.id
+        if delta.function is not None:
+            call["function"]["name"] += delta.function.name or ""
+            call["function"]["arguments"] += delta.function.arguments or ""
 
-        # After tool calls, regenerate response
-        messages_history = await conv.get_messages()
-        logger.info(f"Messages history: {messages_history}")
-        messages = [
-            {"role": "system", "content": system_prompt_formatted}
-        ] + messages_history
-
-        response = await openai_client.chat.completions.create(
-            model=model,
-            messages=messages,
-            max_tokens=800,
+
+async def generate_response_stream(
+    phone_number: str,
+    message_text: str,
+    user_name: str,
+    timezone: str = "America/Lima",
+    system_prompt: str = "You are a helpful assistant.",
+    model: str = "gpt-4o",
+    max_message_chars: int = 300,
+    openai_client: Optional[AsyncOpenAI] = None,
+    tool_functions: Optional[List[Type[OpenAISchema]]] = None,
+    use_remote_api: bool = False,
+    remote_base_url: Optional[str] = None,
+    conversation_manager: Optional[ConversationManager] = None,
+    http_client: Optional[httpx.AsyncClient] = None,
+    tool_timeout: Optional[float] = 30.0,
+    max_tool_rounds: int = 5,
+    max_prompt_tokens: Optional[int] = None,
+    prompt_builder: Optional[PromptBuilder] = None,
+    response_cache: Optional[ResponseCache] = None,
+    cache_scope: Optional[str] = None,
+    priority: int = Priority.REPLY,
+    metrics: Optional[MetricsRegistry] = None,
+    router: Optional[ModelRouter] = None,
+    moderator: Optional[Moderator] = None,
+) -> AsyncIterator[Dict[str, str]]:
+    """
+    Like :func:`generate_response`, but streams the completion and yields each WhatsApp
+    message as soon as it is complete, instead of waiting for the whole reply.
+
+    The reply is cut at paragraph or sentence boundaries into messages of at most
+    ``max_message_chars`` (see :class:`pywaai.splitter.MessageSplitter`), without a second
+    LLM call. The full reply is stored in the background once the stream ends (see
+    :func:`wait_for_pending_writes`). The time the caller takes between messages is
+    recorded as the ``send`` stage of the turn. Turns are routed as in
+    :func:`generate_response`, with fallbacks but no escalations, since the reply is
+    already being sent.
+
+    Example:
+
+        >>> async for message in generate_response_stream(...):
+        ...     await wa.send_message(to=phone_number, text=message["content"])
+    """
+    openai_client = openai_client or _get_default_openai_client()
+    registry = metrics or get_metrics_registry()
+    turn = registry.turn(phone_number, model)
+    try:
+        conv = _conversation_for(
+            phone_number, use_remote_api, remote_base_url, conversation_manager, http_client
         )
+        writer = _TurnWriter(conv, registry, model)
+        if prompt_builder is None and max_prompt_tokens is not None:
+            prompt_builder = await _get_prompt_builder(max_prompt_tokens, model)
+        with turn.stage(_metrics.DB_READ):
+            messages = await _start_turn(
+                conv,
+                writer,
+                message_text,
+                user_name,
+                timezone,
+                system_prompt,
+                prompt_builder,
+                moderator,
+            )
+        turn.conversation_id = conv.conversation_id
+        if messages is None:
+            with turn.stage(_metrics.SEND):
+                yield {"role": "assistant", "content": moderator.refusal}
+            return
 
-    content = (
-        response.choices[0].message.content.strip()
-        if response.choices[0].message.content
-        else "I'm sorry, I couldn't retrieve the requested information."
-    )
+        use_cache = _can_use_cache(response_cache, tool_functions, messages)
+        if use_cache:
+            scope = _cache_scope(timezone, cache_scope)
+            cached = await response_cache.get(
+                system_prompt, model, message_text, context=scope
+            )
+            turn.record_cache(cached is not None)
+            if cached is not None:
+                for message in cached.messages:
+                    with turn.stage(_metrics.SEND):
+                        yield {"role": "assistant", "content": message}
+                writer.write([{"role": "assistant", "content": cached.content}])
+                return
 
-    # Possibly shorten response if too long
-    if len(content) > max_message_chars:
-        shorter_responses = await get_shorter_responses(content)
-        # Append each shorter response to conversation and return
-        final_responses = []
-        for msg in shorter_responses:
-            response_msg = {"role": "assistant", "content": msg}
-            await conv.append_message(response_msg)
-            final_responses.append(response_msg)
-        return final_responses
-    else:
-        response_msg = {"role": "assistant", "content": content}
-        await conv.append_message(response_msg)
-        return [response_msg]
+        import openai
+
+        router = router or get_model_router()
+        if router is not None:
+            turn.model = router.route(
+                turn_features(message_text, messages, tool_functions), model
+            )
+        tried = {turn.model}
+        chat_completion_kwargs = {
+            "model": turn.model,
+            "messages": messages,
+            "max_tokens": 800,
+            "stream": True,
+            "stream_options": {"include_usage": True},
+            **_tools_kwargs(tool_functions),
+        }
+        tools_by_name = {func.__name__: func for func in tool_functions or ()}
+        splitter = MessageSplitter(max_chars=max_message_chars)
+        sent: List[str] = []
+
+        for tool_round in range(max_tool_rounds + 1):
+            if tool_round == max_tool_rounds:
+                chat_completion_kwargs.pop("tools", None)
+                chat_completion_kwargs.pop("tool_choice", None)
+            content_parts: List[str] = []
+            tool_calls: Dict[int, dict] = {}
+            with turn.stage(_metrics.LLM):
+                while True:
+                    received = False
+                    try:
+                        async with aclosing(
+                            _stream_completion(
+                                openai_client, priority, turn, chat_completion_kwargs
+                            )
+                        ) as chunks:
+                            async for chunk in chunks:
+                                received = True
+                                if not chunk.choices:
+                                    continue
+                                delta = chunk.choices[0].delta
+                                if delta.tool_calls:
+                                    _merge_tool_call_deltas(
+                                        tool_calls, delta.tool_calls
+                                    )
+                                if not delta.content:
+                                    continue
+                                content_parts.append(delta.content)
+                                for message in splitter.feed(delta.content):
+                                    sent.append(message)
+                                    with turn.stage(_metrics.SEND):
+                                        yield {"role": "assistant", "content": message}
+                    except openai.APIError as e:
+                        # Nothing was streamed yet: retry with the fallback model
+                        target = router.fallback(turn.model) if router else None
+                        if received or target is None or target in tried:
+                            raise
+                        logger.warning(
+                            f"Call to {turn.model} failed ({e}), "
+                            f"falling back to {target}"
+                        )
+                        tried.add(target)
+                        chat_completion_kwargs["model"] = turn.model = target
+                        continue
+                    break
+            content = "".join(content_parts)
+            if not tool_calls:
+                break
+
+            # Send what the model said before calling the tools (e.g. "Let me check")
+            for message in splitter.flush():
+                sent.append(message)
+                with turn.stage(_metrics.SEND):
+                    yield {"role": "assistant", "content": message}
+
+            from openai.types.chat import ChatCompletionMessageToolCall
+
+            calls = [
+                ChatCompletionMessageToolCall.model_validate(tool_calls[index])
+                for index in sorted(tool_calls)
+            ]
+            with turn.stage(_metrics.TOOLS):
+                results = await execute_tools(calls, tools_by_name, timeout=tool_timeout)
+            round_messages = _tool_round_messages(content or None, calls, results)
+            writer.write(round_messages)
+            messages.extend(round_messages)
+
+        for message in splitter.flush():
+            sent.append(message)
+            with turn.stage(_metrics.SEND):
+                yield {"role": "assistant", "content": message}
+        content = content.strip()
+        if not content and not sent:
+            content = "I'm sorry, I couldn't retrieve the requested information."
+            with turn.stage(_metrics.SEND):
+                yield {"role": "assistant", "content": content}
+
+        if content:
+            writer.write([{"role": "assistant", "content": content}])
+        if (
+            use_cache
+            and content
+            and sent
+            and not _is_personal(content, phone_number, user_name)
+        ):
+            await response_cache.put(
+                system_prompt,
+                model,
+                message_text,
+                CachedResponse(content, sent),
+                context=scope,
+            )
+    finally:
+        turn.finish()
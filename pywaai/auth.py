@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from typing import TYPE_CHECKING, Callable, Optional, Union
+
+if TYPE_CHECKING:
+    import httpx
+
+try:
+    from loguru import logger
+except ImportError:
+    import logging
+
+    logger = logging.getLogger(__name__)
+
+
+class TokenCache:
+    """Caches an Auth0 M2M (client credentials) access token until it expires.
+
+    - The token is refreshed in the background ``refresh_margin`` seconds before it expires,
+      so callers keep using the current token instead of waiting for a new one.
+    - Concurrent refreshes are collapsed into a single in-flight request.
+
+    The credentials default to the ``AUTH0_DOMAIN``, ``AUTH0_APP_CLIENT_ID``,
+    ``AUTH0_APP_CLIENT_SECRET`` and ``CONVERSATIONS_AUDIENCE_IDENTIFIER`` env vars.
+    """
+
+    def __init__(
+        self,
+        domain: Optional[str] = None,
+        client_id: Optional[str] = None,
+        client_secret: Optional[str] = None,
+        audience: Optional[str] = None,
+        refresh_margin: float = 60.0,
+        http_client: Union[
+            httpx.AsyncClient, Callable[[], httpx.AsyncClient], None
+        ] = None,
+    ):
+        """Initialize the token cache.
+
+        Args:
+            domain: The Auth0 domain.
+            client_id: The M2M application client ID.
+            client_secret: The M2M application client secret.
+            audience: The API audience identifier.
+            refresh_margin: Refresh the token this many seconds before it expires.
+            http_client: The client to request tokens with, or a function returning it on
+                each fetch (e.g. :func:`pywaai.http_client.get_http_client`, whose client
+                is replaced after it is closed). A new client is created on first use
+                if omitted.
+        """
+        self.domain = domain or os.getenv("AUTH0_DOMAIN")
+        self.client_id = client_id or os.getenv("AUTH0_APP_CLIENT_ID")
+        self.client_secret = client_secret or os.getenv("AUTH0_APP_CLIENT_SECRET")
+        self.audience = audience or os.getenv("CONVERSATIONS_AUDIENCE_IDENTIFIER")
+        self.refresh_margin = refresh_margin
+        self.http_client = http_client
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    async def _fetch_token(self) -> str:
+        if self.http_client is None:
+            import httpx
+
+            self.http_client = httpx.AsyncClient(timeout=10.0)
+        http_client = (
+            self.http_client() if callable(self.http_client) else self.http_client
+        )
+        response = await http_client.post(
+            f"https://{self.domain}/oauth/token",
+            json={
+                "client_id": self.client_id,
+                "client_secret": self.client_secret,
+                "audience": self.audience,
+                "grant_type": "client_credentials",
+            },
+            headers={"Content-Type": "application/json"},
+        )
+        response.raise_for_status()
+        data = response.json()
+        self._token = data["access_token"]
+        self._expires_at = time.monotonic() + float(data.get("expires_in", 86400))
+        logger.debug(f"Fetched a new access token for {self.audience}")
+        return self._token
+
+    def _refresh(self) -> asyncio.Task:
+        """Start a refresh, or join the one that is already in flight."""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._fetch_token())
+            # Retrieve the exception of background refreshes nobody awaits
+            self._refresh_task.add_done_callback(
+                lambda task: task.cancelled() or task.exception()
+            )
+        return self._refresh_task
+
+    async def get_token(self) -> str:
+        """Get a valid access token, fetching a new one only when needed."""
+        remaining = self._expires_at - time.monotonic()
+        if self._token is not None and remaining > 0:
+            if remaining <= self.refresh_margin:
+                self._refresh()
+            return self._token
+        return await asyncio.shield(self._refresh())
+
+    def invalidate(self) -> None:
+        """Drop the cached token (e.g. after the API rejected it)."""
+        self._token = None
+        self._expires_at = 0.0
+
+
+class StaticTokenCache(TokenCache):
+    """A token cache that always returns the same token (e.g. for local servers and tests)."""
+
+    def __init__(self, token: str = "local"):
+        super().__init__()
+        self._token = token
+        self._expires_at = float("inf")
+
+    def invalidate(self) -> None:
+        pass
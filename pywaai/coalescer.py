@@ -0,0 +1,233 @@
+"""Per-user coalescing of consecutive messages into a single reply.
+
+Users often send a thought as several quick messages ("hi", "one question", "do you ship
+to Lima?"). Replying to each of them costs an LLM call per message and produces answers
+to half-finished questions. :class:`MessageCoalescer` buffers the messages of each user
+until they stop typing, and hands the whole batch to a single handler call.
+"""
+
+import asyncio
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Generic, List, Optional, TypeVar
+
+from cachetools import TTLCache
+
+try:
+    from loguru import logger
+except ImportError:
+    import logging
+
+    logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+BatchHandler = Callable[[str, List[T]], Awaitable[Any]]
+"""Receives the user's ``wa_id`` and the buffered messages, oldest first."""
+
+
+@dataclass
+class _UserState(Generic[T]):
+    messages: List[T] = field(default_factory=list)
+    first_at: float = 0.0
+    timer: Optional[asyncio.TimerHandle] = None
+    task: Optional[asyncio.Task] = None
+    in_flight: List[T] = field(default_factory=list)
+    # Whether the handler stored the in-flight messages (see mark_committed)
+    committed: bool = False
+
+
+# The batch handled by the current task: (coalescer, wa_id, batch)
+_handling: ContextVar[Optional[tuple]] = ContextVar("pywaai_coalescer_batch", default=None)
+
+
+def mark_committed() -> None:
+    """Tell the coalescer that the batch being handled was stored in the conversation.
+
+    A superseded batch is then not handled again with the new messages (it is already in
+    the history). :func:`~pywaai.ai_utils.generate_response` calls it once it has queued
+    the user message; other handlers that store the messages themselves should too. Does
+    nothing outside of a coalescer's handler.
+    """
+    current = _handling.get()
+    if current is not None:
+        coalescer, wa_id, batch = current
+        coalescer._commit(wa_id, batch)
+
+
+class MessageCoalescer(Generic[T]):
+    """Buffers the consecutive messages of each user and handles them in a single call.
+
+    A user's batch is handled once they have been quiet for an adaptive window: about
+    ``gap_multiplier`` times their usual gap between quick messages, within
+    ``[min_delay, max_delay]``. A batch never waits more than ``max_wait`` after its first
+    message, and is handled at once when it reaches ``max_messages``.
+
+    A message arriving while the previous batch is being handled cancels that handler
+    (its reply is outdated), and the unanswered messages are handled again together with
+    the new ones, unless the handler already stored them (see :func:`mark_committed`):
+    only the new messages are handled then, and the earlier ones are in the history. With ``cancel_superseded=False`` the handler finishes and the new
+    messages are handled after it instead. Batches of a user are never handled
+    concurrently.
+
+    Only users with pending or running batches hold state; the typing statistics of idle
+    users expire after ``idle_ttl`` seconds.
+
+    Example:
+
+        >>> async def reply(wa_id: str, texts: List[str]):
+        ...     responses = await generate_response(
+        ...         phone_number=wa_id, message_text="\\n".join(texts), ...
+        ...     )
+        ...     for response in responses:
+        ...         await wa.send_message(to=wa_id, text=response["content"])
+        >>> coalescer = MessageCoalescer(reply)
+        >>> @wa.on_message()
+        ... async def on_message(client, msg):
+        ...     coalescer.add(msg.from_user.wa_id, msg.text)
+    """
+
+    def __init__(
+        self,
+        handler: BatchHandler,
+        min_delay: float = 1.0,
+        max_delay: float = 5.0,
+        max_wait: float = 15.0,
+        max_messages: int = 20,
+        gap_multiplier: float = 1.5,
+        cancel_superseded: bool = True,
+        max_users: int = 100_000,
+        idle_ttl: float = 3600,
+    ):
+        """
+        Args:
+            handler: An async function receiving the ``wa_id`` and the batched messages.
+            min_delay: The shortest quiet time (in seconds) before a batch is handled.
+            max_delay: The longest quiet time before a batch is handled. Longer gaps
+                between messages are not counted as typing.
+            max_wait: The longest time a batch waits after its first message.
+            max_messages: Handle a batch at once when it holds this many messages.
+            gap_multiplier: The window is this many times the user's average gap.
+            cancel_superseded: Cancel a running handler when new messages arrive.
+            max_users: How many users' typing statistics to keep.
+            idle_ttl: How long (in seconds) to keep the typing statistics of idle users.
+        """
+        if min_delay > max_delay:
+            raise ValueError("min_delay must not be greater than max_delay")
+        self.handler = handler
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self.max_messages = max_messages
+        self.gap_multiplier = gap_multiplier
+        self.cancel_superseded = cancel_superseded
+        self._states: Dict[str, _UserState[T]] = {}
+        # wa_id -> (time of the last message, average gap between quick messages)
+        self._typing: "TTLCache[str, tuple[float, Optional[float]]]" = TTLCache(
+            maxsize=max_users, ttl=idle_ttl
+        )
+
+    def window(self, wa_id: str) -> float:
+        """The quiet time (in seconds) after which the batch of a user is handled."""
+        _, gap = self._typing.get(wa_id, (0.0, None))
+        if gap is None:
+            return self.min_delay
+        return min(self.max_delay, max(self.min_delay, gap * self.gap_multiplier))
+
+    def _observe(self, wa_id: str, now: float):
+        last_at, gap = self._typing.get(wa_id, (None, None))
+        if last_at is not None and now - last_at <= self.max_delay:
+            observed = now - last_at
+            gap = observed if gap is None else 0.7 * gap + 0.3 * observed
+        self._typing[wa_id] = (now, gap)
+
+    def add(self, wa_id: str, message: T) -> None:
+        """Buffer a message of a user (must be called from the event loop)."""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self._observe(wa_id, now)
+        state = self._states.get(wa_id)
+        if state is None:
+            state = self._states[wa_id] = _UserState()
+
+        if state.task is not None and self.cancel_superseded and state.in_flight:
+            logger.debug(f"New message from {wa_id}, cancelling the outdated reply")
+            state.task.cancel()
+            if not state.committed:
+                state.messages = state.in_flight + state.messages
+            state.in_flight = []
+        if not state.messages:
+            state.first_at = now
+        state.messages.append(message)
+
+        if state.timer is not None:
+            state.timer.cancel()
+            state.timer = None
+        if len(state.messages) >= self.max_messages:
+            self._dispatch(wa_id)
+            return
+        delay = min(self.window(wa_id), state.first_at + self.max_wait - now)
+        state.timer = loop.call_later(max(0.0, delay), self._dispatch, wa_id)
+
+    def _dispatch(self, wa_id: str):
+        state = self._states.get(wa_id)
+        if state is None:
+            return
+        if state.timer is not None:
+            state.timer.cancel()
+            state.timer = None
+        if not state.messages or state.task is not None:
+            # Handled when the running batch is done
+            return
+        batch, state.messages = state.messages, []
+        state.in_flight = batch
+        state.committed = False
+        state.task = asyncio.create_task(self._handle(wa_id, batch))
+        state.task.add_done_callback(lambda task: self._done(wa_id, task))
+
+    async def _handle(self, wa_id: str, batch: List[T]):
+        # Set in the task's own context
+        _handling.set((self, wa_id, batch))
+        try:
+            await self.handler(wa_id, batch)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error handling the messages of {wa_id}: {e}")
+
+    def _done(self, wa_id: str, task: asyncio.Task):
+        state = self._states.get(wa_id)
+        if state is None or state.task is not task:
+            return
+        state.task = None
+        state.in_flight = []
+        state.committed = False
+        if state.messages:
+            if state.timer is None:
+                self._dispatch(wa_id)
+        else:
+            del self._states[wa_id]
+
+    def _commit(self, wa_id: str, batch: List[T]):
+        state = self._states.get(wa_id)
+        if state is not None and state.in_flight is batch:
+            state.committed = True
+
+    def pending(self, wa_id: str) -> int:
+        """The number of buffered (not yet handled) messages of a user."""
+        state = self._states.get(wa_id)
+        return len(state.messages) if state else 0
+
+    def flush(self, wa_id: Optional[str] = None) -> None:
+        """Handle the buffered messages of a user (or of all users) now."""
+        for user in [wa_id] if wa_id is not None else list(self._states):
+            self._dispatch(user)
+
+    async def wait(self) -> None:
+        """Handle all buffered messages now and wait for the handlers (e.g. on shutdown)."""
+        while self._states:
+            self.flush()
+            tasks = [s.task for s in self._states.values() if s.task is not None]
+            if not tasks:
+                break
+            await asyncio.gather(*tasks, return_exceptions=True)
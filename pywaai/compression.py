@@ -0,0 +1,128 @@
+"""Dictionary-trained zstd compression for stored conversation messages.
+
+Requires ``zstandard`` (``pip install "pywaai[compression]"``).
+"""
+
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Optional, Union
+
+if TYPE_CHECKING:
+    import zstandard
+
+
+def _import_zstd():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError(
+            'zstandard is required for message compression. Install it with `pip install "pywaai[compression]"`'
+        ) from e
+    return zstandard
+
+
+class MessageCompressor:
+    """Compresses the JSON-encoded ``messages`` column of conversations.
+
+    Each compressed row is a zstd frame whose header records the ID of the dictionary it
+    was compressed with (``0`` when no dictionary was used), so rows written with older
+    dictionaries stay readable after a new one is trained. Rows that are still plain JSON
+    text are passed through untouched. Dictionaries that are not registered yet (e.g.
+    trained by another process) are fetched with ``dictionary_loader``, which
+    :class:`~pywaai.conversation_db.ConversationHistory` sets to read its database.
+
+    Example:
+
+        >>> compressor = MessageCompressor()
+        >>> history = ConversationHistory("conversations.db", compressor=compressor)
+        >>> await history.init_db()  # loads the stored dictionaries
+        >>> await history.train_compression_dictionary()
+        >>> await history.recompress()
+    """
+
+    def __init__(self, level: int = 3):
+        """Initialize the compressor.
+
+        Args:
+            level: The zstd compression level.
+        """
+        self.zstd = _import_zstd()
+        self.level = level
+        self.dictionaries: Dict[int, "zstandard.ZstdCompressionDict"] = {}
+        self.active_dictionary_id: Optional[int] = None
+        self._compressors: Dict[Optional[int], "zstandard.ZstdCompressor"] = {}
+        self._decompressors: Dict[int, "zstandard.ZstdDecompressor"] = {}
+        # dictionary ID -> its stored content, or None if there is no such dictionary
+        self.dictionary_loader: Optional[Callable[[int], Optional[bytes]]] = None
+
+    def add_dictionary(self, dictionary_id: int, data: bytes, activate: bool = True):
+        """Register a dictionary (and by default use it for new rows)."""
+        self.dictionaries[dictionary_id] = self.zstd.ZstdCompressionDict(data)
+        self._compressors.pop(dictionary_id, None)
+        self._decompressors.pop(dictionary_id, None)
+        if activate and (
+            self.active_dictionary_id is None
+            or dictionary_id >= self.active_dictionary_id
+        ):
+            self.active_dictionary_id = dictionary_id
+
+    def train(
+        self, samples: Iterable[bytes], dictionary_id: int, dict_size: int = 16 * 1024
+    ) -> bytes:
+        """Train a new dictionary on sample payloads and activate it.
+
+        Args:
+            samples: Raw (uncompressed) JSON payloads of existing rows.
+            dictionary_id: The version to embed in the dictionary (must be > 0).
+            dict_size: The maximum size of the dictionary in bytes.
+
+        Returns:
+            bytes: The dictionary content, to be persisted.
+        """
+        dictionary = self.zstd.train_dictionary(
+            dict_size, list(samples), dict_id=dictionary_id, level=self.level
+        )
+        data = dictionary.as_bytes()
+        self.add_dictionary(dictionary_id, data)
+        return data
+
+    def compress(self, raw: str) -> bytes:
+        """Compress a JSON payload with the active dictionary."""
+        dictionary_id = self.active_dictionary_id
+        compressor = self._compressors.get(dictionary_id)
+        if compressor is None:
+            compressor = self.zstd.ZstdCompressor(
+                level=self.level,
+                dict_data=self.dictionaries.get(dictionary_id),
+                write_dict_id=True,
+            )
+            self._compressors[dictionary_id] = compressor
+        return compressor.compress(raw.encode())
+
+    def decompress(self, data: Union[str, bytes]) -> str:
+        """Decompress a stored payload (plain JSON text is returned as is)."""
+        if isinstance(data, str):
+            return data
+        dictionary_id = self.dictionary_id_of(data)
+        decompressor = self._decompressors.get(dictionary_id)
+        if decompressor is None:
+            if dictionary_id and dictionary_id not in self.dictionaries:
+                dictionary = (
+                    self.dictionary_loader(dictionary_id)
+                    if self.dictionary_loader is not None
+                    else None
+                )
+                if dictionary is None:
+                    raise ValueError(
+                        f"Compression dictionary {dictionary_id} is not loaded"
+                    )
+                self.add_dictionary(dictionary_id, dictionary)
+            decompressor = self.zstd.ZstdDecompressor(
+                dict_data=self.dictionaries.get(dictionary_id)
+            )
+            self._decompressors[dictionary_id] = decompressor
+        return decompressor.decompress(data).decode()
+
+    def dictionary_id_of(self, data: Union[str, bytes]) -> Optional[int]:
+        """The dictionary ID a stored payload was compressed with (``None`` if plain text)."""
+        if isinstance(data, str):
+            return None
+        return self.zstd.get_frame_parameters(data).dict_id
@@ -0,0 +1,163 @@
+"""Reference implementation of the remote conversation API used by ``LocalOrRemoteConversation``.
+
+Requires ``fastapi`` (``pip install "pywaai[fastapi]"``). Run it with:
+
+    python -m pywaai.conversation_api --db conversations.db --port 8000
+
+Endpoints:
+
+- ``GET /conversations/{phone}/latest``: the latest conversation (404 if there is none).
+- ``POST /conversations/{phone}``: create a new conversation.
+- ``GET /conversations/{phone}/{cid}/messages?since=N``: the messages after the first ``N``.
+  Responds with ``X-Next-Cursor`` (the total number of messages), ``X-Compacted`` (how many
+  of them were replaced by a summary) and an ``ETag``, and with ``304 Not Modified`` when
+  ``If-None-Match`` matches. When ``N`` is 0 or falls within the compacted messages, the
+  whole conversation (summary first) is returned instead.
+- ``POST /conversations/{phone}/{cid}/messages``: append a message (object) or a batch of
+  messages (array) in a single write.
+- ``DELETE /conversations/{phone}/{cid}``: delete a conversation.
+"""
+
+import argparse
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union, TYPE_CHECKING
+
+from .conversation_db import ConversationManager
+
+if TYPE_CHECKING:
+    import fastapi
+
+
+def _sync_headers(updated_at: datetime, compacted: int) -> Dict[str, str]:
+    return {
+        "ETag": f'"{int(updated_at.timestamp() * 1_000_000)}-{compacted}"',
+        "X-Compacted": str(compacted),
+    }
+
+
+def create_app(
+    manager: ConversationManager,
+    authorize: Optional[Callable[[str], Union[bool, Awaitable[bool]]]] = None,
+) -> "fastapi.FastAPI":
+    """Create the conversation API application.
+
+    Args:
+        manager: The conversation manager that stores the conversations.
+        authorize: A (sync or async) callable that receives the bearer token of each request
+            and returns whether it is allowed. ``None`` accepts every request.
+    """
+    from fastapi import Body, Depends, FastAPI, HTTPException, Request, Response
+    from fastapi.responses import JSONResponse
+
+    @asynccontextmanager
+    async def lifespan(_: FastAPI):
+        await manager.init_db()
+        yield
+        await manager.history.pool.close_all()
+
+    async def check_authorization(request: Request):
+        if authorize is None:
+            return
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        allowed = authorize(token) if scheme.lower() == "bearer" and token else False
+        if asyncio.iscoroutine(allowed):
+            allowed = await allowed
+        if not allowed:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+
+    app = FastAPI(
+        title="pywaai conversations",
+        lifespan=lifespan,
+        dependencies=[Depends(check_authorization)],
+    )
+
+    @app.get("/conversations/{phone_number}/latest")
+    async def get_latest_conversation(phone_number: str):
+        latest = await manager._get_latest_activity(phone_number)
+        if latest is None:
+            raise HTTPException(status_code=404, detail="No conversations")
+        return {
+            "conversation_id": latest.conversation_id,
+            "updated_at": latest.updated_at.isoformat(),
+        }
+
+    @app.post("/conversations/{phone_number}")
+    async def create_conversation(phone_number: str):
+        conversation = await manager.create_conversation(phone_number)
+        return {
+            "conversation_id": conversation.conversation_id,
+            "created_at": conversation.created_at.isoformat(),
+        }
+
+    @app.get("/conversations/{phone_number}/{conversation_id}/messages")
+    async def get_messages(
+        request: Request, phone_number: str, conversation_id: str, since: int = 0
+    ):
+        state = await manager.get_sync_state(phone_number, conversation_id)
+        if state is None:
+            raise HTTPException(status_code=404, detail="Conversation not found")
+        headers = _sync_headers(*state)
+        if request.headers.get("If-None-Match") == headers["ETag"]:
+            return Response(status_code=304, headers=headers)
+        compacted, messages = await manager.get_messages_with_offset(
+            phone_number, conversation_id
+        )
+        # The summary (if any) comes first, then message number `compacted`
+        start = 1 if compacted else 0
+        total = compacted + len(messages) - start
+        if since > 0 and since >= compacted:
+            messages = messages[start + since - compacted :]
+        # Compaction does not touch updated_at, but may have happened since `state`
+        headers.update(_sync_headers(state[0], compacted))
+        headers["X-Next-Cursor"] = str(total)
+        return JSONResponse(messages, headers=headers)
+
+    @app.post("/conversations/{phone_number}/{conversation_id}/messages")
+    async def append_messages(
+        phone_number: str,
+        conversation_id: str,
+        body: Union[List[Dict[str, Any]], Dict[str, Any]] = Body(...),
+    ):
+        messages = body if isinstance(body, list) else [body]
+        try:
+            count, updated_at, compacted = await manager.add_messages_with_sync_state(
+                phone_number, messages, conversation_id
+            )
+        except ValueError:
+            raise HTTPException(status_code=404, detail="Conversation not found")
+        # The state of this write, so that the client's ETag never covers messages
+        # written since by someone else
+        headers = {"X-Next-Cursor": str(count), **_sync_headers(updated_at, compacted)}
+        return JSONResponse({"count": count}, headers=headers)
+
+    @app.delete("/conversations/{phone_number}/{conversation_id}")
+    async def delete_conversation(phone_number: str, conversation_id: str):
+        if not await manager.delete_conversation(phone_number, conversation_id):
+            raise HTTPException(status_code=404, detail="Conversation not found")
+        return {"deleted": True}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pywaai conversation API")
+    parser.add_argument("--db", default="conversations.db", help="SQLite database path")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--pool-size", type=int, default=5)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    uvicorn.run(
+        create_app(ConversationManager(db_path=args.db, pool_size=args.pool_size)),
+        host=args.host,
+        port=args.port,
+        log_level="warning",
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,19 @@ from cachetools import TTLCache
 from sqlcipher3 import dbapi2 as sqlcipher
 import asyncio
 import logging
-from typing import Dict, List, Optional, Any, AsyncIterator
-from datetime import datetime
+import weakref
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Union,
+    TYPE_CHECKING,
+)
+from datetime import datetime, timedelta
 import time
 import secrets
 from base64 import b64encode, b64decode
@@ -14,8 +25,13 @@ from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives import hashes
 import json
 from sqlalchemy.orm import Session, sessionmaker
-from sqlalchemy import desc, create_engine, QueuePool
-from .models import ConversationDB, Base
+from sqlalchemy import desc, create_engine, func, update, QueuePool
+from sqlalchemy.schema import CreateIndex
+from .models import ConversationDB, CompressionDictionaryDB, ConversationSummaryDB, Base
+
+if TYPE_CHECKING:
+    from .compression import MessageCompressor
+    from .summarization import RollingSummarizer
 
 
 def generate_ulid() -> str:
@@ -75,6 +91,12 @@ class ConnectionPool:
         async with self._lock:
             if not self._initialized:
                 Base.metadata.create_all(self.engine)
+                # create_all skips existing tables, so databases created by older
+                # versions also get the indexes added since
+                with self.engine.begin() as connection:
+                    for table in Base.metadata.sorted_tables:
+                        for index in table.indexes:
+                            connection.execute(CreateIndex(index, if_not_exists=True))
                 self._initialized = True
 
     async def get_connection(self) -> Session:
@@ -125,19 +147,205 @@ class ConnectionPool:
 class ConversationHistory:
     """Manages conversation history with SQLite backend."""
 
-    def __init__(self, db_path: str = "conversations.db", pool_size: int = 5):
-        """Initialize the conversation history manager."""
+    def __init__(
+        self,
+        db_path: str = "conversations.db",
+        pool_size: int = 5,
+        compressor: Optional["MessageCompressor"] = None,
+    ):
+        """Initialize the conversation history manager.
+
+        Args:
+            db_path: Path of the SQLite database.
+            pool_size: The number of pooled sessions.
+            compressor: Compress the stored messages with zstd (see :class:`MessageCompressor`).
+        """
         self.db_path = db_path
         self.pool = ConnectionPool(db_path, pool_size)
+        self.compressor = compressor
+        if compressor is not None:
+            compressor.dictionary_loader = self._fetch_compression_dictionary
 
     async def init_db(self):
         """Initialize the database."""
         await self.pool.init_db()
+        if self.compressor:
+            await self.load_compression_dictionaries()
+
+    def _dump_messages(self, messages: List[Dict[str, Any]]) -> Union[str, bytes]:
+        """Encode a list of messages for the ``messages`` column."""
+        raw = json.dumps(messages)
+        if self.compressor:
+            return self.compressor.compress(raw)
+        return raw
+
+    def _load_messages(self, stored: Union[str, bytes]) -> List[Dict[str, Any]]:
+        """Decode the ``messages`` column into a list of (stored) messages."""
+        if self.compressor:
+            stored = self.compressor.decompress(stored)
+        elif isinstance(stored, bytes):
+            raise ValueError("Found compressed messages but no compressor is set")
+        return json.loads(stored)
+
+    def _decode_messages(self, raw: Union[str, bytes]) -> List[Dict[str, Any]]:
+        """Decode a stored ``messages`` column into plain message dicts."""
+        return self._load_messages(raw)
+
+    def _encode_message(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """Encode a plain message for storage (the inverse of :meth:`_decode_messages`)."""
+        return message
+
+    @staticmethod
+    def _compacted_count(session: Session, conversation_id: str) -> int:
+        return (
+            session.query(ConversationSummaryDB.compacted_count)
+            .filter(ConversationSummaryDB.conversation_id == conversation_id)
+            .scalar()
+            or 0
+        )
+
+    def _fetch_compression_dictionary(self, dictionary_id: int) -> Optional[bytes]:
+        """Read a stored dictionary (e.g. trained by another process since the load).
+
+        Uses its own session, as the compressor calls it while rows are decoded.
+        """
+        with self.pool.Session() as session:
+            row = session.get(CompressionDictionaryDB, dictionary_id)
+            return row.data if row is not None else None
+
+    async def load_compression_dictionaries(self):
+        """Load the stored compression dictionaries into the compressor."""
+        session = await self.pool.get_connection()
+        try:
+            for row in session.query(CompressionDictionaryDB).order_by(
+                CompressionDictionaryDB.dictionary_id
+            ):
+                self.compressor.add_dictionary(row.dictionary_id, row.data)
+        finally:
+            await self.pool.release_connection(session)
+
+    async def train_compression_dictionary(
+        self, sample_limit: int = 5000, dict_size: int = 16 * 1024
+    ) -> int:
+        """Train a new compression dictionary on the most recent conversations.
+
+        The dictionary is stored in the ``compression_dictionaries`` table and used for
+        all rows written from now on. Existing rows keep their dictionary until
+        :meth:`recompress` is called.
+
+        Args:
+            sample_limit: The maximum number of conversations to sample.
+            dict_size: The maximum size of the dictionary in bytes.
+
+        Returns:
+            int: The ID (version) of the new dictionary.
+        """
+        if not self.compressor:
+            raise ValueError("A compressor is required to train a dictionary")
+        session = await self.pool.get_connection()
+        try:
+            samples = [
+                self.compressor.decompress(row.messages).encode()
+                for row in session.query(ConversationDB.messages)
+                .order_by(desc(ConversationDB.updated_at))
+                .limit(sample_limit)
+            ]
+            if not samples:
+                raise ValueError("No conversations to train a dictionary on")
+            dictionary_id = (
+                session.query(func.max(CompressionDictionaryDB.dictionary_id)).scalar()
+                or 0
+            ) + 1
+            data = self.compressor.train(samples, dictionary_id, dict_size)
+            session.add(CompressionDictionaryDB(dictionary_id=dictionary_id, data=data))
+            session.commit()
+            logger.info(
+                f"Trained compression dictionary {dictionary_id} on {len(samples)} conversations"
+            )
+            return dictionary_id
+        finally:
+            await self.pool.release_connection(session)
+
+    async def recompress(self, batch_size: int = 500) -> int:
+        """Rewrite the rows that are not compressed with the active dictionary.
+
+        Run ``VACUUM`` afterwards to return the freed pages to the file system.
+
+        Returns:
+            int: The number of rewritten conversations.
+        """
+        if not self.compressor:
+            raise ValueError("A compressor is required to recompress conversations")
+        active_id = self.compressor.active_dictionary_id or 0
+        rewritten = 0
+        last_id = ""
+        session = await self.pool.get_connection()
+        try:
+            while True:
+                rows = (
+                    session.query(ConversationDB.conversation_id, ConversationDB.messages)
+                    .filter(ConversationDB.conversation_id > last_id)
+                    .order_by(ConversationDB.conversation_id)
+                    .limit(batch_size)
+                    .all()
+                )
+                if not rows:
+                    break
+                for conversation_id, stored in rows:
+                    if self.compressor.dictionary_id_of(stored) == active_id:
+                        continue
+                    session.execute(
+                        update(ConversationDB)
+                        .where(ConversationDB.conversation_id == conversation_id)
+                        .values(
+                            messages=self.compressor.compress(
+                                self.compressor.decompress(stored)
+                            ),
+                            # Recompressing is not activity, keep the timestamp
+                            updated_at=ConversationDB.updated_at,
+                        )
+                    )
+                    rewritten += 1
+                session.commit()
+                last_id = rows[-1][0]
+            return rewritten
+        finally:
+            await self.pool.release_connection(session)
 
     async def append(
         self, phone_number: str, message: Dict[str, Any], conversation_id: str
     ) -> str:
         """Append a message to the conversation history."""
+        await self._write_messages(phone_number, [message], conversation_id)
+        return conversation_id
+
+    async def extend(
+        self, phone_number: str, messages: List[Dict[str, Any]], conversation_id: str
+    ) -> int:
+        """Append several messages to the conversation history in a single write.
+
+        Returns:
+            int: The number of messages in the conversation after the write (including
+            the messages replaced by a summary, see :meth:`compact`).
+        """
+        count, _, _ = await self.extend_with_sync_state(
+            phone_number, messages, conversation_id
+        )
+        return count
+
+    async def extend_with_sync_state(
+        self, phone_number: str, messages: List[Dict[str, Any]], conversation_id: str
+    ) -> tuple[int, datetime, int]:
+        """Like :meth:`extend`, but also return the sync state left by the write.
+
+        Returns:
+            ``(count, updated_at, compacted_count)``, all read in the write's transaction.
+        """
+        return await self._write_messages(phone_number, messages, conversation_id)
+
+    async def _write_messages(
+        self, phone_number: str, new_messages: List[Dict[str, Any]], conversation_id: str
+    ) -> tuple[int, datetime, int]:
         session = await self.pool.get_connection()
         try:
             conversation = (
@@ -151,12 +359,112 @@ class ConversationHistory:
             if not conversation:
                 raise ValueError(f"Conversation {conversation_id} not found")
 
-            messages = json.loads(conversation.messages)
-            messages.append(message)
-            conversation.messages = json.dumps(messages)
-            conversation.updated_at = datetime.utcnow()
+            messages = self._load_messages(conversation.messages)
+            messages.extend(new_messages)
+            conversation.messages = self._dump_messages(messages)
+            updated_at = conversation.updated_at = datetime.utcnow()
+            compacted = self._compacted_count(session, conversation_id)
             session.commit()
-            return conversation_id
+            # The summary replaces the compacted messages in the stored list
+            count = compacted + len(messages) - (1 if compacted else 0)
+            return count, updated_at, compacted
+        finally:
+            await self.pool.release_connection(session)
+
+    async def read_view(
+        self, phone_number: str, conversation_id: str
+    ) -> tuple[int, List[Dict[str, Any]]]:
+        """Read a conversation along with the number of messages replaced by its summary.
+
+        Returns:
+            The number of compacted messages, and the stored messages (starting with the
+            summary message when that number is not zero).
+        """
+        session = await self.pool.get_connection()
+        try:
+            row = (
+                session.query(ConversationDB.messages)
+                .filter(
+                    ConversationDB.phone_number == phone_number,
+                    ConversationDB.conversation_id == conversation_id,
+                )
+                .first()
+            )
+            if row is None:
+                raise ValueError(f"Conversation {conversation_id} not found")
+            return (
+                self._compacted_count(session, conversation_id),
+                self._decode_messages(row.messages),
+            )
+        finally:
+            await self.pool.release_connection(session)
+
+    async def compact(
+        self,
+        phone_number: str,
+        conversation_id: str,
+        upto: int,
+        summary_message: Dict[str, Any],
+        expected_compacted: int,
+    ) -> bool:
+        """Atomically replace the first ``upto`` stored messages with a summary message.
+
+        The swap is a compare-and-set: it only happens if the conversation has not been
+        compacted since it was read (``expected_compacted`` is still the compacted count)
+        and still holds at least ``upto`` messages. Messages appended in the meantime are
+        kept. ``updated_at`` is not changed, as compacting is not activity.
+
+        Args:
+            phone_number: The phone number of the conversation.
+            conversation_id: The conversation ID.
+            upto: How many stored messages (including a previous summary) to replace.
+            summary_message: The message that replaces them.
+            expected_compacted: The compacted count read along with the messages.
+
+        Returns:
+            bool: Whether the summary was swapped in.
+        """
+        session = await self.pool.get_connection()
+        try:
+            conversation = (
+                session.query(ConversationDB.messages)
+                .filter(
+                    ConversationDB.phone_number == phone_number,
+                    ConversationDB.conversation_id == conversation_id,
+                )
+                .first()
+            )
+            summary_row = session.get(ConversationSummaryDB, conversation_id)
+            compacted = summary_row.compacted_count if summary_row else 0
+            if conversation is None or compacted != expected_compacted:
+                return False
+            messages = self._load_messages(conversation.messages)
+            if len(messages) < upto:
+                return False
+
+            session.execute(
+                update(ConversationDB)
+                .where(ConversationDB.conversation_id == conversation_id)
+                .values(
+                    messages=self._dump_messages(
+                        [self._encode_message(summary_message)] + messages[upto:]
+                    ),
+                    # Compacting is not activity, keep the timestamp
+                    updated_at=ConversationDB.updated_at,
+                )
+            )
+            new_compacted = compacted + upto - (1 if compacted else 0)
+            if summary_row is None:
+                session.add(
+                    ConversationSummaryDB(
+                        conversation_id=conversation_id, compacted_count=new_compacted
+                    )
+                )
+            else:
+                summary_row.compacted_count = new_compacted
+                summary_row.summarized_at = datetime.utcnow()
+            session.commit()
+            return True
         finally:
             await self.pool.release_connection(session)
 
@@ -175,7 +483,7 @@ class ConversationHistory:
 
             all_messages = []
             for conversation in conversations:
-                messages = json.loads(conversation.messages)
+                messages = self._load_messages(conversation.messages)
                 all_messages.extend(messages)
             return all_messages
         finally:
@@ -202,7 +510,7 @@ class ConversationHistory:
             while True:
                 session.refresh(conversation)
                 if conversation.updated_at > last_check:
-                    messages = json.loads(conversation.messages)
+                    messages = self._load_messages(conversation.messages)
                     for message in messages:
                         if (
                             "timestamp" not in message
@@ -235,7 +543,7 @@ class ConversationHistory:
                 conversation = ConversationDB(
                     conversation_id=conversation_id,
                     phone_number=phone_number,
-                    messages=json.dumps([message]),
+                    messages=self._dump_messages([message]),
                     updated_at=datetime.utcnow(),
                 )
                 session.add(conversation)
@@ -257,9 +565,10 @@ class EncryptedConversationHistory(ConversationHistory):
         master_key: Optional[str] = None,
         salt_master_key: Optional[str] = None,
         pool_size: int = 5,
+        compressor: Optional["MessageCompressor"] = None,
     ):
         """Initialize the encrypted conversation history manager."""
-        super().__init__(db_path, pool_size)
+        super().__init__(db_path, pool_size, compressor)
         self.cipher = self._init_cipher(master_key, salt_master_key)
 
     def _init_cipher(
@@ -301,6 +610,15 @@ class EncryptedConversationHistory(ConversationHistory):
         decrypted = self.cipher.decrypt(nonce, encrypted, None)
         return json.loads(decrypted.decode())
 
+    def _decode_messages(self, raw: str) -> List[Dict[str, Any]]:
+        """Decode and decrypt a stored ``messages`` column."""
+        return [
+            self._decrypt_message(message) for message in super()._decode_messages(raw)
+        ]
+
+    def _encode_message(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        return self._encrypt_message(message)
+
     async def append(
         self, phone_number: str, message: Dict[str, Any], conversation_id: str
     ) -> str:
@@ -308,6 +626,16 @@ class EncryptedConversationHistory(ConversationHistory):
         encrypted_message = self._encrypt_message(message)
         return await super().append(phone_number, encrypted_message, conversation_id)
 
+    async def extend_with_sync_state(
+        self, phone_number: str, messages: List[Dict[str, Any]], conversation_id: str
+    ) -> tuple[int, datetime, int]:
+        """Append several encrypted messages in a single write."""
+        return await super().extend_with_sync_state(
+            phone_number,
+            [self._encrypt_message(message) for message in messages],
+            conversation_id,
+        )
+
     async def watch(
         self, phone_number: str, conversation_id: str
     ) -> AsyncIterator[Dict[str, Any]]:
@@ -349,11 +677,36 @@ class ConversationManager:
         db_path: str = "conversations.db",
         pool_size: int = 5,
         history: Optional[ConversationHistory] = None,
+        inactivity_timeout: Optional[timedelta] = None,
+        summarizer: Optional[
+            Callable[[List[Dict[str, Any]]], Union[Optional[str], Awaitable[Optional[str]]]]
+        ] = None,
+        rolling_summarizer: Optional["RollingSummarizer"] = None,
     ):
-        """Initialize the conversation manager."""
+        """Initialize the conversation manager.
+
+        Args:
+            db_path: Path of the SQLite database.
+            pool_size: The number of pooled sessions.
+            history: A custom (e.g. encrypted) history backend.
+            inactivity_timeout: Start a new conversation when the latest one has been idle for
+                longer than this (e.g. ``timedelta(hours=24)`` for WhatsApp's customer service
+                window). ``None`` keeps using the latest conversation forever.
+            summarizer: A (sync or async) callable that receives the messages of the expired
+                conversation and returns a summary to carry over into the new one.
+            rolling_summarizer: Compact the older messages of long conversations into a
+                summary in the background (see :class:`pywaai.summarization.RollingSummarizer`).
+        """
         self.history = history or ConversationHistory(
             db_path=db_path, pool_size=pool_size
         )
+        self.inactivity_timeout = inactivity_timeout
+        self.summarizer = summarizer
+        self.rolling_summarizer = rolling_summarizer
+        # One lock per phone number, so a slow summary doesn't hold up other users
+        self._rollover_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = (
+            weakref.WeakValueDictionary()
+        )
 
     async def init_db(self):
         """Initialize the database."""
@@ -368,7 +721,7 @@ class ConversationManager:
             conversation = ConversationDB(
                 conversation_id=conversation_id,
                 phone_number=phone_number,
-                messages=json.dumps([]),
+                messages=self.history._dump_messages([]),
                 created_at=now,
                 updated_at=now,
             )
@@ -402,7 +755,7 @@ class ConversationManager:
                 Conversation(
                     phone_number=conv.phone_number,
                     conversation_id=conv.conversation_id,
-                    messages=json.loads(conv.messages),
+                    messages=self.history._load_messages(conv.messages),
                     created_at=conv.created_at,
                     updated_at=conv.updated_at,
                 )
@@ -427,7 +780,7 @@ class ConversationManager:
                 return Conversation(
                     phone_number=latest.phone_number,
                     conversation_id=latest.conversation_id,
-                    messages=json.loads(latest.messages),
+                    messages=self.history._load_messages(latest.messages),
                     created_at=latest.created_at,
                     updated_at=latest.updated_at,
                 )
@@ -435,18 +788,197 @@ class ConversationManager:
         finally:
             await self.history.pool.release_connection(session)
 
+    async def _get_latest_activity(
+        self, phone_number: str
+    ) -> Optional[tuple[str, datetime]]:
+        """Get the ID and last activity of the latest conversation (without its messages)."""
+        session = await self.history.pool.get_connection()
+        try:
+            return (
+                session.query(ConversationDB.conversation_id, ConversationDB.updated_at)
+                .filter(ConversationDB.phone_number == phone_number)
+                .order_by(desc(ConversationDB.updated_at))
+                .first()
+            )
+        finally:
+            await self.history.pool.release_connection(session)
+
+    def _is_active(self, last_activity: datetime, now: datetime) -> bool:
+        return (
+            self.inactivity_timeout is None
+            or now - last_activity <= self.inactivity_timeout
+        )
+
+    async def get_active_conversation_id(
+        self, phone_number: str, now: Optional[datetime] = None
+    ) -> str:
+        """Get the ID of the active conversation, rolling over to a new one if needed.
+
+        The latest conversation is reused unless it has been inactive for longer than
+        ``inactivity_timeout``, in which case a new conversation is created (seeded with a
+        summary of the previous one when a ``summarizer`` is set).
+
+        Args:
+            phone_number: The phone number of the user.
+            now: The current UTC time (defaults to ``datetime.utcnow()``).
+
+        Returns:
+            str: The conversation ID.
+        """
+        now = now or datetime.utcnow()
+        latest = await self._get_latest_activity(phone_number)
+        if latest and self._is_active(latest.updated_at, now):
+            return latest.conversation_id
+
+        lock = self._rollover_locks.get(phone_number)
+        if lock is None:
+            lock = self._rollover_locks[phone_number] = asyncio.Lock()
+        async with lock:
+            # Another task may have rolled over while we were waiting
+            latest = await self._get_latest_activity(phone_number)
+            if latest and self._is_active(latest.updated_at, now):
+                return latest.conversation_id
+
+            summary = None
+            if latest and self.summarizer:
+                try:
+                    summary = self.summarizer(
+                        await self.get_messages(phone_number, latest.conversation_id)
+                    )
+                    if asyncio.iscoroutine(summary):
+                        summary = await summary
+                except Exception as e:
+                    logger.error(
+                        f"Error summarizing conversation {latest.conversation_id}, "
+                        f"rolling over without a summary: {e}"
+                    )
+                    summary = None
+
+            conversation = await self.create_conversation(phone_number)
+            if summary:
+                await self.add_message(
+                    phone_number,
+                    {
+                        "role": "system",
+                        "content": f"Summary of the previous conversation: {summary}",
+                    },
+                    conversation.conversation_id,
+                )
+            if latest:
+                logger.info(
+                    f"Conversation {latest.conversation_id} of {phone_number} expired, "
+                    f"started {conversation.conversation_id}"
+                )
+            return conversation.conversation_id
+
     async def add_message(
         self, phone_number: str, message: Dict[str, Any], conversation_id: str
     ) -> str:
         """Add a message to a conversation."""
-        return await self.history.append(phone_number, message, conversation_id)
+        result = await self.history.append(phone_number, message, conversation_id)
+        if self.rolling_summarizer:
+            self.rolling_summarizer.schedule(self, phone_number, conversation_id)
+        return result
+
+    async def add_messages(
+        self, phone_number: str, messages: List[Dict[str, Any]], conversation_id: str
+    ) -> int:
+        """Add several messages to a conversation in a single write.
+
+        Returns:
+            int: The number of messages in the conversation after the write.
+        """
+        count, _, _ = await self.add_messages_with_sync_state(
+            phone_number, messages, conversation_id
+        )
+        return count
+
+    async def add_messages_with_sync_state(
+        self, phone_number: str, messages: List[Dict[str, Any]], conversation_id: str
+    ) -> tuple[int, datetime, int]:
+        """Like :meth:`add_messages`, but also return the sync state left by the write.
+
+        Unlike a later :meth:`get_sync_state`, the state can't include another writer's
+        messages.
+
+        Returns:
+            ``(count, updated_at, compacted_count)``, as of the write.
+        """
+        state = await self.history.extend_with_sync_state(
+            phone_number, messages, conversation_id
+        )
+        if self.rolling_summarizer:
+            self.rolling_summarizer.schedule(
+                self, phone_number, conversation_id, added=len(messages)
+            )
+        return state
+
+    async def get_updated_at(
+        self, phone_number: str, conversation_id: str
+    ) -> Optional[datetime]:
+        """Get the last activity of a conversation without loading its messages."""
+        session = await self.history.pool.get_connection()
+        try:
+            row = (
+                session.query(ConversationDB.updated_at)
+                .filter(
+                    ConversationDB.phone_number == phone_number,
+                    ConversationDB.conversation_id == conversation_id,
+                )
+                .first()
+            )
+            return row.updated_at if row else None
+        finally:
+            await self.history.pool.release_connection(session)
+
+    async def get_sync_state(
+        self, phone_number: str, conversation_id: str
+    ) -> Optional[tuple[datetime, int]]:
+        """Get the last activity and the compacted message count of a conversation.
+
+        Returns:
+            ``(updated_at, compacted_count)``, or ``None`` if the conversation does not exist.
+        """
+        session = await self.history.pool.get_connection()
+        try:
+            row = (
+                session.query(
+                    ConversationDB.updated_at, ConversationSummaryDB.compacted_count
+                )
+                .outerjoin(
+                    ConversationSummaryDB,
+                    ConversationSummaryDB.conversation_id
+                    == ConversationDB.conversation_id,
+                )
+                .filter(
+                    ConversationDB.phone_number == phone_number,
+                    ConversationDB.conversation_id == conversation_id,
+                )
+                .first()
+            )
+            return (row.updated_at, row.compacted_count or 0) if row else None
+        finally:
+            await self.history.pool.release_connection(session)
 
     async def get_messages(
         self, phone_number: str, conversation_id: str
     ) -> List[Dict[str, Any]]:
-        """Get all messages in a conversation."""
+        """Get all messages in a conversation.
+
+        Once a conversation has been compacted, the first message is the summary of the
+        older messages, followed by the recent ones.
+        """
         return await self.history.read(phone_number, conversation_id)
 
+    async def get_messages_with_offset(
+        self, phone_number: str, conversation_id: str
+    ) -> tuple[int, List[Dict[str, Any]]]:
+        """Get the messages of a conversation and how many older messages were compacted.
+
+        See :meth:`ConversationHistory.read_view`.
+        """
+        return await self.history.read_view(phone_number, conversation_id)
+
     async def watch_conversation(
         self, phone_number: str, conversation_id: str
     ) -> AsyncIterator[Dict[str, Any]]:
@@ -487,6 +1019,10 @@ class ConversationManager:
                 ConversationDB.phone_number == phone_number,
                 ConversationDB.conversation_id == conversation_id
             ).delete()
+            if result:
+                session.query(ConversationSummaryDB).filter(
+                    ConversationSummaryDB.conversation_id == conversation_id
+                ).delete()
             session.commit()
             # Return True if at least one row was deleted
             return result > 0
@@ -0,0 +1,336 @@
+"""Columnar (Arrow/Parquet) export of the conversation store for analytics.
+
+Requires ``pyarrow`` (``pip install "pywaai[export]"``).
+"""
+
+import asyncio
+import json
+import os
+from dataclasses import dataclass, field
+from datetime import datetime, date, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, TYPE_CHECKING
+
+from sqlalchemy import and_, or_
+
+from .conversation_db import ConversationManager, generate_ulid, logger
+from .models import ConversationDB, ConversationSummaryDB
+
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError(
+            'pyarrow is required for exporting conversations. Install it with `pip install "pywaai[export]"`'
+        ) from e
+    return pyarrow
+
+
+def message_schema() -> "pa.Schema":
+    """The Arrow schema of the flattened (one row per message) export."""
+    pa = _import_pyarrow()
+    return pa.schema(
+        [
+            pa.field("conversation_id", pa.string(), nullable=False),
+            pa.field("phone_number", pa.string(), nullable=False),
+            pa.field("message_index", pa.int32(), nullable=False),
+            pa.field("role", pa.string()),
+            pa.field("content_length", pa.int64()),
+            pa.field("tool_call_count", pa.int32()),
+            pa.field("tool_names", pa.list_(pa.string())),
+            pa.field("tool_call_id", pa.string()),
+            pa.field("message_timestamp", pa.timestamp("us")),
+            pa.field("conversation_created_at", pa.timestamp("us")),
+            pa.field("conversation_updated_at", pa.timestamp("us")),
+            pa.field("day", pa.date32(), nullable=False),
+        ]
+    )
+
+
+@dataclass
+class ExportState:
+    """High-water mark of an incremental export.
+
+    Attributes:
+        high_water_mark: The greatest ``updated_at`` of the conversations exported so far.
+        offsets: The number of messages already exported, per conversation ID.
+        updated_at: The ``updated_at`` of each conversation when it was last exported,
+            used by :meth:`prune`.
+    """
+
+    high_water_mark: Optional[datetime] = None
+    offsets: Dict[str, int] = field(default_factory=dict)
+    updated_at: Dict[str, datetime] = field(default_factory=dict)
+
+    def prune(self, before: datetime) -> int:
+        """Forget the conversations last updated before ``before``.
+
+        Only prune conversations that won't get new messages, e.g. those idle for longer
+        than the manager's ``inactivity_timeout``: a pruned conversation that is updated
+        again is exported from its first message.
+
+        Returns:
+            int: The number of forgotten conversations.
+        """
+        stale = [cid for cid, updated in self.updated_at.items() if updated < before]
+        for cid in stale:
+            del self.updated_at[cid]
+            self.offsets.pop(cid, None)
+        return len(stale)
+
+    @classmethod
+    def load(cls, path: str) -> "ExportState":
+        """Load the state from a JSON file (an empty state if it does not exist)."""
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            data = json.load(f)
+        hwm = data.get("high_water_mark")
+        return cls(
+            high_water_mark=datetime.fromisoformat(hwm) if hwm else None,
+            offsets=data.get("offsets", {}),
+            updated_at={
+                cid: datetime.fromisoformat(value)
+                for cid, value in data.get("updated_at", {}).items()
+            },
+        )
+
+    def save(self, path: str) -> None:
+        """Atomically write the state to a JSON file."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "high_water_mark": self.high_water_mark.isoformat()
+                    if self.high_water_mark
+                    else None,
+                    "offsets": self.offsets,
+                    "updated_at": {
+                        cid: value.isoformat() for cid, value in self.updated_at.items()
+                    },
+                },
+                f,
+            )
+        os.replace(tmp_path, path)
+
+
+def _parse_timestamp(value: Any) -> Optional[datetime]:
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    return None
+
+
+def flatten_message(
+    conversation: ConversationDB, index: int, message: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Flatten a single stored message into an export row."""
+    content = message.get("content")
+    if isinstance(content, str):
+        content_length = len(content)
+    elif content is None:
+        content_length = 0
+    else:
+        content_length = len(json.dumps(content))
+    tool_calls = message.get("tool_calls") or []
+    timestamp = _parse_timestamp(message.get("timestamp"))
+    # Messages are not timestamped when stored, unless the caller adds a "timestamp".
+    # The start of the conversation doesn't change, unlike its updated_at, so the rows
+    # stay in the same partition across exports.
+    day: date = (timestamp or conversation.created_at).date()
+    return {
+        "conversation_id": conversation.conversation_id,
+        "phone_number": conversation.phone_number,
+        "message_index": index,
+        "role": message.get("role"),
+        "content_length": content_length,
+        "tool_call_count": len(tool_calls),
+        "tool_names": [
+            (call.get("function") or {}).get("name") for call in tool_calls
+        ],
+        "tool_call_id": message.get("tool_call_id"),
+        "message_timestamp": timestamp,
+        "conversation_created_at": conversation.created_at,
+        "conversation_updated_at": conversation.updated_at,
+        "day": day,
+    }
+
+
+async def iter_message_rows(
+    manager: ConversationManager,
+    state: Optional[ExportState] = None,
+    chunk_size: int = 500,
+) -> AsyncIterator[Dict[str, Any]]:
+    """Stream flattened message rows that were added since the given state.
+
+    Only conversations updated at or after ``state.high_water_mark`` are read, and only
+    the messages past the recorded offset of each conversation are yielded. The state is
+    advanced in place as rows are produced. Messages that were summarized away (see
+    :class:`pywaai.summarization.RollingSummarizer`) before being exported are skipped.
+
+    Args:
+        manager: The conversation manager to export from.
+        state: The export state to resume from (a full export if omitted).
+        chunk_size: How many conversations to fetch from the database at a time.
+    """
+    state = state if state is not None else ExportState()
+    history = manager.history
+    since = state.high_water_mark
+    await history.pool.init_db()
+
+    def fetch(
+        after: Optional[Tuple[datetime, str]],
+    ) -> List[Tuple[ConversationDB, Optional[int]]]:
+        # A session of its own: pooled sessions are used by the event loop meanwhile
+        with history.pool.Session() as session:
+            query = session.query(
+                ConversationDB, ConversationSummaryDB.compacted_count
+            ).outerjoin(
+                ConversationSummaryDB,
+                ConversationSummaryDB.conversation_id == ConversationDB.conversation_id,
+            )
+            if since is not None:
+                query = query.filter(ConversationDB.updated_at >= since)
+            if after is not None:
+                # Keyset pagination: resume after the last conversation of the chunk
+                query = query.filter(
+                    or_(
+                        ConversationDB.updated_at > after[0],
+                        and_(
+                            ConversationDB.updated_at == after[0],
+                            ConversationDB.conversation_id > after[1],
+                        ),
+                    )
+                )
+            # The loaded rows stay usable once the session is closed
+            return (
+                query.order_by(ConversationDB.updated_at, ConversationDB.conversation_id)
+                .limit(chunk_size)
+                .all()
+            )
+
+    after: Optional[Tuple[datetime, str]] = None
+    while True:
+        # Reading a chunk can take a while: don't block the event loop
+        rows = await asyncio.to_thread(fetch, after)
+
+        for conversation, compacted in rows:
+            messages = history._decode_messages(conversation.messages)
+            # A compacted conversation starts with the summary of its first `compacted`
+            # messages, which is not exported itself.
+            compacted = compacted or 0
+            start = 1 if compacted else 0
+            total = compacted + len(messages) - start
+            offset = state.offsets.get(conversation.conversation_id, 0)
+            for index in range(max(offset, compacted), total):
+                yield flatten_message(
+                    conversation, index, messages[start + index - compacted]
+                )
+            state.offsets[conversation.conversation_id] = max(offset, total)
+            state.updated_at[conversation.conversation_id] = conversation.updated_at
+            if (
+                state.high_water_mark is None
+                or conversation.updated_at > state.high_water_mark
+            ):
+                state.high_water_mark = conversation.updated_at
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1][0]
+        after = (last.updated_at, last.conversation_id)
+
+
+async def iter_record_batches(
+    manager: ConversationManager,
+    state: Optional[ExportState] = None,
+    batch_size: int = 8192,
+) -> AsyncIterator["pa.RecordBatch"]:
+    """Stream the conversation store as Arrow record batches of flattened messages.
+
+    Args:
+        manager: The conversation manager to export from.
+        state: The export state to resume from (advanced in place).
+        batch_size: The maximum number of rows per record batch.
+    """
+    pa = _import_pyarrow()
+    schema = message_schema()
+    rows: List[Dict[str, Any]] = []
+    async for row in iter_message_rows(manager, state):
+        rows.append(row)
+        if len(rows) >= batch_size:
+            yield pa.RecordBatch.from_pylist(rows, schema=schema)
+            rows = []
+    if rows:
+        yield pa.RecordBatch.from_pylist(rows, schema=schema)
+
+
+async def export_parquet(
+    manager: ConversationManager,
+    output_dir: str,
+    state_path: Optional[str] = None,
+    batch_size: int = 8192,
+    retention: Optional[timedelta] = None,
+) -> int:
+    """Export new messages to Parquet files partitioned by day.
+
+    Files are written as ``{output_dir}/day=YYYY-MM-DD/part-{ulid}.parquet``, where the
+    day is the message's ``timestamp`` if it has one, else the day its conversation
+    started. When ``state_path`` is given the export is incremental: the high-water mark
+    is loaded from it before exporting and saved back only after all files were written
+    successfully.
+
+    Args:
+        manager: The conversation manager to export from.
+        output_dir: The root directory of the partitioned dataset.
+        state_path: Path of the JSON file holding the :class:`ExportState`.
+        batch_size: The maximum number of rows per record batch.
+        retention: How long before the high-water mark conversations are remembered
+            in the state (see :meth:`ExportState.prune`). Defaults to the manager's
+            ``inactivity_timeout``; ``None`` then keeps every conversation.
+
+    Returns:
+        int: The number of exported messages.
+    """
+    pa = _import_pyarrow()
+    state = ExportState.load(state_path) if state_path else ExportState()
+    schema = message_schema()
+    # The day is encoded in the (hive-style) partition path, not in the files.
+    file_schema = schema.remove(schema.get_field_index("day"))
+    part_name = f"part-{generate_ulid()}.parquet"
+    writers: Dict[date, "pa.parquet.ParquetWriter"] = {}
+    exported = 0
+    try:
+        async for batch in iter_record_batches(manager, state, batch_size):
+            table = pa.Table.from_batches([batch], schema=schema)
+            days = table.column("day")
+            for day in pa.compute.unique(days).to_pylist():
+                if day not in writers:
+                    partition = os.path.join(output_dir, f"day={day.isoformat()}")
+                    os.makedirs(partition, exist_ok=True)
+                    writers[day] = pa.parquet.ParquetWriter(
+                        os.path.join(partition, part_name), file_schema
+                    )
+                writers[day].write_table(
+                    table.filter(
+                        pa.compute.equal(days, pa.scalar(day, pa.date32()))
+                    ).drop_columns(["day"])
+                )
+            exported += batch.num_rows
+    finally:
+        for writer in writers.values():
+            writer.close()
+    if state_path:
+        retention = retention or manager.inactivity_timeout
+        if retention is not None and state.high_water_mark is not None:
+            state.prune(state.high_water_mark - retention)
+        state.save(state_path)
+    logger.info(f"Exported {exported} messages to {output_dir}")
+    return exported
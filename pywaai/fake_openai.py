@@ -0,0 +1,304 @@
+"""An offline stand-in for the OpenAI chat completions API, for benchmarks and tests.
+
+:class:`FakeOpenAI` answers ``client.chat.completions.create(...)`` like ``AsyncOpenAI``
+does (completions, tool calls and streams with usage), after a simulated latency, so it
+can be passed as ``openai_client`` to :func:`~pywaai.ai_utils.generate_response`. It also
+answers ``client.moderations.create(...)``, see :class:`pywaai.moderation.Moderator`.
+
+Example:
+
+    >>> client = FakeOpenAI(latency=lognormal_latency(0.8), tool_call_rate=0.2)
+    >>> await generate_response(..., openai_client=client)
+"""
+
+import asyncio
+import itertools
+import json
+import math
+import random
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from openai.types import ModerationCreateResponse
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from openai.types.moderation import Categories, CategoryAppliedInputTypes, CategoryScores
+
+from .prompt import CHARS_PER_TOKEN, _message_text
+
+LatencyFunction = Callable[[], float]
+"""Returns a simulated latency in seconds."""
+
+
+def constant_latency(seconds: float) -> LatencyFunction:
+    """Always wait ``seconds``."""
+    return lambda: seconds
+
+
+def uniform_latency(
+    low: float, high: float, seed: Optional[int] = None
+) -> LatencyFunction:
+    """Wait a uniformly distributed time between ``low`` and ``high`` seconds."""
+    rng = random.Random(seed)
+    return lambda: rng.uniform(low, high)
+
+
+def lognormal_latency(
+    median: float, sigma: float = 0.5, seed: Optional[int] = None
+) -> LatencyFunction:
+    """Wait a log-normally distributed time (the long-tailed shape of real LLM latencies)."""
+    rng = random.Random(seed)
+    mu = math.log(median)
+    return lambda: rng.lognormvariate(mu, sigma)
+
+
+@dataclass
+class FakeReply:
+    """The reply of the fake model.
+
+    Attributes:
+        content: The text of the reply.
+        tool_calls: The tools to call, as ``(name, arguments)`` pairs.
+    """
+
+    content: Optional[str] = None
+    tool_calls: List[Tuple[str, Dict[str, Any]]] = field(default_factory=list)
+
+
+Responder = Callable[[Dict[str, Any]], FakeReply]
+"""Receives the keyword arguments of the ``create`` call and returns the reply."""
+
+
+def _placeholder_arguments(parameters: Dict[str, Any]) -> Dict[str, Any]:
+    """Arguments of the right type for the properties of a JSON schema."""
+    placeholders = {"string": "test", "integer": 1, "number": 1.0, "boolean": True}
+    return {
+        name: placeholders.get(schema.get("type"), None)
+        for name, schema in parameters.get("properties", {}).items()
+    }
+
+
+def echo_responder(request: Dict[str, Any]) -> FakeReply:
+    """Answer with the last user message."""
+    last = next(
+        (m for m in reversed(request["messages"]) if m.get("role") == "user"), {}
+    )
+    return FakeReply(f"You said: {_message_text(last)}")
+
+
+class _Completions:
+    def __init__(self, client: "FakeOpenAI"):
+        self.create = client.create
+
+
+class _Chat:
+    def __init__(self, client: "FakeOpenAI"):
+        self.completions = _Completions(client)
+
+
+class _Moderations:
+    def __init__(self, client: "FakeOpenAI"):
+        self.create = client.moderate
+
+
+def _moderation_result(flagged: bool) -> Dict[str, Any]:
+    def fields(model, value) -> Dict[str, Any]:
+        return {f.alias or name: value for name, f in model.model_fields.items()}
+
+    categories = fields(Categories, False)
+    scores = fields(CategoryScores, 0.0)
+    if flagged:
+        categories["harassment"] = True
+        scores["harassment"] = 0.99
+    return {
+        "flagged": flagged,
+        "categories": categories,
+        "category_scores": scores,
+        "category_applied_input_types": fields(CategoryAppliedInputTypes, []),
+    }
+
+
+class FakeOpenAI:
+    """A fake ``AsyncOpenAI`` client for the chat completions API.
+
+    Replies come from ``responder``. When tools are offered and the last message is not a
+    tool result, the model calls one of them (with placeholder arguments) with probability
+    ``tool_call_rate`` instead.
+
+    Each call waits ``latency()`` seconds before the first token; streams then wait
+    ``1 / tokens_per_second`` seconds between chunks of about one word.
+
+    Moderation calls wait ``moderation_latency()`` seconds, and flag (as harassment) the
+    texts that contain one of ``flagged_words``.
+    """
+
+    def __init__(
+        self,
+        responder: Responder = echo_responder,
+        latency: LatencyFunction = constant_latency(0.0),
+        tokens_per_second: Optional[float] = None,
+        tool_call_rate: float = 0.0,
+        seed: Optional[int] = None,
+        moderation_latency: LatencyFunction = constant_latency(0.0),
+        flagged_words: Sequence[str] = (),
+    ):
+        """
+        Args:
+            responder: Builds the reply from the request.
+            latency: The time to first token (see :func:`lognormal_latency`).
+            tokens_per_second: The streaming speed (``None`` streams without delays).
+            tool_call_rate: The probability of calling a tool when tools are offered.
+            seed: The seed of the tool call decisions.
+            moderation_latency: The latency of moderation calls.
+            flagged_words: Texts containing one of these (in lowercase) are flagged.
+        """
+        self.responder = responder
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.tool_call_rate = tool_call_rate
+        self.moderation_latency = moderation_latency
+        self.flagged_words = [word.lower() for word in flagged_words]
+        self.chat = _Chat(self)
+        self.moderations = _Moderations(self)
+        self.calls = 0
+        self.moderation_calls = 0
+        self._rng = random.Random(seed)
+        self._ids = itertools.count()
+
+    def _reply(self, request: Dict[str, Any]) -> FakeReply:
+        tools = request.get("tools")
+        messages = request["messages"]
+        if (
+            tools
+            and messages
+            and messages[-1].get("role") != "tool"
+            and self._rng.random() < self.tool_call_rate
+        ):
+            function = self._rng.choice(tools)["function"]
+            arguments = _placeholder_arguments(function.get("parameters", {}))
+            return FakeReply(tool_calls=[(function["name"], arguments)])
+        return self.responder(request)
+
+    @staticmethod
+    def _usage(request: Dict[str, Any], reply: FakeReply) -> Dict[str, int]:
+        prompt = sum(len(_message_text(m)) for m in request["messages"])
+        completion = len(reply.content or "") + sum(
+            len(json.dumps(arguments)) for _, arguments in reply.tool_calls
+        )
+        prompt_tokens = prompt // CHARS_PER_TOKEN
+        completion_tokens = completion // CHARS_PER_TOKEN
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    async def create(self, **kwargs):
+        """Create a chat completion (or a stream of chunks with ``stream=True``)."""
+        self.calls += 1
+        reply = self._reply(kwargs)
+        await asyncio.sleep(self.latency())
+        completion_id = f"chatcmpl-fake-{next(self._ids)}"
+        if kwargs.get("stream"):
+            return self._stream(completion_id, kwargs, reply)
+        return ChatCompletion.model_validate(
+            {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": 0,
+                "model": kwargs["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "tool_calls" if reply.tool_calls else "stop",
+                        "message": {
+                            "role": "assistant",
+                            "content": reply.content,
+                            "tool_calls": [
+                                {
+                                    "id": f"call_{i}",
+                                    "type": "function",
+                                    "function": {
+                                        "name": name,
+                                        "arguments": json.dumps(arguments),
+                                    },
+                                }
+                                for i, (name, arguments) in enumerate(reply.tool_calls)
+                            ]
+                            or None,
+                        },
+                    }
+                ],
+                "usage": self._usage(kwargs, reply),
+            }
+        )
+
+    async def moderate(
+        self, input: Union[str, List[str]], model: str = "omni-moderation-latest", **kwargs
+    ) -> ModerationCreateResponse:
+        """Moderate a text or a list of texts."""
+        self.moderation_calls += 1
+        await asyncio.sleep(self.moderation_latency())
+        texts = [input] if isinstance(input, str) else input
+        return ModerationCreateResponse.model_validate(
+            {
+                "id": f"modr-fake-{next(self._ids)}",
+                "model": model,
+                "results": [
+                    _moderation_result(
+                        any(word in text.lower() for word in self.flagged_words)
+                    )
+                    for text in texts
+                ],
+            }
+        )
+
+    async def _stream(
+        self, completion_id: str, request: Dict[str, Any], reply: FakeReply
+    ) -> AsyncIterator[ChatCompletionChunk]:
+        def chunk(delta=None, finish_reason=None, usage=None) -> ChatCompletionChunk:
+            return ChatCompletionChunk.model_validate(
+                {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": 0,
+                    "model": request["model"],
+                    "choices": []
+                    if delta is None
+                    else [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                    "usage": usage,
+                }
+            )
+
+        delay = 1 / self.tokens_per_second if self.tokens_per_second else 0.0
+        words = (reply.content or "").split(" ") if reply.content else []
+        for i, word in enumerate(words):
+            if i and delay:
+                await asyncio.sleep(delay)
+            text = word if i == len(words) - 1 else word + " "
+            yield chunk({"role": "assistant", "content": text})
+        for i, (name, arguments) in enumerate(reply.tool_calls):
+            yield chunk(
+                {
+                    "tool_calls": [
+                        {
+                            "index": i,
+                            "id": f"call_{i}",
+                            "type": "function",
+                            "function": {"name": name, "arguments": json.dumps(arguments)},
+                        }
+                    ]
+                }
+            )
+        yield chunk({}, "tool_calls" if reply.tool_calls else "stop")
+        if (request.get("stream_options") or {}).get("include_usage"):
+            yield chunk(usage=self._usage(request, reply))
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    import httpx
+
+
+def create_http_client(
+    timeout: float = 10.0,
+    connect_timeout: float = 5.0,
+    max_connections: int = 100,
+    max_keepalive_connections: int = 20,
+    keepalive_expiry: float = 30.0,
+    retries: int = 2,
+    http2: bool = False,
+    **kwargs,
+) -> httpx.AsyncClient:
+    """Create a keep-alive ``httpx.AsyncClient`` for the remote conversation API.
+
+    Args:
+        timeout: The read/write/pool timeout in seconds.
+        connect_timeout: The connect timeout in seconds.
+        max_connections: The maximum number of open connections.
+        max_keepalive_connections: The maximum number of idle connections kept alive.
+        keepalive_expiry: How long (in seconds) idle connections are kept alive.
+        retries: How many times to retry failed connection attempts (requests that reached
+            the server are never retried).
+        http2: Use HTTP/2 when the server supports it (requires ``pip install "httpx[http2]"``).
+        **kwargs: Passed to ``httpx.AsyncClient``.
+    """
+    import httpx
+
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(timeout, connect=connect_timeout),
+        limits=limits,
+        transport=httpx.AsyncHTTPTransport(retries=retries, http2=http2, limits=limits),
+        **kwargs,
+    )
+
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Get the shared HTTP client (created with the default options on first use)."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = create_http_client()
+    return _http_client
+
+
+def set_http_client(client: httpx.AsyncClient) -> None:
+    """Replace the shared HTTP client (e.g. with one from :func:`create_http_client`)."""
+    global _http_client
+    _http_client = client
+
+
+async def close_http_client() -> None:
+    """Close the shared HTTP client (e.g. on application shutdown)."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
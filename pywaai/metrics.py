@@ -0,0 +1,351 @@
+"""In-process metrics of generated replies: stage latencies, token usage and cache hits.
+
+Every :func:`~pywaai.ai_utils.generate_response` turn is recorded in a
+:class:`MetricsRegistry` (the shared one unless another is passed), which keeps
+aggregated counters and histograms per model and stage, plus running totals per
+conversation. Export it with :meth:`MetricsRegistry.to_prometheus` (e.g. from a
+``/metrics`` endpoint) or :meth:`MetricsRegistry.to_dict`.
+
+Conversations are not Prometheus labels (they would explode the number of series); their
+totals are only part of the JSON export and of :meth:`MetricsRegistry.conversation`.
+"""
+
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from cachetools import LRUCache
+
+# Stages of a turn
+DB_READ = "db_read"
+LLM = "llm"
+TOOLS = "tools"
+SHORTENER = "shortener"
+DB_WRITE = "db_write"
+SEND = "send"
+# Outside of turns (see MetricsRegistry.observe_stage)
+MODERATION = "moderation"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class _Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """The ``(le, count)`` pairs of the Prometheus buckets, ``+Inf`` included."""
+        total, pairs = 0, []
+        for bound, count in zip((*self.buckets, "+Inf"), self.counts):
+            total += count
+            pairs.append((bound if bound == "+Inf" else repr(float(bound)), total))
+        return pairs
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"count": self.count, "sum": self.sum, "buckets": dict(self.cumulative())}
+
+
+@dataclass
+class ConversationStats:
+    """Running totals of a conversation."""
+
+    turns: int = 0
+    llm_calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cache_hits: int = 0
+    seconds: float = 0.0
+    last_turn_at: float = 0.0
+
+
+class TurnMetrics:
+    """The metrics of one turn, recorded in the registry by :meth:`finish`."""
+
+    def __init__(
+        self,
+        registry: "MetricsRegistry",
+        phone_number: str,
+        model: str,
+        conversation_id: Optional[str] = None,
+    ):
+        self.registry = registry
+        self.phone_number = phone_number
+        self.conversation_id = conversation_id
+        self.model = model
+        self.stages: Dict[str, float] = {}
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cache_hit: Optional[bool] = None
+        self._started = time.perf_counter()
+        self._active: List[list] = []
+        self._finished = False
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time a stage of the turn.
+
+        Stages can be nested, and only count their own time: the time of a nested stage
+        (e.g. sending messages while a stream is read) is not counted in the outer one.
+        """
+        now = time.perf_counter()
+        if self._active:
+            outer = self._active[-1]
+            self._add(outer[0], now - outer[1])
+        self._active.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            _, started = self._active.pop()
+            self._add(name, now - started)
+            if self._active:
+                self._active[-1][1] = now
+
+    def _add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def record_usage(
+        self, usage: Any, model: Optional[str] = None, stage: str = LLM
+    ) -> None:
+        """Record the token usage of an LLM call (the ``usage`` of the OpenAI response)."""
+        self.llm_calls += 1
+        prompt, completion = _usage_tokens(usage)
+        self.prompt_tokens += prompt
+        self.completion_tokens += completion
+        self.registry.record_usage(model or self.model, stage, usage)
+
+    def record_cache(self, hit: bool) -> None:
+        """Record a response cache lookup."""
+        self.cache_hit = hit
+        self.registry.record_cache(hit)
+
+    def finish(self) -> None:
+        """Record the turn in the registry (only the first call counts)."""
+        if self._finished:
+            return
+        self._finished = True
+        self.registry._record_turn(self, time.perf_counter() - self._started)
+
+
+def _usage_tokens(usage: Any) -> Tuple[int, int]:
+    if usage is None:
+        return 0, 0
+    return (
+        getattr(usage, "prompt_tokens", 0) or 0,
+        getattr(usage, "completion_tokens", 0) or 0,
+    )
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels: Any) -> str:
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+class MetricsRegistry:
+    """Aggregates the metrics of all turns of the process.
+
+    Example:
+
+        >>> registry = get_metrics_registry()
+        >>> registry.to_prometheus()
+        '# HELP pywaai_turns_total ...'
+    """
+
+    def __init__(
+        self,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        max_conversations: int = 10_000,
+    ):
+        """
+        Args:
+            buckets: The upper bounds (in seconds) of the latency histograms.
+            max_conversations: How many conversations to keep totals of (least recently
+                active are dropped).
+        """
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._turns: Dict[str, int] = {}
+        self._turn_seconds: Dict[str, _Histogram] = {}
+        self._stage_seconds: Dict[Tuple[str, str], _Histogram] = {}
+        # (model, stage) -> [calls, prompt tokens, completion tokens]
+        self._llm: Dict[Tuple[str, str], List[int]] = {}
+        self._cache = {"hit": 0, "miss": 0}
+        self._conversations: "LRUCache[Tuple[str, Optional[str]], ConversationStats]" = (
+            LRUCache(maxsize=max_conversations)
+        )
+
+    def turn(
+        self, phone_number: str, model: str, conversation_id: Optional[str] = None
+    ) -> TurnMetrics:
+        """Start recording a turn."""
+        return TurnMetrics(self, phone_number, model, conversation_id)
+
+    def record_usage(self, model: str, stage: str, usage: Any) -> None:
+        """Record the token usage of an LLM call made outside of a turn."""
+        prompt, completion = _usage_tokens(usage)
+        with self._lock:
+            totals = self._llm.setdefault((model, stage), [0, 0, 0])
+            totals[0] += 1
+            totals[1] += prompt
+            totals[2] += completion
+
+    def record_cache(self, hit: bool) -> None:
+        """Record a response cache lookup made outside of a turn."""
+        with self._lock:
+            self._cache["hit" if hit else "miss"] += 1
+
+    def observe_stage(self, stage: str, seconds: float, model: str = "") -> None:
+        """Record the duration of a stage run outside of a turn (e.g. sending a message)."""
+        with self._lock:
+            self._histogram(self._stage_seconds, (model, stage)).observe(seconds)
+
+    def _histogram(self, histograms: dict, key) -> _Histogram:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = _Histogram(self.buckets)
+        return histogram
+
+    def _record_turn(self, turn: TurnMetrics, seconds: float):
+        with self._lock:
+            self._turns[turn.model] = self._turns.get(turn.model, 0) + 1
+            self._histogram(self._turn_seconds, turn.model).observe(seconds)
+            for stage, stage_seconds in turn.stages.items():
+                self._histogram(
+                    self._stage_seconds, (turn.model, stage)
+                ).observe(stage_seconds)
+            key = (turn.phone_number, turn.conversation_id)
+            stats = self._conversations.get(key) or ConversationStats()
+            stats.turns += 1
+            stats.llm_calls += turn.llm_calls
+            stats.prompt_tokens += turn.prompt_tokens
+            stats.completion_tokens += turn.completion_tokens
+            stats.cache_hits += bool(turn.cache_hit)
+            stats.seconds += seconds
+            stats.last_turn_at = time.time()
+            self._conversations[key] = stats
+
+    def conversation(
+        self, phone_number: str, conversation_id: Optional[str] = None
+    ) -> Optional[ConversationStats]:
+        """The running totals of a conversation, or ``None`` if it has no recorded turns."""
+        with self._lock:
+            stats = self._conversations.get((phone_number, conversation_id))
+            return ConversationStats(**asdict(stats)) if stats else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """All the metrics as a JSON-serializable dict."""
+        with self._lock:
+            return {
+                "turns": {
+                    model: {
+                        "count": count,
+                        "seconds": self._turn_seconds[model].to_dict(),
+                    }
+                    for model, count in self._turns.items()
+                },
+                "stages": [
+                    {"model": model, "stage": stage, **histogram.to_dict()}
+                    for (model, stage), histogram in self._stage_seconds.items()
+                ],
+                "llm": [
+                    {
+                        "model": model,
+                        "stage": stage,
+                        "calls": calls,
+                        "prompt_tokens": prompt,
+                        "completion_tokens": completion,
+                    }
+                    for (model, stage), (calls, prompt, completion) in self._llm.items()
+                ],
+                "response_cache": dict(self._cache),
+                "conversations": [
+                    {
+                        "phone_number": phone_number,
+                        "conversation_id": conversation_id,
+                        **asdict(stats),
+                    }
+                    for (phone_number, conversation_id), stats in self._conversations.items()
+                ],
+            }
+
+    def to_json(self) -> str:
+        """All the metrics as JSON."""
+        return json.dumps(self.to_dict())
+
+    def to_prometheus(self) -> str:
+        """The aggregated metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+
+        def header(name: str, kind: str, help_text: str):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def histogram(name: str, histogram: _Histogram, **labels: str):
+            for le, count in histogram.cumulative():
+                lines.append(f"{name}_bucket{_labels(**labels, le=le)} {count}")
+            lines.append(f"{name}_sum{_labels(**labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_labels(**labels)} {histogram.count}")
+
+        with self._lock:
+            header("pywaai_turns_total", "counter", "Generated replies.")
+            for model, count in self._turns.items():
+                lines.append(f"pywaai_turns_total{_labels(model=model)} {count}")
+            header("pywaai_turn_duration_seconds", "histogram", "Duration of a turn.")
+            for model, h in self._turn_seconds.items():
+                histogram("pywaai_turn_duration_seconds", h, model=model)
+            header(
+                "pywaai_stage_duration_seconds",
+                "histogram",
+                "Time spent in a stage of a turn.",
+            )
+            for (model, stage), h in self._stage_seconds.items():
+                histogram("pywaai_stage_duration_seconds", h, model=model, stage=stage)
+            header("pywaai_llm_requests_total", "counter", "LLM calls.")
+            for (model, stage), (calls, _, _) in self._llm.items():
+                labels = _labels(model=model, stage=stage)
+                lines.append(f"pywaai_llm_requests_total{labels} {calls}")
+            header("pywaai_llm_tokens_total", "counter", "Tokens used by LLM calls.")
+            for (model, stage), (_, prompt, completion) in self._llm.items():
+                for kind, tokens in (("prompt", prompt), ("completion", completion)):
+                    labels = _labels(model=model, stage=stage, type=kind)
+                    lines.append(f"pywaai_llm_tokens_total{labels} {tokens}")
+            header(
+                "pywaai_response_cache_lookups_total", "counter", "Response cache lookups."
+            )
+            for result, count in self._cache.items():
+                labels = _labels(result=result)
+                lines.append(f"pywaai_response_cache_lookups_total{labels} {count}")
+        return "\n".join(lines) + "\n"
+
+
+_metrics_registry: Optional[MetricsRegistry] = None
+
+
+def get_metrics_registry() -> MetricsRegistry:
+    """Get the shared metrics registry (created on first use)."""
+    global _metrics_registry
+    if _metrics_registry is None:
+        _metrics_registry = MetricsRegistry()
+    return _metrics_registry
+
+
+def set_metrics_registry(registry: MetricsRegistry) -> None:
+    """Replace the shared metrics registry."""
+    global _metrics_registry
+    _metrics_registry = registry
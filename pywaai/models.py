@@ -1,6 +1,6 @@
 from datetime import datetime
 from typing import Optional
-from sqlalchemy import Column, String, DateTime, Text
+from sqlalchemy import Column, String, DateTime, Text, Integer, LargeBinary, Index
 from sqlalchemy.orm import declarative_base, sessionmaker, Session
 from pydantic import BaseModel, ConfigDict
 
@@ -10,16 +10,64 @@ Base = declarative_base()
 class ConversationDB(Base):
     """SQLAlchemy model for conversations."""
     __tablename__ = "conversations"
+    __table_args__ = (
+        # Latest conversation of a phone number in a single index lookup
+        Index("ix_conversations_phone_number_updated_at", "phone_number", "updated_at"),
+    )
 
     conversation_id = Column(String, primary_key=True)
-    phone_number = Column(String, nullable=False, index=True)
-    messages = Column(Text, nullable=False)  # JSON-encoded list of messages
+    # Indexed by ix_conversations_phone_number_updated_at
+    phone_number = Column(String, nullable=False)
+    # JSON-encoded list of messages, or a zstd frame (stored as a BLOB) when compressed
+    messages = Column(Text, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False, index=True)
 
     def __repr__(self):
         return f"<Conversation(phone_number={self.phone_number}, conversation_id={self.conversation_id})>"
 
+class CompressionDictionaryDB(Base):
+    """SQLAlchemy model for the zstd dictionaries used to compress messages."""
+    __tablename__ = "compression_dictionaries"
+
+    dictionary_id = Column(Integer, primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"<CompressionDictionary(dictionary_id={self.dictionary_id})>"
+
+class ConversationSummaryDB(Base):
+    """SQLAlchemy model for the compaction state of a conversation.
+
+    The first ``compacted_count`` messages of the conversation were replaced by a summary
+    message, which is stored first in ``ConversationDB.messages``.
+    """
+    __tablename__ = "conversation_summaries"
+
+    conversation_id = Column(String, primary_key=True)
+    compacted_count = Column(Integer, nullable=False, default=0)
+    summarized_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"<ConversationSummary(conversation_id={self.conversation_id}, compacted_count={self.compacted_count})>"
+
+class ScheduledJobDB(Base):
+    """SQLAlchemy model for the pending jobs of the follow-up scheduler."""
+    __tablename__ = "scheduled_jobs"
+
+    job_id = Column(String, primary_key=True)
+    phone_number = Column(String, nullable=False, index=True)
+    kind = Column(String, nullable=False, default="follow_up")
+    # JSON-encoded payload given to the handler
+    payload = Column(Text, nullable=False, default="{}")
+    due_at = Column(DateTime, nullable=False, index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"<ScheduledJob(job_id={self.job_id}, phone_number={self.phone_number}, due_at={self.due_at})>"
+
 class ConversationCreate(BaseModel):
     """Pydantic model for creating a conversation."""
     model_config = ConfigDict(from_attributes=True)
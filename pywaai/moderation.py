@@ -0,0 +1,199 @@
+"""Moderation of incoming messages, batched and cached.
+
+Checks arriving within ``max_wait`` of each other are sent to the moderation API in a
+single request (of up to ``max_batch_size`` texts), and verdicts are cached by the hash of
+the text, so common messages ("hola", "ok") are only checked once. Pass a
+:class:`Moderator` to :func:`~pywaai.ai_utils.generate_response`, which checks the
+message while the history is loaded.
+
+Example:
+
+    >>> moderator = Moderator(openai_client)
+    >>> await generate_response(..., moderator=moderator)
+    >>> (await moderator.check("some text")).flagged
+    False
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
+
+from cachetools import TTLCache
+
+from . import metrics as _metrics
+from .metrics import MetricsRegistry, get_metrics_registry
+from .prompt import CHARS_PER_TOKEN
+from .rate_limit import Priority, get_llm_limiter, retry_after
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+try:
+    from loguru import logger
+except ImportError:
+    import logging
+
+    logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ModerationResult:
+    """The verdict on a text.
+
+    Attributes:
+        flagged: Whether the text breaks the usage policies.
+        categories: The flagged categories (e.g. ``"harassment"``).
+        error: Whether the check failed (the verdict is then the ``fail_open`` default and
+            is not cached).
+    """
+
+    flagged: bool
+    categories: List[str] = field(default_factory=list)
+    error: bool = False
+
+
+def content_key(text: str) -> str:
+    """The cache key of a text."""
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _result(result) -> ModerationResult:
+    categories = result.categories.model_dump(by_alias=True)
+    return ModerationResult(
+        flagged=result.flagged,
+        categories=[name for name, flagged in categories.items() if flagged],
+    )
+
+
+class Moderator:
+    """Checks texts with the OpenAI moderation API, micro-batching and caching the calls."""
+
+    def __init__(
+        self,
+        openai_client: Optional[AsyncOpenAI] = None,
+        model: str = "omni-moderation-latest",
+        max_batch_size: int = 32,
+        max_wait: float = 0.01,
+        maxsize: int = 10000,
+        ttl: float = 86400,
+        fail_open: bool = True,
+        refusal: str = "I'm sorry, but I can't respond to that kind of message.",
+        priority: int = Priority.REPLY,
+        rate_limit_retries: int = 2,
+        metrics: Optional[MetricsRegistry] = None,
+    ):
+        """
+        Args:
+            openai_client: The client of the moderation API (defaults to the client of
+                :mod:`pywaai.ai_utils`).
+            model: The moderation model.
+            max_batch_size: The most texts sent in one request.
+            max_wait: How long (in seconds) a check waits for others to share its request.
+            maxsize: The most verdicts kept in the cache.
+            ttl: How long (in seconds) verdicts are cached.
+            fail_open: Whether texts pass when the moderation API fails.
+            refusal: The reply to flagged messages.
+            priority: The lane of the calls in the shared LLM limiter.
+            rate_limit_retries: How many times a rate-limited call is retried.
+            metrics: Where the duration of the calls is recorded (defaults to the shared
+                registry).
+        """
+        self._openai_client = openai_client
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.fail_open = fail_open
+        self.refusal = refusal
+        self.priority = priority
+        self.rate_limit_retries = rate_limit_retries
+        self.metrics = metrics
+        self.calls = 0
+        self._cache: TTLCache[str, ModerationResult] = TTLCache(maxsize=maxsize, ttl=ttl)
+        # Texts being checked, so that concurrent checks of a text share the call
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._batch: List[Tuple[str, str]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def openai_client(self) -> AsyncOpenAI:
+        if self._openai_client is None:
+            from .ai_utils import _get_default_openai_client
+
+            self._openai_client = _get_default_openai_client()
+        return self._openai_client
+
+    async def check(self, text: str) -> ModerationResult:
+        """The verdict on a text, from the cache or from the next batched request."""
+        key = content_key(text)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._in_flight[key] = future
+            self._batch.append((key, text))
+            if len(self._batch) >= self.max_batch_size:
+                self._send_batch()
+            elif self._timer is None:
+                self._timer = asyncio.get_running_loop().call_later(
+                    self.max_wait, self._send_batch
+                )
+        # A cancelled check doesn't cancel the others waiting for the text
+        return await asyncio.shield(future)
+
+    def _send_batch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._batch = self._batch, []
+        if batch:
+            task = asyncio.create_task(self._moderate(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _moderate(self, batch: List[Tuple[str, str]]):
+        started = time.perf_counter()
+        results: List[ModerationResult] = []
+        try:
+            response = await self._create([text for _, text in batch])
+            results = [_result(result) for result in response.results]
+            if len(results) != len(batch):
+                raise ValueError(f"got {len(results)} results for {len(batch)} texts")
+            for (key, _), result in zip(batch, results):
+                self._cache[key] = result
+        except Exception as e:
+            logger.error(f"Moderation of {len(batch)} texts failed: {e}")
+            results = []
+        finally:
+            (self.metrics or get_metrics_registry()).observe_stage(
+                _metrics.MODERATION, time.perf_counter() - started, self.model
+            )
+            # Every check gets a verdict (also when cancelled), so none waits forever
+            error = ModerationResult(flagged=not self.fail_open, error=True)
+            for i, (key, _) in enumerate(batch):
+                future = self._in_flight.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_result(results[i] if i < len(results) else error)
+
+    async def _create(self, texts: List[str]):
+        import openai
+
+        self.calls += 1
+        limiter = get_llm_limiter()
+        tokens = sum(len(text) for text in texts) // CHARS_PER_TOKEN
+        for attempt in range(self.rate_limit_retries + 1):
+            async with limiter.acquire(self.model, self.priority, tokens):
+                try:
+                    return await self.openai_client.moderations.create(
+                        model=self.model, input=texts
+                    )
+                except openai.RateLimitError as e:
+                    if attempt == self.rate_limit_retries:
+                        raise
+                    limiter.pause(self.model, retry_after(e, attempt))
@@ -0,0 +1,140 @@
+"""Token-budgeted prompt assembly.
+
+The most recent messages of a conversation are kept within a token budget. Token counts
+are cached per message, so each turn only tokenizes the messages it has not seen before.
+Tokens are counted with ``tiktoken`` (``pip install "pywaai[tokens]"``), or estimated from
+the length of the text when it is not installed.
+"""
+
+import hashlib
+import json
+from typing import Callable, Dict, List, Optional
+
+from cachetools import LRUCache
+
+try:
+    from loguru import logger
+except ImportError:
+    import logging
+
+    logger = logging.getLogger(__name__)
+
+# Every message costs a few tokens on top of its content (role and separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Characters per token when estimating without a tokenizer
+CHARS_PER_TOKEN = 4
+
+
+def get_token_counter(model: str = "gpt-4o") -> Callable[[str], int]:
+    """Get a function that counts the tokens of a text for the given model.
+
+    Uses ``tiktoken`` when it is installed, and otherwise estimates
+    ``len(text) / CHARS_PER_TOKEN``.
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        logger.debug("tiktoken is not installed, estimating token counts")
+        return lambda text: -(-len(text) // CHARS_PER_TOKEN)
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("o200k_base")
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def _message_text(message: Dict) -> str:
+    text = message.get("content") or ""
+    if not isinstance(text, str):
+        text = json.dumps(text, ensure_ascii=False)
+    if message.get("tool_calls"):
+        text += json.dumps(message["tool_calls"], ensure_ascii=False)
+    return text
+
+
+def _group_messages(messages: List[Dict]) -> List[List[Dict]]:
+    """Group the messages so that tool results stay with the assistant message that called them."""
+    groups: List[List[Dict]] = []
+    for message in messages:
+        if message.get("role") == "tool" and groups and (
+            groups[-1][0].get("tool_calls")
+        ):
+            groups[-1].append(message)
+        else:
+            groups.append([message])
+    return groups
+
+
+class PromptBuilder:
+    """Builds the prompt from the system message and the most recent messages that fit a budget.
+
+    Messages are kept or dropped whole, newest first, and an assistant message with tool
+    calls is always kept or dropped together with its tool results. The latest message is
+    always kept, even if it alone exceeds the budget. System messages at the start of the
+    history (such as conversation summaries) are always kept too.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 16000,
+        model: str = "gpt-4o",
+        count_tokens: Optional[Callable[[str], int]] = None,
+        cache_size: int = 100_000,
+    ):
+        """
+        Args:
+            max_tokens: The token budget of the prompt (system message included).
+            model: The model whose tokenizer is used.
+            count_tokens: A custom function counting the tokens of a text.
+            cache_size: The number of per-message token counts to cache.
+        """
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens or get_token_counter(model)
+        self._counts: "LRUCache[bytes, int]" = LRUCache(maxsize=cache_size)
+
+    def message_tokens(self, message: Dict) -> int:
+        """Count the tokens of a message, caching the count by its content."""
+        text = _message_text(message)
+        key = hashlib.blake2b(
+            f"{message.get('role')}\0{text}".encode(), digest_size=16
+        ).digest()
+        count = self._counts.get(key)
+        if count is None:
+            count = self.count_tokens(text) + MESSAGE_OVERHEAD_TOKENS
+            self._counts[key] = count
+        return count
+
+    def build(
+        self, system_message: Optional[Dict], history: List[Dict]
+    ) -> List[Dict]:
+        """Build the messages for the model.
+
+        Args:
+            system_message: The system message (always included), or ``None``.
+            history: The conversation messages, oldest first.
+
+        Returns:
+            The system message(s) followed by the most recent messages within the budget.
+        """
+        leading = 0
+        while leading < len(history) and history[leading].get("role") == "system":
+            leading += 1
+        pinned = ([system_message] if system_message is not None else []) + history[
+            :leading
+        ]
+        history = history[leading:]
+        budget = self.max_tokens - sum(self.message_tokens(m) for m in pinned)
+
+        kept: List[List[Dict]] = []
+        groups = _group_messages(history)
+        for group in reversed(groups):
+            tokens = sum(self.message_tokens(message) for message in group)
+            if tokens > budget and kept:
+                break
+            budget -= tokens
+            kept.append(group)
+
+        dropped = len(groups) - len(kept)
+        if dropped:
+            logger.debug(f"Dropped the {dropped} oldest message groups from the prompt")
+        return pinned + [message for group in reversed(kept) for message in group]
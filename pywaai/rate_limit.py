@@ -0,0 +1,292 @@
+"""Shared limiter for LLM calls: per-model concurrency caps, request and token rate limits,
+and priority lanes.
+
+Callers wait in a queue instead of failing: requests are granted in priority order
+(user replies before follow-ups before background work), first come first served within a
+priority, as soon as the model has a free slot and enough request and token budget.
+
+Example:
+
+    >>> set_llm_limiter(
+    ...     LLMLimiter({"gpt-4o": ModelLimits(max_concurrency=20, tokens_per_minute=450_000)})
+    ... )
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Dict, List, Optional
+
+from .prompt import CHARS_PER_TOKEN, _message_text
+
+try:
+    from loguru import logger
+except ImportError:
+    import logging
+
+    logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """The priority lane of an LLM call (lower values are served first)."""
+
+    REPLY = 0
+    FOLLOW_UP = 1
+    BACKGROUND = 2
+
+
+@dataclass
+class ModelLimits:
+    """The limits of a model (``None`` means unlimited).
+
+    Attributes:
+        max_concurrency: The maximum number of calls in flight.
+        requests_per_minute: The maximum number of calls per minute.
+        tokens_per_minute: The maximum number of (prompt and completion) tokens per minute.
+    """
+
+    max_concurrency: Optional[int] = None
+    requests_per_minute: Optional[float] = None
+    tokens_per_minute: Optional[float] = None
+
+
+class _TokenBucket:
+    """A bucket holding up to a minute of budget, refilled continuously."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, cost: float, now: float) -> float:
+        """Seconds until ``cost`` can be consumed (costs above the capacity wait for a full bucket)."""
+        self._refill(now)
+        return max(0.0, (min(cost, self.capacity) - self.level) / self.rate)
+
+    def consume(self, cost: float, now: float):
+        """Take ``cost`` from the bucket (which may go into debt), or refund a negative cost."""
+        self._refill(now)
+        self.level = min(self.capacity, self.level - cost)
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: int
+    seq: int
+    tokens: int = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+
+class _ModelState:
+    def __init__(self, limits: ModelLimits):
+        self.limits = limits
+        self.in_flight = 0
+        self.requests = (
+            _TokenBucket(limits.requests_per_minute) if limits.requests_per_minute else None
+        )
+        self.tokens = (
+            _TokenBucket(limits.tokens_per_minute) if limits.tokens_per_minute else None
+        )
+        self.waiters: List[_Waiter] = []
+        self.paused_until = 0.0
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.timer_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+class Permit:
+    """Permission to make one LLM call, used as ``async with limiter.acquire(...) as permit``."""
+
+    def __init__(self, limiter: "LLMLimiter", model: str, priority: int, tokens: int):
+        self._limiter = limiter
+        self._model = model
+        self._priority = priority
+        self._tokens = tokens
+        self._granted = False
+
+    async def __aenter__(self) -> "Permit":
+        await self._limiter._acquire(self._model, self._priority, self._tokens)
+        self._granted = True
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self._granted:
+            self._granted = False
+            self._limiter._release(self._model)
+
+    def record(self, usage: Any) -> None:
+        """Correct the token budget with the actual usage of the call.
+
+        Args:
+            usage: The ``usage`` of the OpenAI response (or a number of tokens).
+        """
+        if usage is None:
+            return
+        total = usage if isinstance(usage, int) else getattr(usage, "total_tokens", None)
+        if total is None:
+            return
+        self._limiter._adjust(self._model, total - self._tokens)
+        self._tokens = total
+
+
+class LLMLimiter:
+    """Coordinates the LLM calls of the process (see the module docstring)."""
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, ModelLimits]] = None,
+        default: Optional[ModelLimits] = None,
+    ):
+        """
+        Args:
+            limits: The limits of each model.
+            default: The limits of the models without their own (unlimited by default).
+        """
+        self.limits = limits or {}
+        self.default = default or ModelLimits()
+        self._states: Dict[str, _ModelState] = {}
+        self._seq = itertools.count()
+
+    def _state(self, model: str) -> _ModelState:
+        state = self._states.get(model)
+        if state is None:
+            state = _ModelState(self.limits.get(model, self.default))
+            self._states[model] = state
+        return state
+
+    def acquire(
+        self, model: str, priority: int = Priority.REPLY, tokens: int = 0
+    ) -> Permit:
+        """Wait for permission to call a model.
+
+        Args:
+            model: The model to call.
+            priority: The priority lane of the call.
+            tokens: The estimated tokens of the call (see :func:`estimate_tokens`),
+                corrected afterwards with :meth:`Permit.record`.
+        """
+        return Permit(self, model, priority, tokens)
+
+    async def _acquire(self, model: str, priority: int, tokens: int):
+        state = self._state(model)
+        waiter = _Waiter(
+            priority, next(self._seq), tokens, asyncio.get_running_loop().create_future()
+        )
+        heapq.heappush(state.waiters, waiter)
+        self._dispatch(state)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Granted just as we were cancelled
+                self._release(model)
+            else:
+                waiter.future.cancel()
+                self._dispatch(state)
+            raise
+
+    def _release(self, model: str):
+        state = self._state(model)
+        state.in_flight -= 1
+        self._dispatch(state)
+
+    def _adjust(self, model: str, tokens: int):
+        state = self._state(model)
+        if state.tokens is not None and tokens:
+            state.tokens.consume(tokens, time.monotonic())
+            if tokens < 0:
+                self._dispatch(state)
+
+    def pause(self, model: str, seconds: float) -> None:
+        """Stop granting calls to a model for a while (e.g. after a 429 response)."""
+        state = self._state(model)
+        state.paused_until = max(state.paused_until, time.monotonic() + seconds)
+        logger.warning(f"Pausing {model} calls for {seconds:.1f}s")
+
+    def _dispatch(self, state: _ModelState):
+        """Grant calls from the head of the queue while the limits allow it."""
+        limits = state.limits
+        while state.waiters:
+            waiter = state.waiters[0]
+            if waiter.future.done():
+                heapq.heappop(state.waiters)
+                continue
+            if limits.max_concurrency and state.in_flight >= limits.max_concurrency:
+                return
+            now = time.monotonic()
+            delay = max(
+                state.paused_until - now,
+                state.requests.delay(1, now) if state.requests else 0.0,
+                state.tokens.delay(waiter.tokens, now) if state.tokens else 0.0,
+            )
+            if delay > 0:
+                self._wake_up_in(state, delay)
+                return
+            heapq.heappop(state.waiters)
+            if state.requests:
+                state.requests.consume(1, now)
+            if state.tokens:
+                state.tokens.consume(waiter.tokens, now)
+            state.in_flight += 1
+            waiter.future.set_result(None)
+
+    def _wake_up_in(self, state: _ModelState, delay: float):
+        loop = asyncio.get_running_loop()
+        when = loop.time() + delay
+        if state.timer is not None and state.timer_loop is loop:
+            if not state.timer.cancelled() and state.timer.when() <= when:
+                return
+            state.timer.cancel()
+
+        def wake_up():
+            state.timer = None
+            self._dispatch(state)
+
+        state.timer = loop.call_at(when, wake_up)
+        state.timer_loop = loop
+
+    def stats(self, model: str) -> Dict[str, int]:
+        """The number of calls in flight and waiting for a model."""
+        state = self._state(model)
+        return {
+            "in_flight": state.in_flight,
+            "queued": sum(1 for waiter in state.waiters if not waiter.future.done()),
+        }
+
+
+def estimate_tokens(messages: List[Dict], max_tokens: int = 0) -> int:
+    """Estimate the tokens of a chat completion from its messages and ``max_tokens``."""
+    characters = sum(len(_message_text(message)) for message in messages)
+    return characters // CHARS_PER_TOKEN + max_tokens
+
+
+def retry_after(error: Any, attempt: int) -> float:
+    """The delay (in seconds) asked by a 429 error, or an exponential backoff."""
+    try:
+        return float(error.response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return float(2**attempt)
+
+
+_llm_limiter: Optional[LLMLimiter] = None
+
+
+def get_llm_limiter() -> LLMLimiter:
+    """Get the shared limiter (without limits unless replaced with :func:`set_llm_limiter`)."""
+    global _llm_limiter
+    if _llm_limiter is None:
+        _llm_limiter = LLMLimiter()
+    return _llm_limiter
+
+
+def set_llm_limiter(limiter: LLMLimiter) -> None:
+    """Replace the shared limiter."""
+    global _llm_limiter
+    _llm_limiter = limiter
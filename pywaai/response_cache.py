@@ -0,0 +1,198 @@
+"""Cache of generated replies for repeated questions (e.g. FAQs).
+
+Replies are keyed by the model, the system prompt, the context of the reply (e.g. the
+date, or a tenant) and the normalized user message. On an exact miss, an optional
+embedding tier returns the reply of the most similar cached question of the same prompt
+and context. See ``generate_response(response_cache=...)`` for when the cache is used.
+"""
+
+import asyncio
+import hashlib
+import math
+import re
+import unicodedata
+from dataclasses import dataclass
+from operator import mul
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Union
+
+from cachetools import TTLCache
+
+try:
+    from loguru import logger
+except ImportError:
+    import logging
+
+    logger = logging.getLogger(__name__)
+
+Embedder = Callable[[str], Union[Sequence[float], Awaitable[Sequence[float]]]]
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_message(text: str) -> str:
+    """Normalize a user message for matching: case, accents, punctuation and spacing are ignored."""
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return _WHITESPACE.sub(" ", _PUNCTUATION.sub(" ", text)).strip()
+
+
+def prompt_key(system_prompt: str) -> str:
+    """The key of the cache entries of a system prompt."""
+    return hashlib.sha256(system_prompt.encode()).hexdigest()
+
+
+@dataclass
+class CachedResponse:
+    """A cached reply.
+
+    Attributes:
+        content: The full reply, as stored in the conversation.
+        messages: The messages the reply was sent as.
+    """
+
+    content: str
+    messages: List[str]
+
+
+def _key(system_prompt: str, model: str, context: str) -> tuple[str, str, str]:
+    return prompt_key(system_prompt), model, prompt_key(context) if context else ""
+
+
+def _unit(vector: Sequence[float]) -> List[float]:
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+class ResponseCache:
+    """A TTL/LRU cache of replies with an exact and an optional embedding-similarity tier.
+
+    A cached reply is only sent for the same ``context`` it was generated with, which
+    :func:`~pywaai.ai_utils.generate_response` sets to the date and its ``cache_scope``.
+    Only use it for system prompts whose answers do not depend on the user: the cached
+    reply of a question is sent to everyone asking it.
+
+    Example:
+
+        >>> cache = ResponseCache(ttl=3600, embedder=model.encode)
+        >>> await generate_response(..., response_cache=cache)
+        >>> cache.invalidate(system_prompt)  # e.g. after updating the FAQ
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: float = 3600,
+        embedder: Optional[Embedder] = None,
+        similarity_threshold: float = 0.92,
+        max_history_messages: int = 0,
+    ):
+        """
+        Args:
+            maxsize: The maximum number of cached replies (least recently used are evicted).
+            ttl: How long (in seconds) a reply is cached.
+            embedder: A (sync or async) function returning the embedding of a text, e.g.
+                a local sentence-transformers model. Sync embedders run in a thread.
+                ``None`` only matches normalized messages exactly.
+            similarity_threshold: The minimum cosine similarity of an embedding match.
+            max_history_messages: The cache is skipped when the conversation has more
+                than this many earlier (non-system) messages, as the reply may depend
+                on them.
+        """
+        self.embedder = embedder
+        self.similarity_threshold = similarity_threshold
+        self.max_history_messages = max_history_messages
+        # (prompt key, model, context key, normalized message) -> CachedResponse
+        self._entries: "TTLCache[tuple[str, str, str, str], CachedResponse]" = TTLCache(
+            maxsize=maxsize, ttl=ttl
+        )
+        # (prompt key, model, context key) -> {normalized message: unit embedding}
+        self._embeddings: Dict[tuple[str, str, str], Dict[str, List[float]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def _embed(self, text: str) -> List[float]:
+        if asyncio.iscoroutinefunction(self.embedder):
+            vector = await self.embedder(text)
+        else:
+            vector = await asyncio.to_thread(self.embedder, text)
+        return _unit(vector)
+
+    async def get(
+        self, system_prompt: str, model: str, message: str, context: str = ""
+    ) -> Optional[CachedResponse]:
+        """Get the cached reply to a message in a ``context``, or ``None``."""
+        key = _key(system_prompt, model, context)
+        normalized = normalize_message(message)
+        cached = self._entries.get((*key, normalized))
+        if cached is None and self.embedder is not None and self._embeddings.get(key):
+            cached = await self._get_similar(key, normalized)
+        if cached is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return cached
+
+    async def _get_similar(
+        self, key: tuple[str, str, str], normalized: str
+    ) -> Optional[CachedResponse]:
+        vector = await self._embed(normalized)
+        embeddings = self._embeddings.get(key, {})
+        best, best_similarity = None, self.similarity_threshold
+        for other, other_vector in list(embeddings.items()):
+            if (*key, other) not in self._entries:
+                # Expired or evicted
+                del embeddings[other]
+                continue
+            similarity = sum(map(mul, vector, other_vector))
+            if similarity >= best_similarity:
+                best, best_similarity = other, similarity
+        if best is None:
+            return None
+        logger.debug(
+            f"Response cache matched {normalized!r} to {best!r} ({best_similarity:.3f})"
+        )
+        return self._entries.get((*key, best))
+
+    async def put(
+        self,
+        system_prompt: str,
+        model: str,
+        message: str,
+        response: CachedResponse,
+        context: str = "",
+    ) -> None:
+        """Cache the reply to a message in a ``context``."""
+        key = _key(system_prompt, model, context)
+        normalized = normalize_message(message)
+        self._entries[(*key, normalized)] = response
+        if self.embedder is not None:
+            embeddings = self._embeddings.setdefault(key, {})
+            if normalized not in embeddings:
+                embeddings[normalized] = await self._embed(normalized)
+
+    def invalidate(
+        self, system_prompt: Optional[str] = None, model: Optional[str] = None
+    ) -> int:
+        """Drop the cached replies of a system prompt (of any model unless given), or all of them.
+
+        Returns:
+            int: The number of dropped replies.
+        """
+        if system_prompt is None:
+            dropped = len(self._entries)
+            self._entries.clear()
+            self._embeddings.clear()
+            return dropped
+        key = prompt_key(system_prompt)
+        stale = [
+            entry
+            for entry in list(self._entries)
+            if entry[0] == key and model in (None, entry[1])
+        ]
+        for entry in stale:
+            self._entries.pop(entry, None)
+        for embedding_key in list(self._embeddings):
+            if embedding_key[0] == key and model in (None, embedding_key[1]):
+                del self._embeddings[embedding_key]
+        return len(stale)
@@ -0,0 +1,226 @@
+"""Per-turn model routing: send easy turns to a smaller, faster model.
+
+The router picks the model of a turn from cheap local features (see :class:`TurnFeatures`)
+with a list of rules, tried in order. A model can have a fallback, used when its calls
+fail, and an escalation, used when its reply falls short (e.g. it is empty or cut).
+
+Example:
+
+    >>> set_model_router(
+    ...     ModelRouter(
+    ...         rules=[likely_tools("gpt-4o"), short_messages("gpt-4o-mini")],
+    ...         fallbacks={"gpt-4o-mini": "gpt-4o"},
+    ...         escalations={"gpt-4o-mini": "gpt-4o"},
+    ...     )
+    ... )
+
+Every :func:`pywaai.ai_utils.generate_response` call then routes its turns, unless it is
+given a ``router`` of its own.
+"""
+
+import re
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from .rate_limit import estimate_tokens
+
+try:
+    from loguru import logger
+except ImportError:
+    import logging
+
+    logger = logging.getLogger(__name__)
+
+
+_WORD = re.compile(r"\w+")
+# Too generic to tell that a message is about a tool
+_GENERIC_TOOL_WORDS = {"tool", "function", "call", "fetch", "info", "data"}
+
+
+@dataclass
+class TurnFeatures:
+    """What the router knows about a turn, computed locally before the model is called.
+
+    Attributes:
+        message_text: The user message.
+        chars: The length of the message.
+        words: The number of words of the message.
+        is_question: Whether the message asks something (has a question mark).
+        history_messages: The number of earlier messages in the prompt (without the
+            system messages).
+        prompt_tokens: An estimate of the tokens of the prompt.
+        has_tools: Whether tools are offered in the turn.
+        tools_likely: Whether the message mentions a word of a tool's name.
+    """
+
+    message_text: str
+    chars: int
+    words: int
+    is_question: bool
+    history_messages: int
+    prompt_tokens: int
+    has_tools: bool
+    tools_likely: bool
+
+
+def _tool_words(name: str) -> List[str]:
+    """The words of a tool name, e.g. ``GetWeather`` or ``get_weather`` -> weather."""
+    words = re.findall(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])", name.replace("_", " "))
+    return [
+        word.lower()
+        for word in words
+        if len(word) > 3 and word.lower() not in _GENERIC_TOOL_WORDS
+    ]
+
+
+def turn_features(
+    message_text: str,
+    messages: List[Dict],
+    tool_functions: Optional[Sequence[Any]] = None,
+) -> TurnFeatures:
+    """Compute the features of a turn.
+
+    Args:
+        message_text: The user message.
+        messages: The prompt, ending with the user message.
+        tool_functions: The tools offered in the turn.
+    """
+    words = _WORD.findall(message_text.lower())
+    tool_words = {
+        word for func in tool_functions or () for word in _tool_words(func.__name__)
+    }
+    return TurnFeatures(
+        message_text=message_text,
+        chars=len(message_text.strip()),
+        words=len(words),
+        is_question="?" in message_text,
+        history_messages=sum(1 for m in messages[:-1] if m.get("role") != "system"),
+        prompt_tokens=estimate_tokens(messages),
+        has_tools=bool(tool_functions),
+        tools_likely=any(
+            word.startswith(tool_word) for word in words for tool_word in tool_words
+        ),
+    )
+
+
+RoutingRule = Callable[[TurnFeatures], Optional[str]]
+"""Picks the model of a turn, or returns ``None`` to leave it to the next rule."""
+
+
+def short_messages(model: str, max_chars: int = 25, max_words: int = 4) -> RoutingRule:
+    """Route short messages that ask nothing and need no tool (e.g. "ok", "thanks") to ``model``.
+
+    Args:
+        model: The model for these turns, typically a small and fast one.
+        max_chars: The longest message to route.
+        max_words: The most words of a message to route.
+    """
+
+    def rule(features: TurnFeatures) -> Optional[str]:
+        if (
+            features.chars <= max_chars
+            and features.words <= max_words
+            and not features.is_question
+            and not features.tools_likely
+        ):
+            return model
+        return None
+
+    return rule
+
+
+def likely_tools(model: str) -> RoutingRule:
+    """Route the turns whose message mentions a tool to ``model``.
+
+    Put it before rules for small models, so that tool calls stay on a capable model.
+    """
+
+    def rule(features: TurnFeatures) -> Optional[str]:
+        return model if features.tools_likely else None
+
+    return rule
+
+
+def long_prompts(model: str, min_tokens: int) -> RoutingRule:
+    """Route the turns whose prompt has at least ``min_tokens`` tokens to ``model``."""
+
+    def rule(features: TurnFeatures) -> Optional[str]:
+        return model if features.prompt_tokens >= min_tokens else None
+
+    return rule
+
+
+EscalationPolicy = Callable[[Any], bool]
+"""Decides from a chat completion whether to ask the escalation model instead."""
+
+
+def escalate_if_incomplete(response: Any) -> bool:
+    """Escalate replies that were cut at ``max_tokens``, or have neither text nor tool calls."""
+    choice = response.choices[0]
+    if choice.finish_reason == "length":
+        return True
+    return not choice.message.tool_calls and not (choice.message.content or "").strip()
+
+
+class ModelRouter:
+    """Picks the model of each turn, with fallbacks on errors and escalations of poor replies."""
+
+    def __init__(
+        self,
+        rules: Sequence[RoutingRule] = (),
+        default: Optional[str] = None,
+        fallbacks: Optional[Dict[str, str]] = None,
+        escalations: Optional[Dict[str, str]] = None,
+        should_escalate: EscalationPolicy = escalate_if_incomplete,
+    ):
+        """
+        Args:
+            rules: Tried in order; the first model returned is used.
+            default: The model when no rule matches (``None`` keeps the caller's model).
+            fallbacks: model -> the model to retry with when a call fails.
+            escalations: model -> the model to ask when ``should_escalate`` returns
+                ``True`` for a reply.
+            should_escalate: Decides whether a reply is escalated.
+        """
+        self.rules = list(rules)
+        self.default = default
+        self.fallbacks = dict(fallbacks or {})
+        self.escalations = dict(escalations or {})
+        self.should_escalate = should_escalate
+
+    def route(self, features: TurnFeatures, model: str) -> str:
+        """The model of a turn, given the caller's ``model``."""
+        for rule in self.rules:
+            routed = rule(features)
+            if routed is not None:
+                break
+        else:
+            routed = self.default or model
+        if routed != model:
+            logger.debug(f"Routing the turn from {model} to {routed}")
+        return routed
+
+    def fallback(self, model: str) -> Optional[str]:
+        """The model to retry with after a failed call to ``model``."""
+        return self.fallbacks.get(model)
+
+    def escalation(self, model: str, response: Any) -> Optional[str]:
+        """The model to ask instead, if the reply of ``model`` falls short."""
+        target = self.escalations.get(model)
+        if target is not None and self.should_escalate(response):
+            return target
+        return None
+
+
+_model_router: Optional[ModelRouter] = None
+
+
+def get_model_router() -> Optional[ModelRouter]:
+    """The router used by default, or ``None`` if turns are not routed."""
+    return _model_router
+
+
+def set_model_router(router: Optional[ModelRouter]) -> None:
+    """Route the turns of every call that doesn't pass its own router (``None`` disables it)."""
+    global _model_router
+    _model_router = router
@@ -0,0 +1,400 @@
+"""Persistent scheduler for follow-up messages.
+
+Jobs are stored in the ``scheduled_jobs`` table, so the schedule survives restarts, and
+the jobs due within the next ``horizon`` are kept in an in-memory heap. A single loop
+fires the due jobs in batches, with at most ``max_concurrency`` handlers running, instead
+of one sleeping task per user.
+
+Example:
+
+    >>> async def follow_up(job: ScheduledJob):
+    ...     await wa.send_message(to=job.phone_number, text=job.payload["text"])
+    >>> scheduler = FollowUpScheduler(follow_up, pool=manager.history.pool)
+    >>> await scheduler.start()  # Recovers the pending jobs
+    >>> await scheduler.cancel(phone_number)  # The user replied
+    >>> await scheduler.schedule(phone_number, 300, payload={"text": "Still there?"})
+"""
+
+import asyncio
+import heapq
+import itertools
+import json
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from .conversation_db import ConnectionPool, generate_ulid
+from .models import ScheduledJobDB
+
+try:
+    from loguru import logger
+except ImportError:
+    import logging
+
+    logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ScheduledJob:
+    """A job of the scheduler.
+
+    Attributes:
+        job_id: The ID of the job.
+        phone_number: The user the job is for.
+        due_at: When the job is due (a Unix timestamp).
+        kind: The kind of job (e.g. ``"follow_up"``), to cancel jobs selectively.
+        payload: JSON-serializable data for the handler.
+        attempts: The number of failed attempts so far.
+    """
+
+    job_id: str
+    phone_number: str
+    due_at: float
+    kind: str = "follow_up"
+    payload: Dict[str, Any] = field(default_factory=dict)
+    attempts: int = 0
+
+
+JobHandler = Callable[[ScheduledJob], Awaitable[Any]]
+
+
+def _to_datetime(timestamp: float) -> datetime:
+    return datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None)
+
+
+def _to_timestamp(value: datetime) -> float:
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _from_row(row: ScheduledJobDB) -> ScheduledJob:
+    return ScheduledJob(
+        job_id=row.job_id,
+        phone_number=row.phone_number,
+        due_at=_to_timestamp(row.due_at),
+        kind=row.kind,
+        payload=json.loads(row.payload),
+        attempts=row.attempts,
+    )
+
+
+class FollowUpScheduler:
+    """Fires scheduled jobs (e.g. follow-up messages) from a SQLite table and an in-memory heap.
+
+    Jobs are delivered at least once: a job is deleted after its handler returns, so the
+    jobs that were running when the process stopped fire again after :meth:`start`. A
+    failing handler is retried after ``retry_delay`` seconds, up to ``max_attempts`` times.
+    """
+
+    def __init__(
+        self,
+        handler: JobHandler,
+        db_path: str = "conversations.db",
+        pool: Optional[ConnectionPool] = None,
+        max_concurrency: int = 50,
+        batch_size: int = 500,
+        horizon: float = 3600,
+        max_attempts: int = 3,
+        retry_delay: float = 60,
+        error_delay: float = 5,
+    ):
+        """
+        Args:
+            handler: An async function called with each due :class:`ScheduledJob`.
+            db_path: The SQLite database of the jobs (ignored if ``pool`` is given).
+            pool: A connection pool to share, e.g. ``conversation_manager.history.pool``.
+            max_concurrency: The maximum number of handlers running at once.
+            batch_size: The maximum number of due jobs taken from the heap at once.
+            horizon: Jobs due within this many seconds are kept in memory; later ones
+                are loaded from the database as they get closer.
+            max_attempts: How many times a failing job is tried.
+            retry_delay: The delay (in seconds) before retrying a failed job.
+            error_delay: The delay (in seconds) before firing jobs again after an error
+                of the scheduler itself (e.g. the database is locked).
+        """
+        self.handler = handler
+        self.pool = pool or ConnectionPool(db_path)
+        self.max_concurrency = max_concurrency
+        self.batch_size = batch_size
+        self.horizon = horizon
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.error_delay = error_delay
+        self._heap: List[Tuple[float, int, str]] = []
+        self._seq = itertools.count()
+        self._jobs: Dict[str, ScheduledJob] = {}
+        self._by_phone: Dict[str, Set[str]] = {}
+        self._running: Set[str] = set()
+        # Running jobs cancelled by cancel(), which are not retried
+        self._cancelled: Set[str] = set()
+        self._loaded_until = 0.0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._handlers: Set[asyncio.Task] = set()
+        # Jobs done since the last delete, deleted together
+        self._done: List[str] = []
+        self._delete_task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        """Load the pending jobs and start firing them."""
+        if self._task is not None:
+            return
+        await self._load(time.time() + self.horizon)
+        self._task = asyncio.create_task(self._run())
+        self._task.add_done_callback(self._run_done)
+        logger.info(f"Scheduler started with {len(self._jobs)} pending jobs in memory")
+
+    async def stop(self, wait: bool = True) -> None:
+        """Stop firing jobs, waiting for the running handlers unless ``wait=False``."""
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if wait and self._handlers:
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+        if self._delete_task is not None:
+            await self._delete_task
+
+    async def schedule(
+        self,
+        phone_number: str,
+        delay: float,
+        kind: str = "follow_up",
+        payload: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        """Schedule a job ``delay`` seconds from now.
+
+        Returns:
+            str: The ID of the job.
+        """
+        job = ScheduledJob(
+            job_id=generate_ulid(),
+            phone_number=phone_number,
+            due_at=time.time() + delay,
+            kind=kind,
+            payload=payload or {},
+        )
+        session = await self.pool.get_connection()
+        try:
+            session.add(
+                ScheduledJobDB(
+                    job_id=job.job_id,
+                    phone_number=phone_number,
+                    kind=kind,
+                    payload=json.dumps(job.payload),
+                    due_at=_to_datetime(job.due_at),
+                )
+            )
+            session.commit()
+        finally:
+            await self.pool.release_connection(session)
+        if job.due_at < self._loaded_until:
+            self._push(job)
+        return job.job_id
+
+    async def cancel(self, phone_number: str, kind: Optional[str] = None) -> int:
+        """Cancel the pending jobs of a user (e.g. when they reply), optionally only of a kind.
+
+        Jobs whose handler is already running are not interrupted, but are not retried if
+        they fail.
+
+        Returns:
+            int: The number of cancelled jobs.
+        """
+        for job_id in list(self._by_phone.get(phone_number, ())):
+            if kind is not None and self._jobs[job_id].kind != kind:
+                continue
+            if job_id in self._running:
+                self._cancelled.add(job_id)
+            else:
+                self._forget(job_id)
+        session = await self.pool.get_connection()
+        try:
+            query = session.query(ScheduledJobDB).filter(
+                ScheduledJobDB.phone_number == phone_number
+            )
+            if kind is not None:
+                query = query.filter(ScheduledJobDB.kind == kind)
+            if self._running:
+                query = query.filter(ScheduledJobDB.job_id.notin_(self._running))
+            cancelled = query.delete(synchronize_session=False)
+            session.commit()
+            return cancelled
+        finally:
+            await self.pool.release_connection(session)
+
+    def pending(self, phone_number: Optional[str] = None) -> int:
+        """The number of jobs in memory (of a user, or of everyone)."""
+        if phone_number is None:
+            return len(self._jobs)
+        return len(self._by_phone.get(phone_number, ()))
+
+    def _push(self, job: ScheduledJob):
+        self._jobs[job.job_id] = job
+        self._by_phone.setdefault(job.phone_number, set()).add(job.job_id)
+        heapq.heappush(self._heap, (job.due_at, next(self._seq), job.job_id))
+        if self._heap[0][2] == job.job_id:
+            # Earlier than what the loop is waiting for
+            self._wake.set()
+
+    def _forget(self, job_id: str):
+        job = self._jobs.pop(job_id, None)
+        if job is None:
+            return
+        ids = self._by_phone.get(job.phone_number)
+        if ids is not None:
+            ids.discard(job_id)
+            if not ids:
+                del self._by_phone[job.phone_number]
+
+    async def _load(self, until: float):
+        """Load the jobs due before ``until`` that are not in memory yet."""
+        session = await self.pool.get_connection()
+        try:
+            query = session.query(ScheduledJobDB).filter(
+                ScheduledJobDB.due_at < _to_datetime(until)
+            )
+            if self._loaded_until:
+                query = query.filter(
+                    ScheduledJobDB.due_at >= _to_datetime(self._loaded_until)
+                )
+            rows = query.all()
+        finally:
+            await self.pool.release_connection(session)
+        for row in rows:
+            if row.job_id not in self._jobs:
+                self._push(_from_row(row))
+        self._loaded_until = until
+
+    def _pop_due(self, now: float) -> List[ScheduledJob]:
+        due = []
+        while self._heap and len(due) < self.batch_size and self._heap[0][0] <= now:
+            _, _, job_id = heapq.heappop(self._heap)
+            job = self._jobs.get(job_id)
+            # Skip cancelled jobs and stale entries of rescheduled ones
+            if job is not None and job_id not in self._running:
+                due.append(job)
+        return due
+
+    async def _run(self):
+        while True:
+            try:
+                await self._step()
+            except Exception as e:
+                # e.g. "database is locked": the jobs fire once the database is back
+                logger.error(f"Scheduler error, retrying in {self.error_delay}s: {e}")
+                await asyncio.sleep(self.error_delay)
+
+    async def _step(self):
+        """Fire the due jobs, or wait until the next one is due."""
+        now = time.time()
+        if now + self.horizon / 2 >= self._loaded_until:
+            await self._load(now + self.horizon)
+        due = self._pop_due(now)
+        for job in due:
+            await self._semaphore.acquire()
+            self._running.add(job.job_id)
+            task = asyncio.create_task(self._fire(job))
+            self._handlers.add(task)
+            task.add_done_callback(self._handlers.discard)
+        if due:
+            return
+
+        self._wake.clear()
+        wake_at = self._loaded_until - self.horizon / 2
+        if self._heap:
+            wake_at = min(wake_at, self._heap[0][0])
+        try:
+            await asyncio.wait_for(
+                self._wake.wait(), timeout=max(0.0, wake_at - time.time())
+            )
+        except asyncio.TimeoutError:
+            pass
+
+    def _run_done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Scheduler stopped firing jobs: {task.exception()!r}")
+
+    async def _fire(self, job: ScheduledJob):
+        try:
+            try:
+                await self.handler(job)
+            except Exception as e:
+                job.attempts += 1
+                if job.job_id in self._cancelled:
+                    logger.info(
+                        f"Cancelled job {job.job_id} for {job.phone_number} failed: {e}"
+                    )
+                elif job.attempts < self.max_attempts:
+                    logger.warning(
+                        f"Job {job.job_id} for {job.phone_number} failed ({e}), retrying"
+                    )
+                    await self._retry(job)
+                    return
+                else:
+                    logger.error(
+                        f"Job {job.job_id} for {job.phone_number} failed {job.attempts} times: {e}"
+                    )
+            self._finish(job.job_id)
+        finally:
+            self._running.discard(job.job_id)
+            self._cancelled.discard(job.job_id)
+            self._semaphore.release()
+
+    def _finish(self, job_id: str):
+        self._forget(job_id)
+        self._done.append(job_id)
+        if self._delete_task is None:
+            self._delete_task = asyncio.create_task(self._delete_done())
+
+    async def _retry(self, job: ScheduledJob):
+        job.due_at = time.time() + self.retry_delay
+        try:
+            session = await self.pool.get_connection()
+            try:
+                session.query(ScheduledJobDB).filter(
+                    ScheduledJobDB.job_id == job.job_id
+                ).update(
+                    {"due_at": _to_datetime(job.due_at), "attempts": job.attempts},
+                    synchronize_session=False,
+                )
+                session.commit()
+            finally:
+                await self.pool.release_connection(session)
+        except Exception as e:
+            # It fires again after a restart
+            logger.error(f"Error rescheduling job {job.job_id}: {e}")
+            self._forget(job.job_id)
+            return
+        if job.job_id in self._cancelled:
+            # Cancelled while it was rescheduled
+            self._finish(job.job_id)
+            return
+        self._forget(job.job_id)
+        if job.due_at < self._loaded_until:
+            self._running.discard(job.job_id)
+            self._push(job)
+
+    async def _delete_done(self):
+        """Delete the jobs that finished in the same event loop iteration in one statement."""
+        await asyncio.sleep(0)
+        try:
+            while self._done:
+                job_ids, self._done = self._done, []
+                session = await self.pool.get_connection()
+                try:
+                    session.query(ScheduledJobDB).filter(
+                        ScheduledJobDB.job_id.in_(job_ids)
+                    ).delete(synchronize_session=False)
+                    session.commit()
+                finally:
+                    await self.pool.release_connection(session)
+        except Exception as e:
+            # They fire again after a restart
+            logger.error(f"Error deleting {len(job_ids)} finished jobs: {e}")
+        finally:
+            self._delete_task = None
@@ -0,0 +1,135 @@
+"""Rule-based splitting of long replies into WhatsApp-sized messages, without an LLM call."""
+
+import re
+from typing import Callable, List, Optional, Tuple
+
+_PARAGRAPH_END = re.compile(r"\n\s*\n")
+_LINE_END = re.compile(r"\n")
+_SENTENCE_END = re.compile(r"[.!?…:;]+[)\]\"'»]*(?=\s)")
+_SPACE = re.compile(r" +")
+
+# Text that must not be cut: ```code blocks``` (also unterminated ones while streaming),
+# `inline code` and *bold*, _italic_ and ~strikethrough~ spans.
+_PROTECTED = re.compile(
+    r"```.*?(?:```|\Z)"
+    r"|`[^`\n]+`"
+    r"|(?<![\w*])\*(?=\S)[^*\n]*?(?<=\S)\*(?![\w*])"
+    r"|(?<![\w_])_(?=\S)[^_\n]*?(?<=\S)_(?![\w_])"
+    r"|(?<![\w~])~(?=\S)[^~\n]*?(?<=\S)~(?![\w~])",
+    re.DOTALL,
+)
+
+
+def _protected_spans(text: str) -> List[Tuple[int, int]]:
+    return [m.span() for m in _PROTECTED.finditer(text)]
+
+
+def _find_split(text: str, max_chars: int) -> int:
+    """Find where to cut ``text`` so that the first part fits in ``max_chars``.
+
+    Prefers the last paragraph break, then the last line break (e.g. between list items),
+    then the last sentence end, then the last space, never cutting through formatting.
+    """
+    window = text[: max_chars + 1]
+    spans = _protected_spans(text)
+
+    def allowed(cut: int) -> bool:
+        return 0 < cut <= max_chars and not any(start < cut < end for start, end in spans)
+
+    for pattern in (_PARAGRAPH_END, _LINE_END, _SENTENCE_END, _SPACE):
+        cuts = [m.end() for m in pattern.finditer(window) if allowed(m.end())]
+        if cuts:
+            return cuts[-1]
+    return max_chars
+
+
+class MessageSplitter:
+    """Cuts (streamed) text into WhatsApp-sized messages at natural boundaries.
+
+    Text is fed as it arrives. A message is emitted as soon as a paragraph of at least
+    ``min_chars`` is complete, or when the buffered text no longer fits in ``max_chars``.
+    Cuts prefer paragraph breaks, then list items and lines, then sentence ends, and never
+    fall inside code blocks or ``*bold*``, ``_italic_`` and ``~strikethrough~`` spans.
+
+    Example:
+
+        >>> splitter = MessageSplitter(max_chars=300)
+        >>> for delta in deltas:
+        ...     for message in splitter.feed(delta):
+        ...         send(message)
+        >>> for message in splitter.flush():
+        ...     send(message)
+    """
+
+    def __init__(self, max_chars: int = 300, min_chars: Optional[int] = None):
+        """
+        Args:
+            max_chars: The maximum length of a message.
+            min_chars: The minimum length of a paragraph to send it on its own
+                (defaults to a third of ``max_chars``).
+        """
+        self.max_chars = max_chars
+        self.min_chars = max_chars // 3 if min_chars is None else min_chars
+        self._buffer = ""
+
+    def _take(self, cut: int) -> Optional[str]:
+        message, self._buffer = self._buffer[:cut].strip(), self._buffer[cut:].lstrip()
+        return message or None
+
+    def feed(self, text: str) -> List[str]:
+        """Add text and return the messages that are complete."""
+        self._buffer += text
+        messages = []
+        while len(self._buffer) > self.max_chars:
+            message = self._take(_find_split(self._buffer, self.max_chars))
+            if message:
+                messages.append(message)
+        spans = _protected_spans(self._buffer)
+        breaks = [
+            m
+            for m in _PARAGRAPH_END.finditer(self._buffer)
+            if not any(start < m.end() < end for start, end in spans)
+        ]
+        if breaks and breaks[-1].start() >= self.min_chars:
+            message = self._take(breaks[-1].end())
+            if message:
+                messages.append(message)
+        return messages
+
+    def flush(self) -> List[str]:
+        """Return the rest of the text at the end of the stream."""
+        message = self._take(len(self._buffer))
+        return [message] if message else []
+
+
+def split_message(text: str, max_chars: int = 300) -> List[str]:
+    """Split a complete text into messages of at most ``max_chars`` (see :class:`MessageSplitter`)."""
+    splitter = MessageSplitter(max_chars=max_chars)
+    return splitter.feed(text) + splitter.flush()
+
+
+RewritePolicy = Callable[[str, List[str]], bool]
+"""Decides from a reply and its local split whether to rewrite the reply with the LLM."""
+
+
+def never_rewrite(content: str, messages: List[str]) -> bool:
+    """Always send the local split."""
+    return False
+
+
+def always_rewrite(content: str, messages: List[str]) -> bool:
+    """Always rewrite long replies with the LLM (the behavior before the local splitter)."""
+    return True
+
+
+def rewrite_if_more_than(max_messages: int) -> RewritePolicy:
+    """Rewrite with the LLM only when the local split needs more than ``max_messages`` messages.
+
+    Args:
+        max_messages: The largest number of messages to send without rewriting.
+    """
+
+    def policy(content: str, messages: List[str]) -> bool:
+        return len(messages) > max_messages
+
+    return policy
@@ -0,0 +1,221 @@
+"""Rolling summarization of long conversations.
+
+Once a conversation holds more than ``max_messages`` messages, its older messages are
+summarized in the background and replaced by a single summary message, so that reading
+a conversation and building its prompt stay bounded however old it gets.
+"""
+
+import asyncio
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Union,
+    TYPE_CHECKING,
+)
+
+from cachetools import LRUCache
+
+try:
+    from loguru import logger
+except ImportError:
+    import logging
+
+    logger = logging.getLogger(__name__)
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+    from .conversation_db import ConversationManager
+
+SUMMARY_PREFIX = "Summary of the earlier messages of this conversation: "
+
+SummarizeFunction = Callable[
+    [Optional[str], List[Dict[str, Any]]], Union[str, Awaitable[str]]
+]
+"""Receives the previous summary (if any) and the messages to compact, returns the new summary."""
+
+
+class RollingSummarizer:
+    """Compacts the older messages of long conversations into a running summary.
+
+    Set it on a :class:`~pywaai.conversation_db.ConversationManager`
+    (``rolling_summarizer=...``) and every write schedules a check. When a conversation
+    holds more than ``max_messages`` messages, a background task summarizes all but the
+    last ``keep_messages`` of them and swaps the summary in atomically (see
+    :meth:`~pywaai.conversation_db.ConversationHistory.compact`). Writes never wait for it.
+
+    Example:
+
+        >>> summarizer = RollingSummarizer(llm_summarizer(AsyncOpenAI()))
+        >>> manager = ConversationManager(rolling_summarizer=summarizer)
+    """
+
+    def __init__(
+        self,
+        summarize: SummarizeFunction,
+        max_messages: int = 60,
+        keep_messages: int = 20,
+        cache_size: int = 10_000,
+    ):
+        """
+        Args:
+            summarize: A (sync or async) function that receives the previous summary (or
+                ``None``) and the messages to compact, and returns the new summary.
+            max_messages: Compact conversations holding more messages than this.
+            keep_messages: How many recent messages to keep as they are.
+            cache_size: How many conversation sizes to track in memory.
+        """
+        if keep_messages >= max_messages:
+            raise ValueError("keep_messages must be smaller than max_messages")
+        self.summarize = summarize
+        self.max_messages = max_messages
+        self.keep_messages = keep_messages
+        # (phone_number, conversation_id) -> number of stored messages, as of the last check
+        self._sizes: "LRUCache[tuple[str, str], int]" = LRUCache(maxsize=cache_size)
+        self._tasks: Dict[tuple[str, str], asyncio.Task] = {}
+
+    def schedule(
+        self,
+        manager: "ConversationManager",
+        phone_number: str,
+        conversation_id: str,
+        added: int = 1,
+    ) -> Optional[asyncio.Task]:
+        """Note that messages were added, and start a compaction if the conversation is too long.
+
+        Returns:
+            The background task, or ``None`` if the conversation does not need compacting.
+        """
+        key = (phone_number, conversation_id)
+        size = self._sizes.get(key)
+        if size is not None:
+            self._sizes[key] = size + added
+            if size + added <= self.max_messages:
+                return None
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.create_task(
+                self._run(manager, phone_number, conversation_id)
+            )
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        return task
+
+    async def _run(
+        self, manager: "ConversationManager", phone_number: str, conversation_id: str
+    ):
+        try:
+            await self.compact(manager, phone_number, conversation_id)
+        except Exception as e:
+            logger.error(f"Error summarizing conversation {conversation_id}: {e}")
+            # Check again on the next write
+            self._sizes.pop((phone_number, conversation_id), None)
+
+    async def compact(
+        self, manager: "ConversationManager", phone_number: str, conversation_id: str
+    ) -> bool:
+        """Compact a conversation now if it holds more than ``max_messages`` messages.
+
+        Returns:
+            bool: Whether a summary was swapped in.
+        """
+        key = (phone_number, conversation_id)
+        compacted, messages = await manager.get_messages_with_offset(
+            phone_number, conversation_id
+        )
+        self._sizes[key] = len(messages)
+        if len(messages) <= self.max_messages:
+            return False
+
+        start = 1 if compacted else 0
+        upto = len(messages) - self.keep_messages
+        # Tool results stay with the assistant message that called them
+        while upto < len(messages) and messages[upto].get("role") == "tool":
+            upto += 1
+        if upto <= start:
+            return False
+
+        previous = None
+        if compacted:
+            previous = messages[0].get("content", "")
+            if previous.startswith(SUMMARY_PREFIX):
+                previous = previous[len(SUMMARY_PREFIX) :]
+        summary = self.summarize(previous, messages[start:upto])
+        if asyncio.iscoroutine(summary):
+            summary = await summary
+
+        swapped = await manager.history.compact(
+            phone_number,
+            conversation_id,
+            upto,
+            {"role": "system", "content": SUMMARY_PREFIX + summary},
+            expected_compacted=compacted,
+        )
+        if swapped:
+            # Messages added while summarizing were counted by schedule()
+            self._sizes[key] = self._sizes.get(key, len(messages)) - upto + 1
+            logger.info(
+                f"Compacted {upto - start} messages of conversation {conversation_id}"
+            )
+        else:
+            self._sizes.pop(key, None)
+        return swapped
+
+    async def wait(self):
+        """Wait for the running compactions (e.g. before shutting down)."""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks.values()), return_exceptions=True)
+
+
+def _format_transcript(messages: List[Dict[str, Any]]) -> str:
+    lines = []
+    for message in messages:
+        content = message.get("content")
+        if message.get("tool_calls"):
+            names = ", ".join(
+                (call.get("function") or {}).get("name", "?")
+                for call in message["tool_calls"]
+            )
+            content = f"{content or ''} [called {names}]".strip()
+        if content:
+            lines.append(f"{message.get('role')}: {content}")
+    return "\n".join(lines)
+
+
+def llm_summarizer(
+    openai_client: "AsyncOpenAI",
+    model: str = "gpt-4o-mini",
+    max_tokens: int = 500,
+) -> SummarizeFunction:
+    """Create a summarize function for :class:`RollingSummarizer` that uses an OpenAI model.
+
+    Args:
+        openai_client: The async OpenAI client.
+        model: The model to summarize with.
+        max_tokens: The maximum length of the summary.
+    """
+    prompt = (
+        "You maintain a running summary of a WhatsApp conversation between a user and an "
+        "assistant. Update the summary with the new messages. Keep every fact, name, "
+        "preference, decision and pending request that later messages may refer to. "
+        "Answer with the summary only, in the language of the conversation."
+    )
+
+    async def summarize(previous: Optional[str], messages: List[Dict[str, Any]]) -> str:
+        content = f"Current summary:\n{previous or '(none)'}\n\nNew messages:\n"
+        content += _format_transcript(messages)
+        response = await openai_client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": content},
+            ],
+            max_tokens=max_tokens,
+        )
+        return response.choices[0].message.content.strip()
+
+    return summarize
@@ -0,0 +1,780 @@
+import asyncio
+import json
+import os
+import time
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+from cachetools import LRUCache
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+from pywaai import ai_utils
+from pywaai.auth import TokenCache
+from pywaai.conversation_db import ConversationManager
+from pywaai.metrics import MetricsRegistry
+from pywaai.rate_limit import LLMLimiter, ModelLimits
+from pywaai.response_cache import ResponseCache
+
+
+class FakeConversationAPI:
+    """An in-memory implementation of the remote conversation API."""
+
+    def __init__(self):
+        self.messages: dict[str, list] = {}
+        self.requests: list[httpx.Request] = []
+        self.reject_next_token = False
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if request.url.path == "/oauth/token":
+            return httpx.Response(200, json={"access_token": "t", "expires_in": 3600})
+        if self.reject_next_token:
+            self.reject_next_token = False
+            return httpx.Response(401)
+        parts = request.url.path.strip("/").split("/")
+        if parts[-1] == "latest":
+            if not self.messages:
+                return httpx.Response(404)
+            return httpx.Response(200, json={"conversation_id": next(iter(self.messages))})
+        if len(parts) == 2:
+            self.messages["c1"] = []
+            return httpx.Response(200, json={"conversation_id": "c1"})
+        messages = self.messages[parts[2]]
+        if request.method == "POST":
+            body = json.loads(request.content)
+            messages.extend(body if isinstance(body, list) else [body])
+            return httpx.Response(200, json={}, headers=self._cursor_headers(messages))
+        since = int(request.url.params.get("since", 0))
+        headers = self._cursor_headers(messages)
+        if request.headers.get("If-None-Match") == headers["ETag"]:
+            return httpx.Response(304, headers=headers)
+        return httpx.Response(200, json=messages[since:], headers=headers)
+
+    @staticmethod
+    def _cursor_headers(messages: list) -> dict:
+        return {"X-Next-Cursor": str(len(messages)), "ETag": f'"{len(messages)}"'}
+
+
+@pytest.fixture
+def remote_api(monkeypatch):
+    api = FakeConversationAPI()
+    client = httpx.AsyncClient(transport=httpx.MockTransport(api.handler))
+    monkeypatch.setattr(
+        ai_utils, "_token_cache", TokenCache(domain="auth.test", http_client=client)
+    )
+    monkeypatch.setattr(ai_utils, "_remote_tails", LRUCache(maxsize=16))
+    return api, client
+
+
+@pytest.mark.asyncio
+async def test_remote_conversation_reuses_pooled_client(remote_api):
+    api, client = remote_api
+    conv = ai_utils.LocalOrRemoteConversation(
+        phone_number="123",
+        use_remote_api=True,
+        remote_base_url="http://conversations.test",
+        http_client=client,
+    )
+    await conv.append_message({"role": "user", "content": "Hi"})
+    await conv.append_message({"role": "assistant", "content": "Hello"})
+    assert [m["content"] for m in await conv.get_messages()] == ["Hi", "Hello"]
+    # A single token fetch for the whole conversation
+    assert [r.url.path for r in api.requests].count("/oauth/token") == 1
+    await conv.aclose()
+    assert not client.is_closed
+
+
+@pytest.mark.asyncio
+async def test_remote_conversation_retries_with_new_token(remote_api):
+    api, client = remote_api
+    conv = ai_utils.LocalOrRemoteConversation(
+        phone_number="123",
+        use_remote_api=True,
+        remote_base_url="http://conversations.test",
+        http_client=client,
+    )
+    await conv.get_or_create_conversation_id()
+    api.reject_next_token = True
+    await conv.append_message({"role": "user", "content": "Hi"})
+    await conv.flush()
+    assert api.messages["c1"] == [{"role": "user", "content": "Hi"}]
+    assert [r.url.path for r in api.requests].count("/oauth/token") == 2
+
+
+@pytest.mark.asyncio
+async def test_remote_messages_are_synced_incrementally(remote_api):
+    api, client = remote_api
+
+    def conversation():
+        return ai_utils.LocalOrRemoteConversation(
+            phone_number="123",
+            use_remote_api=True,
+            remote_base_url="http://conversations.test",
+            http_client=client,
+            buffer_writes=True,
+        )
+
+    first = conversation()
+    await first.append_message({"role": "user", "content": "1"})
+    await first.append_message({"role": "assistant", "content": "2"})
+    assert len(await first.get_messages()) == 2
+    # Both buffered messages were sent in one request
+    posts = [r for r in api.requests if r.method == "POST" and "messages" in r.url.path]
+    assert len(posts) == 1
+
+    # The next turn only fetches what is new
+    second = conversation()
+    api.messages["c1"].append({"role": "user", "content": "3"})
+    assert [m["content"] for m in await second.get_messages()] == ["1", "2", "3"]
+    assert api.requests[-1].url.params["since"] == "2"
+
+    await second.append_message({"role": "assistant", "content": "4"})
+    await second.flush()
+    requests_before = len(api.requests)
+    assert len(await second.get_messages()) == 4
+    # Our own flush advanced the cursor, so the server answers 304
+    assert len(api.requests) == requests_before + 1
+
+
+@pytest.mark.asyncio
+async def test_remote_messages_are_written_through_by_default(remote_api):
+    api, client = remote_api
+    conv = ai_utils.LocalOrRemoteConversation(
+        phone_number="123",
+        use_remote_api=True,
+        remote_base_url="http://conversations.test",
+        http_client=client,
+    )
+    await conv.append_message({"role": "user", "content": "Hi"})
+    await conv.extend_messages([{"role": "assistant", "content": "Hello"}])
+    # Stored without a flush or a read
+    assert [m["content"] for m in api.messages["c1"]] == ["Hi", "Hello"]
+
+
+@pytest.mark.asyncio
+async def test_owned_client_is_closed_on_exit():
+    async with ai_utils.LocalOrRemoteConversation(
+        phone_number="123", use_remote_api=True, remote_base_url="http://x"
+    ) as conv:
+        client = conv.http_client
+    assert client.is_closed
+
+
+def _tool_call(name: str, **arguments):
+    return SimpleNamespace(
+        function=SimpleNamespace(name=name, arguments=json.dumps(arguments))
+    )
+
+
+def _schema(name: str) -> dict:
+    return {
+        "name": name,
+        "parameters": {"type": "object", "properties": {"value": {"type": "string"}}},
+    }
+
+
+class SlowTool:
+    openai_schema = _schema("SlowTool")
+
+    def __init__(self, value: str):
+        self.value = value
+
+    async def run(self):
+        await asyncio.sleep(0.1)
+        return self.value
+
+
+class SyncTool:
+    openai_schema = _schema("SyncTool")
+
+    def __init__(self, value: str):
+        self.value = value
+
+    def run(self):
+        time.sleep(0.1)
+        return self.value.upper()
+
+
+class FailingTool:
+    def run(self):
+        raise RuntimeError("boom")
+
+
+class HangingTool:
+    timeout = 0.05
+
+    async def run(self):
+        await asyncio.sleep(10)
+
+
+@pytest.mark.asyncio
+async def test_execute_tools_runs_concurrently_in_order():
+    calls = [
+        _tool_call("SlowTool", value="a"),
+        _tool_call("SyncTool", value="b"),
+        _tool_call("SlowTool", value="c"),
+    ]
+    start = time.perf_counter()
+    results = await ai_utils.execute_tools(calls, [SlowTool, SyncTool])
+    assert results == ["a", "B", "c"]
+    assert time.perf_counter() - start < 0.25
+
+
+@pytest.mark.asyncio
+async def test_execute_tools_captures_errors():
+    calls = [
+        _tool_call("FailingTool"),
+        _tool_call("HangingTool"),
+        _tool_call("MissingTool"),
+        _tool_call("SlowTool", value="ok"),
+    ]
+    results = await ai_utils.execute_tools(calls, [FailingTool, HangingTool, SlowTool])
+    assert results[0] == "Error: tool FailingTool failed: boom"
+    assert results[1] == "Error: tool HangingTool timed out"
+    assert results[2] == "Error: unknown tool MissingTool"
+    assert results[3] == "ok"
+
+
+def _completion(content=None, tool_calls=(), usage=None):
+    return ChatCompletion.model_validate(
+        {
+            "id": "chatcmpl-test",
+            "usage": usage,
+            "object": "chat.completion",
+            "created": 0,
+            "model": "gpt-test",
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "tool_calls" if tool_calls else "stop",
+                    "message": {
+                        "role": "assistant",
+                        "content": content,
+                        "tool_calls": [
+                            {
+                                "id": f"call_{i}",
+                                "type": "function",
+                                "function": {"name": name, "arguments": json.dumps(args)},
+                            }
+                            for i, (name, args) in enumerate(tool_calls)
+                        ]
+                        or None,
+                    },
+                }
+            ],
+        }
+    )
+
+
+class ScriptedOpenAI:
+    """Returns the given completions in order and records the requests."""
+
+    def __init__(self, *completions):
+        self.completions = list(completions)
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **kwargs):
+        self.requests.append({**kwargs, "messages": list(kwargs["messages"])})
+        return self.completions.pop(0)
+
+
+@pytest.mark.asyncio
+async def test_generate_response_runs_multiple_tool_rounds(tmp_path):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    client = ScriptedOpenAI(
+        _completion(tool_calls=[("SlowTool", {"value": "a"}), ("SyncTool", {"value": "b"})]),
+        _completion(tool_calls=[("SlowTool", {"value": "c"})]),
+        _completion("Done"),
+    )
+    responses = await ai_utils.generate_response(
+        phone_number="123",
+        message_text="Hi",
+        user_name="Test",
+        openai_client=client,
+        tool_functions=[SlowTool, SyncTool],
+        conversation_manager=manager,
+    )
+    assert responses == [{"role": "assistant", "content": "Done"}]
+
+    await ai_utils.wait_for_pending_writes()
+    cid = await manager.get_active_conversation_id("123")
+    stored = await manager.get_messages("123", cid)
+    assert [m["role"] for m in stored] == [
+        "user", "assistant", "tool", "tool", "assistant", "tool", "assistant"
+    ]
+    assert [m["content"] for m in stored if m["role"] == "tool"] == ["a", "B", "c"]
+    # The last request saw all tool results without re-reading the history
+    assert client.requests[-1]["messages"][1:] == stored[:-1]
+    await manager.history.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_generate_response_stops_after_max_tool_rounds(tmp_path):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    client = ScriptedOpenAI(
+        _completion(tool_calls=[("SlowTool", {"value": "a"})]),
+        _completion("Final"),
+    )
+    await ai_utils.generate_response(
+        phone_number="123",
+        message_text="Hi",
+        user_name="Test",
+        openai_client=client,
+        tool_functions=[SlowTool],
+        conversation_manager=manager,
+        max_tool_rounds=1,
+    )
+    assert "tools" in client.requests[0]
+    assert "tools" not in client.requests[1]
+    await ai_utils.wait_for_pending_writes()
+    await manager.history.pool.close_all()
+
+
+
+class SlowManager(ConversationManager):
+    """Writes take ``delay`` seconds, and the first ``failures`` writes fail."""
+
+    def __init__(self, *args, delay=0.0, failures=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.delay = delay
+        self.failures = failures
+
+    async def add_messages(self, phone_number, messages, conversation_id):
+        await asyncio.sleep(self.delay)
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("database is locked")
+        return await super().add_messages(phone_number, messages, conversation_id)
+
+
+@pytest.mark.asyncio
+async def test_replies_are_stored_off_the_critical_path(tmp_path):
+    manager = SlowManager(db_path=str(tmp_path / "conversations.db"), delay=0.1)
+    client = ScriptedOpenAI(_completion("Hello"), _completion("Bye"))
+
+    async def ask(text):
+        return await ai_utils.generate_response(
+            phone_number="123",
+            message_text=text,
+            user_name="Test",
+            openai_client=client,
+            conversation_manager=manager,
+        )
+
+    start = time.monotonic()
+    assert await ask("Hi") == [{"role": "assistant", "content": "Hello"}]
+    assert time.monotonic() - start < 0.1
+    # The next turn reads the history once the previous one is stored
+    await ask("Bye")
+    assert [m["content"] for m in client.requests[1]["messages"][1:]] == [
+        "Hi", "Hello", "Bye"
+    ]
+    await ai_utils.wait_for_pending_writes()
+    cid = await manager.get_active_conversation_id("123")
+    stored = await manager.get_messages("123", cid)
+    assert [m["content"] for m in stored] == ["Hi", "Hello", "Bye", "Bye"]
+    await manager.history.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_failed_writes_are_retried(tmp_path):
+    manager = SlowManager(db_path=str(tmp_path / "conversations.db"), failures=2)
+    await ai_utils.generate_response(
+        phone_number="123",
+        message_text="Hi",
+        user_name="Test",
+        openai_client=ScriptedOpenAI(_completion("Hello")),
+        conversation_manager=manager,
+    )
+    await ai_utils.wait_for_pending_writes()
+    cid = await manager.get_active_conversation_id("123")
+    stored = await manager.get_messages("123", cid)
+    assert [m["content"] for m in stored] == ["Hi", "Hello"]
+    await manager.history.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_unstored_messages_are_kept_for_the_next_turn(tmp_path):
+    manager = SlowManager(db_path=str(tmp_path / "conversations.db"), failures=3)
+    client = ScriptedOpenAI(_completion("Hello"), _completion("Bye"))
+
+    async def ask(text):
+        return await ai_utils.generate_response(
+            phone_number="123",
+            message_text=text,
+            user_name="Test",
+            openai_client=client,
+            conversation_manager=manager,
+        )
+
+    await ask("Hi")
+    with pytest.raises(RuntimeError, match="2 messages could not be stored"):
+        await ai_utils.wait_for_pending_writes()
+    # The next turn sees them, and stores them first
+    await ask("Bye")
+    assert [m["content"] for m in client.requests[1]["messages"][1:]] == [
+        "Hi", "Hello", "Bye"
+    ]
+    await ai_utils.wait_for_pending_writes()
+    cid = await manager.get_active_conversation_id("123")
+    stored = await manager.get_messages("123", cid)
+    assert [m["content"] for m in stored] == ["Hi", "Hello", "Bye", "Bye"]
+    await manager.history.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_turns_only_wait_for_the_writes_of_their_store(tmp_path):
+    slow = SlowManager(db_path=str(tmp_path / "slow.db"), delay=0.2)
+    fast = ConversationManager(db_path=str(tmp_path / "fast.db"))
+    client = ScriptedOpenAI(_completion("Hello"), _completion("Hello"))
+    for manager in (slow, fast):
+        start = time.monotonic()
+        await ai_utils.generate_response(
+            phone_number="123",
+            message_text="Hi",
+            user_name="Test",
+            openai_client=client,
+            conversation_manager=manager,
+        )
+        assert time.monotonic() - start < 0.15
+    await ai_utils.wait_for_pending_writes()
+    await slow.history.pool.close_all()
+    await fast.history.pool.close_all()
+
+
+def _chunk(content=None, tool_calls=None):
+    delta = {"role": "assistant"}
+    if content is not None:
+        delta["content"] = content
+    if tool_calls is not None:
+        delta["tool_calls"] = tool_calls
+    return ChatCompletionChunk.model_validate(
+        {
+            "id": "chatcmpl-test",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "gpt-test",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+        }
+    )
+
+
+class StreamingOpenAI(ScriptedOpenAI):
+    """Streams the given rounds of chunks; a chunk can be an event to wait for."""
+
+    async def create(self, **kwargs):
+        assert kwargs["stream"] is True
+        self.requests.append({**kwargs, "messages": list(kwargs["messages"])})
+        chunks = self.completions.pop(0)
+
+        async def stream():
+            for chunk in chunks:
+                if isinstance(chunk, asyncio.Event):
+                    await chunk.wait()
+                else:
+                    yield chunk
+
+        return stream()
+
+
+@pytest.mark.asyncio
+async def test_stream_yields_first_message_before_completion_ends(tmp_path):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    rest_of_stream = asyncio.Event()
+    first = "Hola! Este es el primer párrafo de la respuesta.\n\n"
+    client = StreamingOpenAI(
+        [_chunk(first[:20]), _chunk(first[20:]), rest_of_stream, _chunk("Y el segundo.")]
+    )
+    stream = ai_utils.generate_response_stream(
+        phone_number="123",
+        message_text="Hi",
+        user_name="Test",
+        openai_client=client,
+        conversation_manager=manager,
+        max_message_chars=60,
+    )
+    first_message = await asyncio.wait_for(stream.__anext__(), 1)
+    assert first_message["content"] == first.strip()
+
+    rest_of_stream.set()
+    assert [m["content"] async for m in stream] == ["Y el segundo."]
+
+    await ai_utils.wait_for_pending_writes()
+    cid = await manager.get_active_conversation_id("123")
+    stored = await manager.get_messages("123", cid)
+    assert stored[-1] == {"role": "assistant", "content": first + "Y el segundo."}
+    await manager.history.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_stream_releases_the_limiter_while_the_caller_sends(tmp_path, monkeypatch):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    limiter = LLMLimiter({"gpt-4o": ModelLimits(max_concurrency=1)})
+    monkeypatch.setattr(ai_utils, "get_llm_limiter", lambda: limiter)
+    first = "Hola! Este es el primer párrafo de la respuesta.\n\n"
+    client = StreamingOpenAI([_chunk(first), _chunk("Y el segundo.")])
+    stream = ai_utils.generate_response_stream(
+        phone_number="123",
+        message_text="Hi",
+        user_name="Test",
+        openai_client=client,
+        conversation_manager=manager,
+        max_message_chars=60,
+    )
+    assert (await stream.__anext__())["content"] == first.strip()
+    # The caller is still sending the first message, but the model is done
+    await asyncio.sleep(0.01)
+    assert limiter.stats("gpt-4o") == {"in_flight": 0, "queued": 0}
+    assert [m["content"] async for m in stream] == ["Y el segundo."]
+    await ai_utils.wait_for_pending_writes()
+    await manager.history.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_stream_runs_streamed_tool_calls(tmp_path):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+
+    def call_delta(**fields):
+        return {"index": 0, "type": "function", **fields}
+
+    client = StreamingOpenAI(
+        [
+            _chunk(tool_calls=[call_delta(id="call_0", function={"name": "SlowTool", "arguments": ""})]),
+            _chunk(tool_calls=[call_delta(function={"arguments": '{"value": '})]),
+            _chunk(tool_calls=[call_delta(function={"arguments": '"sunny"}'})]),
+        ],
+        [_chunk("It is "), _chunk("sunny.")],
+    )
+    messages = [
+        m["content"]
+        async for m in ai_utils.generate_response_stream(
+            phone_number="123",
+            message_text="Weather?",
+            user_name="Test",
+            openai_client=client,
+            tool_functions=[SlowTool],
+            conversation_manager=manager,
+        )
+    ]
+    assert messages == ["It is sunny."]
+
+    await ai_utils.wait_for_pending_writes()
+    cid = await manager.get_active_conversation_id("123")
+    stored = await manager.get_messages("123", cid)
+    assert [m["role"] for m in stored] == ["user", "assistant", "tool", "assistant"]
+    assert stored[1]["tool_calls"][0]["function"]["arguments"] == '{"value": "sunny"}'
+    assert stored[2] == {"role": "tool", "content": "sunny", "tool_call_id": "call_0"}
+    await manager.history.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_long_replies_are_split_locally(tmp_path):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    reply = "Primera parte de la respuesta.\n\n" + "Una frase más. " * 30
+    client = ScriptedOpenAI(_completion(reply))
+    responses = await ai_utils.generate_response(
+        phone_number="123",
+        message_text="Hi",
+        user_name="Test",
+        openai_client=client,
+        conversation_manager=manager,
+        max_message_chars=200,
+    )
+    assert len(client.requests) == 1
+    assert len(responses) > 1
+    assert all(len(r["content"]) <= 200 for r in responses)
+
+    await ai_utils.wait_for_pending_writes()
+    cid = await manager.get_active_conversation_id("123")
+    stored = await manager.get_messages("123", cid)
+    assert stored[-1] == {"role": "assistant", "content": reply.strip()}
+    await manager.history.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_prompt_is_trimmed_to_the_token_budget(tmp_path):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    cid = await manager.get_active_conversation_id("123")
+    await manager.add_messages(
+        "123", [{"role": "user", "content": "palabra " * 200}] * 10, cid
+    )
+    client = ScriptedOpenAI(_completion("Ok"))
+    await ai_utils.generate_response(
+        phone_number="123",
+        message_text="Hi",
+        user_name="Test",
+        openai_client=client,
+        conversation_manager=manager,
+        max_prompt_tokens=1000,
+    )
+    sent = client.requests[0]["messages"]
+    assert sent[0]["role"] == "system"
+    assert sent[-1] == {"role": "user", "content": "Hi"}
+    assert 1 < len(sent) < 12
+
+    # Without a budget the whole history is sent
+    client = ScriptedOpenAI(_completion("Ok"))
+    await ai_utils.generate_response(
+        phone_number="123",
+        message_text="Hi",
+        user_name="Test",
+        openai_client=client,
+        conversation_manager=manager,
+    )
+    assert len(client.requests[0]["messages"]) == 14
+    await ai_utils.wait_for_pending_writes()
+    await manager.history.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_repeated_questions_are_answered_from_the_cache(tmp_path):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    client = ScriptedOpenAI(_completion("We open at 9."), _completion("Yes."))
+    cache = ResponseCache()
+
+    async def ask(phone_number, text, user_name="Test", **kwargs):
+        return await ai_utils.generate_response(
+            phone_number=phone_number,
+            message_text=text,
+            user_name=user_name,
+            openai_client=client,
+            conversation_manager=manager,
+            response_cache=cache,
+            **kwargs,
+        )
+
+    assert await ask("1", "When do you open?") == [
+        {"role": "assistant", "content": "We open at 9."}
+    ]
+    # Shared by other users, whatever their name
+    assert await ask("2", "when do you open", user_name="Ana") == [
+        {"role": "assistant", "content": "We open at 9."}
+    ]
+    assert len(client.requests) == 1
+    await ai_utils.wait_for_pending_writes()
+    cid = await manager.get_active_conversation_id("2")
+    assert (await manager.get_messages("2", cid))[-1]["content"] == "We open at 9."
+    # But not across scopes
+    client.completions.insert(0, _completion("Abrimos a las 9."))
+    assert await ask("4", "When do you open?", cache_scope="es") == [
+        {"role": "assistant", "content": "Abrimos a las 9."}
+    ]
+    assert len(client.requests) == 2
+
+    # The history matters in an ongoing conversation
+    await ask("1", "When do you open?")
+    assert len(client.requests) == 3
+    # And tools bypass the cache
+    client.completions.append(_completion("We open at 9."))
+    await ask("3", "When do you open?", tool_functions=[SlowTool])
+    assert len(client.requests) == 4
+
+
+@pytest.mark.asyncio
+async def test_replies_that_mention_the_user_are_not_cached(tmp_path):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    client = ScriptedOpenAI(_completion("Hi Ana!"), _completion("Hi Bob!"))
+    cache = ResponseCache()
+
+    async def ask(phone_number, user_name):
+        return await ai_utils.generate_response(
+            phone_number=phone_number,
+            message_text="Hello, who am I?",
+            user_name=user_name,
+            openai_client=client,
+            conversation_manager=manager,
+            response_cache=cache,
+        )
+
+    assert await ask("1", "Ana") == [{"role": "assistant", "content": "Hi Ana!"}]
+    assert await ask("2", "Bob") == [{"role": "assistant", "content": "Hi Bob!"}]
+    assert len(client.requests) == 2
+    await ai_utils.wait_for_pending_writes()
+    await manager.history.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_calls_pause_the_model_and_retry(tmp_path, monkeypatch):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    limiter = LLMLimiter()
+    monkeypatch.setattr(ai_utils, "get_llm_limiter", lambda: limiter)
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    rate_limited = openai.RateLimitError(
+        "Rate limited",
+        response=httpx.Response(429, headers={"retry-after": "0.05"}, request=request),
+        body=None,
+    )
+    client = ScriptedOpenAI(_completion("Ok"))
+    create = client.create
+
+    async def create_once_rate_limited(**kwargs):
+        if not client.requests:
+            client.requests.append(kwargs)
+            raise rate_limited
+        return await create(**kwargs)
+
+    client.chat.completions.create = create_once_rate_limited
+    start = time.monotonic()
+    responses = await ai_utils.generate_response(
+        phone_number="123",
+        message_text="Hi",
+        user_name="Test",
+        openai_client=client,
+        conversation_manager=manager,
+    )
+    assert responses == [{"role": "assistant", "content": "Ok"}]
+    assert len(client.requests) == 2
+    assert time.monotonic() - start >= 0.04
+    assert limiter.stats("gpt-4o") == {"in_flight": 0, "queued": 0}
+    await ai_utils.wait_for_pending_writes()
+    await manager.history.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_turn_metrics_are_recorded(tmp_path):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    usage = {"prompt_tokens": 30, "completion_tokens": 5, "total_tokens": 35}
+    client = ScriptedOpenAI(
+        _completion(tool_calls=[("SlowTool", {"value": "a"})], usage=usage),
+        _completion("Done", usage=usage),
+    )
+    registry = MetricsRegistry()
+    await ai_utils.generate_response(
+        phone_number="123",
+        message_text="Hi",
+        user_name="Test",
+        openai_client=client,
+        tool_functions=[SlowTool],
+        conversation_manager=manager,
+        metrics=registry,
+    )
+    await ai_utils.wait_for_pending_writes()
+    cid = await manager.get_active_conversation_id("123")
+    stats = registry.conversation("123", cid)
+    assert (stats.turns, stats.llm_calls) == (1, 2)
+    assert (stats.prompt_tokens, stats.completion_tokens) == (60, 10)
+    stages = {s["stage"] for s in registry.to_dict()["stages"]}
+    assert stages == {"db_read", "llm", "tools", "db_write"}
+    await manager.history.pool.close_all()
+
+
+def test_update_token_count_is_deprecated(monkeypatch):
+    registry = MetricsRegistry()
+    monkeypatch.setattr(ai_utils, "get_metrics_registry", lambda: registry)
+    usage = SimpleNamespace(prompt_tokens=30, completion_tokens=5, total_tokens=35)
+    with pytest.warns(DeprecationWarning):
+        ai_utils.update_token_count(SimpleNamespace(model="gpt-4o", usage=usage))
+    assert registry.to_dict()["llm"] == [
+        {
+            "model": "gpt-4o",
+            "stage": "shortener",
+            "calls": 1,
+            "prompt_tokens": 30,
+            "completion_tokens": 5,
+        }
+    ]
@@ -0,0 +1,78 @@
+import asyncio
+
+import httpx
+import pytest
+
+from pywaai import http_client
+from pywaai.auth import TokenCache
+
+
+def _token_cache(expires_in: int, refresh_margin: float = 60.0):
+    requests = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        await asyncio.sleep(0.01)
+        return httpx.Response(
+            200,
+            json={"access_token": f"token-{len(requests)}", "expires_in": expires_in},
+        )
+
+    cache = TokenCache(
+        domain="example.auth0.com",
+        client_id="id",
+        client_secret="secret",
+        audience="conversations",
+        refresh_margin=refresh_margin,
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+    )
+    return cache, requests
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_share_one_fetch():
+    cache, requests = _token_cache(expires_in=3600)
+    tokens = await asyncio.gather(*(cache.get_token() for _ in range(10)))
+    assert set(tokens) == {"token-1"}
+    assert await cache.get_token() == "token-1"
+    assert len(requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_refreshes_before_expiry_in_background():
+    cache, requests = _token_cache(expires_in=30, refresh_margin=60)
+    assert await cache.get_token() == "token-1"
+    # Within the refresh margin: the current token is returned while a new one is fetched
+    assert await cache.get_token() == "token-1"
+    await asyncio.sleep(0.05)
+    assert await cache.get_token() == "token-2"
+
+
+@pytest.mark.asyncio
+async def test_expired_token_is_refetched():
+    cache, requests = _token_cache(expires_in=0, refresh_margin=0)
+    assert await cache.get_token() == "token-1"
+    assert await cache.get_token() == "token-2"
+    cache.invalidate()
+    assert await cache.get_token() == "token-3"
+
+
+@pytest.mark.asyncio
+async def test_shared_client_is_resolved_on_each_fetch(monkeypatch):
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, json={"access_token": "token", "expires_in": 0})
+
+    monkeypatch.setattr(http_client, "_http_client", None)
+    monkeypatch.setattr(
+        http_client,
+        "create_http_client",
+        lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+    )
+    cache = TokenCache(
+        domain="example.auth0.com", refresh_margin=0, http_client=http_client.get_http_client
+    )
+    assert await cache.get_token() == "token"
+    # After a shutdown and restart, the new shared client is used
+    await http_client.close_http_client()
+    assert await cache.get_token() == "token"
+    await http_client.close_http_client()
@@ -0,0 +1,148 @@
+import asyncio
+import os
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+from pywaai import ai_utils
+from pywaai.coalescer import MessageCoalescer
+from pywaai.conversation_db import ConversationManager
+from pywaai.fake_openai import FakeOpenAI, FakeReply, constant_latency
+
+
+class Recorder:
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.batches = []
+        self.cancelled = []
+
+    async def __call__(self, wa_id, messages):
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled.append((wa_id, messages))
+            raise
+        self.batches.append((wa_id, messages))
+
+
+@pytest.mark.asyncio
+async def test_quick_messages_are_handled_together():
+    handler = Recorder()
+    coalescer = MessageCoalescer(handler, min_delay=0.05, max_delay=0.2)
+    for text in ("hi", "one question"):
+        coalescer.add("1", text)
+        await asyncio.sleep(0.01)
+    coalescer.add("2", "hello")
+    coalescer.add("1", "do you ship to Lima?")
+    assert coalescer.pending("1") == 3
+    await asyncio.sleep(0.15)
+    assert sorted(handler.batches) == [
+        ("1", ["hi", "one question", "do you ship to Lima?"]),
+        ("2", ["hello"]),
+    ]
+    # Idle users hold no state
+    assert coalescer._states == {}
+
+
+@pytest.mark.asyncio
+async def test_window_adapts_to_the_typing_speed():
+    coalescer = MessageCoalescer(Recorder(), min_delay=0.05, max_delay=1.0)
+    assert coalescer.window("1") == 0.05
+    for _ in range(4):
+        coalescer.add("1", "...")
+        await asyncio.sleep(0.2)
+    assert 0.25 < coalescer.window("1") < 0.35
+    await coalescer.wait()
+
+
+@pytest.mark.asyncio
+async def test_batches_are_bounded_by_size_and_wait():
+    handler = Recorder()
+    coalescer = MessageCoalescer(
+        handler, min_delay=0.05, max_delay=0.05, max_messages=3
+    )
+    for i in range(3):
+        coalescer.add("1", i)
+    # Handled without waiting for the window
+    await asyncio.sleep(0.01)
+    assert handler.batches == [("1", [0, 1, 2])]
+
+    # Messages every 40ms never leave a 60ms gap, but a batch waits at most 100ms
+    loop = asyncio.get_running_loop()
+    added_at, handled = {}, []
+
+    async def record(wa_id, messages):
+        handled.append((loop.time(), messages))
+
+    coalescer = MessageCoalescer(record, min_delay=0.06, max_delay=0.06, max_wait=0.1)
+    for i in range(6):
+        added_at[i] = loop.time()
+        coalescer.add("2", i)
+        await asyncio.sleep(0.04)
+    await coalescer.wait()
+    # The exact split depends on the timers, but every message is handled once, in
+    # order, and the batches are cut by max_wait (slack for a slow event loop)
+    batches = [messages for _, messages in handled]
+    assert [i for batch in batches for i in batch] == list(range(6))
+    assert len(batches) >= 2
+    assert max(at - added_at[batch[0]] for at, batch in handled) < 0.1 + 0.1
+
+
+@pytest.mark.asyncio
+async def test_new_messages_cancel_the_outdated_reply():
+    handler = Recorder(delay=0.1)
+    coalescer = MessageCoalescer(handler, min_delay=0.02, max_delay=0.02)
+    coalescer.add("1", "hi")
+    await asyncio.sleep(0.05)
+    coalescer.add("1", "are you there?")
+    await coalescer.wait()
+    assert handler.cancelled == [("1", ["hi"])]
+    assert handler.batches == [("1", ["hi", "are you there?"])]
+
+
+@pytest.mark.asyncio
+async def test_running_replies_can_finish_first():
+    handler = Recorder(delay=0.1)
+    coalescer = MessageCoalescer(
+        handler, min_delay=0.02, max_delay=0.02, cancel_superseded=False
+    )
+    coalescer.add("1", "hi")
+    await asyncio.sleep(0.05)
+    coalescer.add("1", "are you there?")
+    await asyncio.sleep(0.05)
+    # Not handled concurrently with the running batch
+    assert handler.batches == []
+    await coalescer.wait()
+    assert handler.cancelled == []
+    assert handler.batches == [("1", ["hi"]), ("1", ["are you there?"])]
+
+
+@pytest.mark.asyncio
+async def test_stored_messages_are_not_handled_again(tmp_path):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    client = FakeOpenAI(lambda request: FakeReply("Hello"), latency=constant_latency(0.2))
+    batches = []
+
+    async def reply(wa_id, texts):
+        batches.append(texts)
+        await ai_utils.generate_response(
+            phone_number=wa_id,
+            message_text="\n".join(texts),
+            user_name="Test",
+            openai_client=client,
+            conversation_manager=manager,
+        )
+
+    coalescer = MessageCoalescer(reply, min_delay=0.02, max_delay=0.02)
+    coalescer.add("123", "hi")
+    # Cancels the reply to "hi", which was stored before the model was called
+    await asyncio.sleep(0.1)
+    coalescer.add("123", "are you there?")
+    await coalescer.wait()
+    await ai_utils.wait_for_pending_writes()
+    assert batches == [["hi"], ["are you there?"]]
+    cid = await manager.get_active_conversation_id("123")
+    stored = await manager.get_messages("123", cid)
+    assert [m["content"] for m in stored] == ["hi", "are you there?", "Hello"]
+    await manager.history.pool.close_all()
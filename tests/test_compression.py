@@ -0,0 +1,92 @@
+import sqlite3
+
+import pytest
+
+from pywaai.conversation_db import ConversationHistory, ConversationManager
+
+pytest.importorskip("zstandard")
+
+from pywaai.compression import MessageCompressor
+
+
+async def _fill(manager: ConversationManager, count: int) -> list[str]:
+    conversation_ids = []
+    for i in range(count):
+        conversation = await manager.create_conversation(f"+1555000{i:04d}")
+        for j in range(3):
+            await manager.add_message(
+                conversation.phone_number,
+                {"role": "user", "content": f"Hola, quiero saber el estado del pedido {i * 7 + j}"},
+                conversation.conversation_id,
+            )
+        conversation_ids.append(conversation.conversation_id)
+    return conversation_ids
+
+
+@pytest.mark.asyncio
+async def test_compressed_round_trip_and_recompress(tmp_path):
+    db_path = str(tmp_path / "conversations.db")
+    history = ConversationHistory(db_path, compressor=MessageCompressor())
+    manager = ConversationManager(history=history)
+    await manager.init_db()
+    conversation_ids = await _fill(manager, 200)
+
+    dictionary_id = await history.train_compression_dictionary()
+    assert dictionary_id == 1
+    assert await history.recompress() == 200
+    assert await history.recompress() == 0
+
+    messages = await manager.get_messages("+15550000003", conversation_ids[3])
+    assert messages[2]["content"] == "Hola, quiero saber el estado del pedido 23"
+
+    with sqlite3.connect(db_path) as conn:
+        (stored,) = conn.execute(
+            "SELECT messages FROM conversations WHERE conversation_id = ?",
+            (conversation_ids[3],),
+        ).fetchone()
+    assert history.compressor.dictionary_id_of(stored) == dictionary_id
+    await history.pool.close_all()
+
+    # A fresh process loads the dictionaries back from the database
+    reopened = ConversationHistory(db_path, compressor=MessageCompressor())
+    await reopened.init_db()
+    assert reopened.compressor.active_dictionary_id == dictionary_id
+    messages = await reopened.read("+15550000003", conversation_ids[3])
+    assert len(messages) == 3
+    await reopened.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_plain_rows_are_readable_with_compressor(tmp_path):
+    db_path = str(tmp_path / "conversations.db")
+    plain = ConversationManager(db_path=db_path)
+    await plain.init_db()
+    (conversation_id,) = await _fill(plain, 1)
+    await plain.history.pool.close_all()
+
+    history = ConversationHistory(db_path, compressor=MessageCompressor())
+    await history.init_db()
+    assert len(await history.read("+15550000000", conversation_id)) == 3
+    await history.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_dictionaries_trained_by_another_manager_are_loaded(tmp_path):
+    db_path = str(tmp_path / "conversations.db")
+    trainer = ConversationHistory(db_path, compressor=MessageCompressor())
+    reader = ConversationHistory(db_path, compressor=MessageCompressor())
+    writer = ConversationManager(history=trainer)
+    await writer.init_db()
+    await ConversationManager(history=reader).init_db()
+    conversation_ids = await _fill(writer, 200)
+
+    # Trained after the reader loaded the dictionaries
+    dictionary_id = await trainer.train_compression_dictionary()
+    await trainer.recompress()
+    messages = await ConversationManager(history=reader).get_messages(
+        "+15550000003", conversation_ids[3]
+    )
+    assert messages[2]["content"] == "Hola, quiero saber el estado del pedido 23"
+    assert reader.compressor.active_dictionary_id == dictionary_id
+    await trainer.pool.close_all()
+    await reader.pool.close_all()
@@ -0,0 +1,128 @@
+import os
+
+import httpx
+import pytest
+from cachetools import LRUCache
+
+pytest.importorskip("fastapi")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+from pywaai import ai_utils
+from pywaai.auth import StaticTokenCache
+from pywaai.conversation_api import create_app
+from pywaai.conversation_db import ConversationManager
+
+BASE_URL = "http://conversations.test"
+
+
+@pytest.fixture
+def api_client(tmp_path, monkeypatch):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    app = create_app(manager, authorize=lambda token: token == "secret")
+    monkeypatch.setattr(ai_utils, "_token_cache", StaticTokenCache("secret"))
+    monkeypatch.setattr(ai_utils, "_remote_tails", LRUCache(maxsize=16))
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url=BASE_URL)
+
+
+@pytest.mark.asyncio
+async def test_protocol(api_client):
+    headers = {"Authorization": "Bearer secret"}
+    assert (await api_client.get("/conversations/123/latest")).status_code == 401
+    r = await api_client.get("/conversations/123/latest", headers=headers)
+    assert r.status_code == 404
+
+    cid = (await api_client.post("/conversations/123", headers=headers)).json()[
+        "conversation_id"
+    ]
+    url = f"/conversations/123/{cid}/messages"
+    r = await api_client.post(
+        url, headers=headers, json=[{"role": "user", "content": "1"}, {"role": "user", "content": "2"}]
+    )
+    assert r.headers["X-Next-Cursor"] == "2"
+    r = await api_client.post(url, headers=headers, json={"role": "user", "content": "3"})
+    assert r.json() == {"count": 3}
+
+    r = await api_client.get(url, headers=headers, params={"since": 1})
+    assert [m["content"] for m in r.json()] == ["2", "3"]
+    r = await api_client.get(
+        url, headers={**headers, "If-None-Match": r.headers["ETag"]}, params={"since": 3}
+    )
+    assert r.status_code == 304
+
+
+@pytest.mark.asyncio
+async def test_remote_conversation_against_reference_server(api_client):
+    for turn in range(2):
+        conv = ai_utils.LocalOrRemoteConversation(
+            phone_number="123",
+            use_remote_api=True,
+            remote_base_url=BASE_URL,
+            http_client=api_client,
+        )
+        await conv.append_message({"role": "user", "content": f"user {turn}"})
+        history = await conv.get_messages()
+        await conv.append_message({"role": "assistant", "content": f"assistant {turn}"})
+        await conv.flush()
+    assert [m["content"] for m in history] == ["user 0", "assistant 0", "user 1"]
+    assert [m["content"] for m in await conv.get_messages()][-1] == "assistant 1"
+
+
+@pytest.mark.asyncio
+async def test_remote_conversation_reloads_after_compaction(tmp_path, monkeypatch):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    monkeypatch.setattr(ai_utils, "_token_cache", StaticTokenCache())
+    monkeypatch.setattr(ai_utils, "_remote_tails", LRUCache(maxsize=16))
+    client = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=create_app(manager)), base_url=BASE_URL
+    )
+
+    def conversation():
+        return ai_utils.LocalOrRemoteConversation(
+            phone_number="123", use_remote_api=True, remote_base_url=BASE_URL, http_client=client
+        )
+
+    conv = conversation()
+    await conv.extend_messages([{"role": "user", "content": str(i)} for i in range(5)])
+    assert len(await conv.get_messages()) == 5
+
+    summary = {"role": "system", "content": "summary"}
+    assert await manager.history.compact("123", conv.conversation_id, 3, summary, 0)
+    conv = conversation()
+    await conv.append_message({"role": "user", "content": "5"})
+    assert await conv.get_messages() == [summary] + [
+        {"role": "user", "content": str(i)} for i in (3, 4, 5)
+    ]
+    # The cursor stays absolute across the compaction
+    r = await client.get(f"/conversations/123/{conv.conversation_id}/messages", params={"since": 5})
+    assert r.headers["X-Next-Cursor"] == "6"
+    assert r.json() == [{"role": "user", "content": "5"}]
+
+
+class RacingManager(ConversationManager):
+    """Another writer appends a message right after each write."""
+
+    async def add_messages_with_sync_state(self, phone_number, messages, conversation_id):
+        state = await super().add_messages_with_sync_state(
+            phone_number, messages, conversation_id
+        )
+        await self.history.extend(
+            phone_number, [{"role": "user", "content": "other"}], conversation_id
+        )
+        return state
+
+
+@pytest.mark.asyncio
+async def test_post_responses_describe_their_own_write(tmp_path):
+    manager = RacingManager(db_path=str(tmp_path / "conversations.db"))
+    client = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=create_app(manager)), base_url=BASE_URL
+    )
+    cid = (await client.post("/conversations/123")).json()["conversation_id"]
+    url = f"/conversations/123/{cid}/messages"
+    r = await client.post(url, json={"role": "user", "content": "1"})
+    assert r.headers["X-Next-Cursor"] == "1"
+    # The ETag doesn't cover the other writer's message, so the client fetches it
+    r = await client.get(url, headers={"If-None-Match": r.headers["ETag"]}, params={"since": 1})
+    assert r.status_code == 200
+    assert r.json() == [{"role": "user", "content": "other"}]
+    await manager.history.pool.close_all()
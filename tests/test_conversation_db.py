@@ -352,3 +352,126 @@ class TestEncryptedConversationHistory:
         except asyncio.CancelledError:
             pass
         return messages
+
+
+@pytest.mark.asyncio
+class TestConversationSessioning:
+    async def test_reuses_active_conversation(self, tmp_path):
+        """Test that a conversation within the inactivity window is reused."""
+        manager = ConversationManager(
+            db_path=str(tmp_path / "conversations.db"),
+            inactivity_timeout=timedelta(hours=24),
+        )
+        await manager.init_db()
+        phone_number = "+1234567890"
+        first = await manager.get_active_conversation_id(phone_number)
+        second = await manager.get_active_conversation_id(
+            phone_number, now=datetime.utcnow() + timedelta(hours=23)
+        )
+        assert first == second
+        await manager.history.pool.close_all()
+
+    async def test_rolls_over_with_summary(self, tmp_path):
+        """Test rollover to a new conversation seeded with a summary."""
+        async def summarizer(messages):
+            return f"{len(messages)} messages about greetings"
+
+        manager = ConversationManager(
+            db_path=str(tmp_path / "conversations.db"),
+            inactivity_timeout=timedelta(hours=24),
+            summarizer=summarizer,
+        )
+        await manager.init_db()
+        phone_number = "+1234567890"
+        first = await manager.get_active_conversation_id(phone_number)
+        await manager.add_message(phone_number, {"role": "user", "content": "Hi"}, first)
+
+        second = await manager.get_active_conversation_id(
+            phone_number, now=datetime.utcnow() + timedelta(hours=25)
+        )
+        assert second != first
+        messages = await manager.get_messages(phone_number, second)
+        assert messages == [
+            {
+                "role": "system",
+                "content": "Summary of the previous conversation: 1 messages about greetings",
+            }
+        ]
+        await manager.history.pool.close_all()
+
+    async def test_rollover_survives_summarizer_errors(self, tmp_path):
+        """Test that a failing summarizer doesn't fail the rollover."""
+        def summarizer(messages):
+            raise RuntimeError("summarizer is down")
+
+        manager = ConversationManager(
+            db_path=str(tmp_path / "conversations.db"),
+            inactivity_timeout=timedelta(hours=24),
+            summarizer=summarizer,
+        )
+        await manager.init_db()
+        first = await manager.get_active_conversation_id("+1")
+        await manager.add_message("+1", {"role": "user", "content": "Hi"}, first)
+        second = await manager.get_active_conversation_id(
+            "+1", now=datetime.utcnow() + timedelta(hours=25)
+        )
+        assert second != first
+        assert await manager.get_messages("+1", second) == []
+        await manager.history.pool.close_all()
+
+    async def test_slow_summaries_dont_block_other_users(self, tmp_path):
+        """Test that rollovers of different users don't wait for each other."""
+        release = asyncio.Event()
+
+        async def summarizer(messages):
+            if messages[0]["content"] == "slow":
+                await release.wait()
+            return "greetings"
+
+        manager = ConversationManager(
+            db_path=str(tmp_path / "conversations.db"),
+            inactivity_timeout=timedelta(hours=24),
+            summarizer=summarizer,
+        )
+        await manager.init_db()
+        for phone_number, content in (("+1", "slow"), ("+2", "fast")):
+            cid = await manager.get_active_conversation_id(phone_number)
+            await manager.add_message(
+                phone_number, {"role": "user", "content": content}, cid
+            )
+        later = datetime.utcnow() + timedelta(hours=25)
+        slow = asyncio.create_task(manager.get_active_conversation_id("+1", now=later))
+        await asyncio.sleep(0.01)
+        await asyncio.wait_for(manager.get_active_conversation_id("+2", now=later), 1)
+        assert not slow.done()
+        release.set()
+        await slow
+        await manager.history.pool.close_all()
+
+    async def test_indexes_are_added_to_existing_databases(self, tmp_path):
+        """Test that init_db creates the indexes missing from an older database."""
+        import sqlite3
+
+        db_path = str(tmp_path / "conversations.db")
+        connection = sqlite3.connect(db_path)
+        connection.execute(
+            "CREATE TABLE conversations (conversation_id VARCHAR PRIMARY KEY, "
+            "phone_number VARCHAR NOT NULL, messages TEXT NOT NULL, "
+            "created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL)"
+        )
+        connection.commit()
+        manager = ConversationManager(db_path=db_path)
+        await manager.init_db()
+        indexes = {
+            row[0]
+            for row in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' "
+                "AND tbl_name = 'conversations'"
+            )
+        }
+        connection.close()
+        assert {
+            "ix_conversations_phone_number_updated_at",
+            "ix_conversations_updated_at",
+        } <= indexes
+        await manager.history.pool.close_all()
@@ -0,0 +1,123 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from pywaai.conversation_db import ConversationManager
+from pywaai.export import (
+    ExportState,
+    export_parquet,
+    iter_message_rows,
+    iter_record_batches,
+)
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+
+@pytest.mark.asyncio
+async def test_record_batches_flatten_messages(tmp_path):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    await manager.init_db()
+    conversation = await manager.create_conversation("+1234567890")
+    cid = conversation.conversation_id
+    await manager.add_message("+1234567890", {"role": "user", "content": "Hi"}, cid)
+    await manager.add_message(
+        "+1234567890",
+        {
+            "role": "assistant",
+            "tool_calls": [{"id": "call_1", "function": {"name": "lookup"}}],
+        },
+        cid,
+    )
+
+    batches = [batch async for batch in iter_record_batches(manager)]
+    rows = pa.Table.from_batches(batches).to_pylist()
+
+    assert [row["role"] for row in rows] == ["user", "assistant"]
+    assert rows[0]["content_length"] == 2
+    assert rows[1]["tool_names"] == ["lookup"]
+    await manager.history.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_export_parquet_is_incremental(tmp_path):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    await manager.init_db()
+    output_dir = tmp_path / "export"
+    state_path = str(tmp_path / "state.json")
+    conversation = await manager.create_conversation("+1234567890")
+    cid = conversation.conversation_id
+    await manager.add_message("+1234567890", {"role": "user", "content": "1"}, cid)
+
+    assert await export_parquet(manager, str(output_dir), state_path) == 1
+    assert ExportState.load(state_path).offsets == {cid: 1}
+
+    await manager.add_message("+1234567890", {"role": "user", "content": "2"}, cid)
+    assert await export_parquet(manager, str(output_dir), state_path) == 1
+    assert await export_parquet(manager, str(output_dir), state_path) == 0
+
+    table = pq.read_table(str(output_dir))
+    assert sorted(table.column("message_index").to_pylist()) == [0, 1]
+    assert len(list(output_dir.iterdir())) == 1  # a single day partition
+    await manager.history.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_export_offsets_survive_compaction(tmp_path):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    cid = await manager.get_active_conversation_id("123")
+    await manager.add_messages(
+        "123", [{"role": "user", "content": str(i)} for i in range(4)], cid
+    )
+    state = ExportState()
+    rows = [row async for batch in iter_record_batches(manager, state) for row in batch.to_pylist()]
+    assert [row["message_index"] for row in rows] == [0, 1, 2, 3]
+
+    summary = {"role": "system", "content": "summary"}
+    assert await manager.history.compact("123", cid, 3, summary, expected_compacted=0)
+    await manager.add_message("123", {"role": "user", "content": "4"}, cid)
+    rows = [row async for batch in iter_record_batches(manager, state) for row in batch.to_pylist()]
+    assert [row["message_index"] for row in rows] == [4]
+    assert state.offsets[cid] == 5
+    await manager.history.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_message_rows_are_read_in_chunks(tmp_path):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    await manager.init_db()
+    for i in range(5):
+        conversation = await manager.create_conversation(f"+{i}")
+        await manager.add_message(
+            f"+{i}", {"role": "user", "content": str(i)}, conversation.conversation_id
+        )
+
+    state = ExportState()
+    rows = [row async for row in iter_message_rows(manager, state, chunk_size=2)]
+    assert sorted(row["phone_number"] for row in rows) == [f"+{i}" for i in range(5)]
+    assert len(state.offsets) == 5
+    assert [row async for row in iter_message_rows(manager, state, chunk_size=2)] == []
+    await manager.history.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_rows_keep_their_day_and_idle_conversations_are_pruned(tmp_path):
+    manager = ConversationManager(
+        db_path=str(tmp_path / "conversations.db"), inactivity_timeout=timedelta(hours=1)
+    )
+    await manager.init_db()
+    old = await manager.create_conversation("+1")
+    await manager.add_message("+1", {"role": "user", "content": "1"}, old.conversation_id)
+    state_path = str(tmp_path / "state.json")
+    state = ExportState(
+        updated_at={"gone": datetime.utcnow() - timedelta(days=1)}, offsets={"gone": 3}
+    )
+    state.save(state_path)
+
+    rows = [row async for row in iter_message_rows(manager, ExportState())]
+    assert rows[0]["day"] == old.created_at.date()
+    assert rows[0]["message_timestamp"] is None
+
+    assert await export_parquet(manager, str(tmp_path / "export"), state_path) == 1
+    assert ExportState.load(state_path).offsets == {old.conversation_id: 1}
+    await manager.history.pool.close_all()
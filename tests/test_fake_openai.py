@@ -0,0 +1,96 @@
+import os
+import time
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+from pywaai import ai_utils
+from pywaai.conversation_db import ConversationManager
+from pywaai.fake_openai import (
+    FakeOpenAI,
+    FakeReply,
+    constant_latency,
+    lognormal_latency,
+)
+from pywaai.metrics import MetricsRegistry
+
+
+class EchoTool:
+    openai_schema = {
+        "name": "EchoTool",
+        "parameters": {
+            "type": "object",
+            "properties": {"value": {"type": "string"}, "times": {"type": "integer"}},
+        },
+    }
+
+    def __init__(self, value: str, times: int):
+        self.value = value
+        self.times = times
+
+    async def run(self):
+        return self.value * self.times
+
+
+def test_lognormal_latency_is_centered_on_the_median():
+    latency = lognormal_latency(0.5, sigma=0.3, seed=1)
+    samples = sorted(latency() for _ in range(1001))
+    assert 0.45 < samples[500] < 0.55
+
+
+@pytest.mark.asyncio
+async def test_generate_response_with_the_fake_client(tmp_path):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    client = FakeOpenAI(latency=constant_latency(0.05), tool_call_rate=1.0)
+    registry = MetricsRegistry()
+    start = time.monotonic()
+    responses = await ai_utils.generate_response(
+        phone_number="123",
+        message_text="Hi",
+        user_name="Test",
+        openai_client=client,
+        tool_functions=[EchoTool],
+        conversation_manager=manager,
+        metrics=registry,
+    )
+    # A tool round, then the answer
+    assert time.monotonic() - start >= 0.1
+    assert responses == [{"role": "assistant", "content": "You said: Hi"}]
+    await ai_utils.wait_for_pending_writes()
+    cid = await manager.get_active_conversation_id("123")
+    stored = await manager.get_messages("123", cid)
+    assert [m["role"] for m in stored] == ["user", "assistant", "tool", "assistant"]
+    assert stored[2]["content"] == "test"
+    assert registry.conversation("123", cid).llm_calls == 2
+    await manager.history.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_streams_report_usage(tmp_path):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    client = FakeOpenAI(
+        responder=lambda request: FakeReply("One two three. " * 10),
+        tokens_per_second=1000,
+    )
+    registry = MetricsRegistry()
+    messages = [
+        message
+        async for message in ai_utils.generate_response_stream(
+            phone_number="123",
+            message_text="Hi",
+            user_name="Test",
+            openai_client=client,
+            conversation_manager=manager,
+            max_message_chars=50,
+            metrics=registry,
+        )
+    ]
+    assert len(messages) > 1
+    assert "".join(m["content"] for m in messages).replace(" ", "") == (
+        "Onetwothree." * 10
+    )
+    await ai_utils.wait_for_pending_writes()
+    cid = await manager.get_active_conversation_id("123")
+    assert registry.conversation("123", cid).completion_tokens == 150 // 4
+    await manager.history.pool.close_all()
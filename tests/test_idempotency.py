@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+from pywa import WhatsApp
+from pywa.idempotency import MemoryIdempotencyStore, SQLiteIdempotencyStore
+
+
+def _message_update(msg_id: str) -> dict:
+    with open("tests/data/updates/18.0/message.json") as f:
+        update = json.load(f)["text"]
+    update["entry"][0]["changes"][0]["value"]["messages"][0]["id"] = msg_id
+    return update
+
+
+def test_memory_store_is_bounded():
+    store = MemoryIdempotencyStore(maxsize=2)
+    assert store.add("a")
+    assert not store.add("a")
+    assert store.add("b")
+    assert store.add("c")
+    assert len(store) == 2
+    assert "a" not in store
+
+
+def test_memory_store_expires():
+    store = MemoryIdempotencyStore(ttl=0)
+    assert store.add("a")
+    assert store.add("a")
+
+
+def test_sqlite_store_is_shared(tmp_path):
+    db_path = str(tmp_path / "updates.db")
+    first, second = SQLiteIdempotencyStore(db_path), SQLiteIdempotencyStore(db_path)
+    assert first.add("wamid.1")
+    assert not second.add("wamid.1")
+    second.discard("wamid.1")
+    assert SQLiteIdempotencyStore(db_path).add("wamid.1")
+    first.close()
+    second.close()
+
+
+@pytest.mark.asyncio
+async def test_redelivered_update_is_skipped():
+    wa = WhatsApp(
+        token="xyz",
+        server=None,
+        verify_token="xyz",
+        validate_updates=False,
+        idempotency_store=MemoryIdempotencyStore(),
+    )
+    calls = []
+    wa.on_raw_update()(lambda _, update: calls.append(update))
+
+    assert await wa.webhook_update_handler(_message_update("wamid.1")) == ("ok", 200)
+    assert await wa.webhook_update_handler(_message_update("wamid.1")) == ("ok", 200)
+    assert await wa.webhook_update_handler(_message_update("wamid.2")) == ("ok", 200)
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_update_is_released_when_a_handler_fails(tmp_path):
+    store = SQLiteIdempotencyStore(str(tmp_path / "updates.db"))
+    wa = WhatsApp(
+        token="xyz",
+        server=None,
+        verify_token="xyz",
+        validate_updates=False,
+        idempotency_store=store,
+    )
+    calls = []
+
+    def handler(_, update):
+        calls.append(update)
+        if len(calls) == 1:
+            raise RuntimeError("handler failed")
+
+    wa.on_raw_update()(handler)
+
+    assert await wa.webhook_update_handler(_message_update("wamid.1")) == ("ok", 200)
+    assert await wa.webhook_update_handler(_message_update("wamid.1")) == ("ok", 200)
+    assert await wa.webhook_update_handler(_message_update("wamid.1")) == ("ok", 200)
+    assert len(calls) == 2
+    store.close()
@@ -0,0 +1,36 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Imported on first use, not with pywaai
+HEAVY_MODULES = ("openai", "instructor", "pydantic", "httpx", "pywa", "logfire", "sqlalchemy")
+# Generous, to be stable on slow machines: eager imports took well over a second
+MAX_IMPORT_SECONDS = 0.5
+
+
+def _import_times(module: str) -> dict:
+    env = {k: v for k, v in os.environ.items() if k != "OPENAI_API_KEY"}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+@pytest.mark.parametrize("module", ["pywaai", "pywaai.ai_utils"])
+def test_import_is_lazy(module):
+    times = _import_times(module)
+    eager = [name for name in HEAVY_MODULES if name in times]
+    assert not eager, f"{module} imports {eager}"
+    assert times[module] < MAX_IMPORT_SECONDS
@@ -0,0 +1,72 @@
+import json
+import time
+from types import SimpleNamespace
+
+from pywaai.metrics import DB_READ, LLM, SEND, SHORTENER, MetricsRegistry
+
+
+def _usage(prompt, completion):
+    return SimpleNamespace(prompt_tokens=prompt, completion_tokens=completion)
+
+
+def test_nested_stages_only_count_their_own_time():
+    turn = MetricsRegistry().turn("123", "gpt-4o")
+    with turn.stage(LLM):
+        time.sleep(0.02)
+        with turn.stage(SEND):
+            time.sleep(0.03)
+        time.sleep(0.02)
+    assert 0.035 < turn.stages[LLM] < 0.055
+    assert 0.025 < turn.stages[SEND] < 0.045
+
+
+def test_turns_are_aggregated_per_conversation():
+    registry = MetricsRegistry()
+    for _ in range(2):
+        turn = registry.turn("123", "gpt-4o", "c1")
+        with turn.stage(DB_READ):
+            pass
+        turn.record_usage(_usage(100, 20))
+        turn.record_cache(False)
+        turn.finish()
+        turn.finish()
+    registry.turn("456", "gpt-4o", "c2").finish()
+
+    stats = registry.conversation("123", "c1")
+    assert (stats.turns, stats.llm_calls) == (2, 2)
+    assert (stats.prompt_tokens, stats.completion_tokens) == (200, 40)
+    assert registry.conversation("123") is None
+
+    exported = json.loads(registry.to_json())
+    assert exported["turns"]["gpt-4o"]["count"] == 3
+    assert exported["llm"] == [
+        {
+            "model": "gpt-4o",
+            "stage": "llm",
+            "calls": 2,
+            "prompt_tokens": 200,
+            "completion_tokens": 40,
+        }
+    ]
+    assert exported["response_cache"] == {"hit": 0, "miss": 2}
+    assert {c["conversation_id"] for c in exported["conversations"]} == {"c1", "c2"}
+
+
+def test_prometheus_export():
+    registry = MetricsRegistry(buckets=(0.1, 1))
+    registry.record_usage("gpt-4o", SHORTENER, _usage(50, 10))
+    registry.observe_stage(SEND, 0.5)
+    registry.record_cache(True)
+    text = registry.to_prometheus()
+    lines = text.splitlines()
+    assert "# TYPE pywaai_stage_duration_seconds histogram" in lines
+    assert 'pywaai_stage_duration_seconds_bucket{model="",stage="send",le="0.1"} 0' in lines
+    assert 'pywaai_stage_duration_seconds_bucket{model="",stage="send",le="1.0"} 1' in lines
+    assert 'pywaai_stage_duration_seconds_bucket{model="",stage="send",le="+Inf"} 1' in lines
+    assert 'pywaai_stage_duration_seconds_count{model="",stage="send"} 1' in lines
+    assert (
+        'pywaai_llm_tokens_total{model="gpt-4o",stage="shortener",type="prompt"} 50'
+        in lines
+    )
+    assert 'pywaai_response_cache_lookups_total{result="hit"} 1' in lines
+    assert text.endswith("\n")
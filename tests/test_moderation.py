@@ -0,0 +1,123 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+from pywaai import ai_utils
+from pywaai.conversation_db import ConversationManager
+from pywaai.fake_openai import FakeOpenAI, FakeReply, constant_latency
+from pywaai.metrics import MetricsRegistry
+from pywaai.moderation import Moderator
+
+
+class FailingModerations:
+    def __init__(self):
+        self.moderations = self
+
+    async def create(self, **kwargs):
+        raise RuntimeError("moderation is down")
+
+
+@pytest.mark.asyncio
+async def test_concurrent_checks_share_one_request():
+    client = FakeOpenAI(flagged_words=["idiot"])
+    registry = MetricsRegistry()
+    moderator = Moderator(client, metrics=registry)
+    results = await asyncio.gather(
+        *(moderator.check(f"message {i}") for i in range(9)),
+        moderator.check("you idiot"),
+    )
+    assert client.moderation_calls == 1
+    assert [result.flagged for result in results] == [False] * 9 + [True]
+    assert results[-1].categories == ["harassment"]
+    assert {s["stage"] for s in registry.to_dict()["stages"]} == {"moderation"}
+
+
+@pytest.mark.asyncio
+async def test_verdicts_are_cached_by_content():
+    client = FakeOpenAI()
+    moderator = Moderator(client, max_batch_size=2)
+    await asyncio.gather(*(moderator.check("hola") for _ in range(5)))
+    assert client.moderation_calls == 1
+    await moderator.check("hola")
+    assert client.moderation_calls == 1
+    # Full batches are sent without waiting
+    await asyncio.gather(*(moderator.check(str(i)) for i in range(5)))
+    assert client.moderation_calls == 4
+
+
+@pytest.mark.asyncio
+async def test_failed_checks_are_not_cached():
+    moderator = Moderator(FailingModerations())
+    result = await moderator.check("hola")
+    assert (result.flagged, result.error) == (False, True)
+    assert (await Moderator(FailingModerations(), fail_open=False).check("hola")).flagged
+    moderator._openai_client = FakeOpenAI()
+    assert not (await moderator.check("hola")).error
+
+
+class BrokenModerations:
+    def __init__(self, results):
+        self.moderations = self
+        self.results = results
+
+    async def create(self, **kwargs):
+        return type("Response", (), {"results": self.results})()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("results", [[], [object()]], ids=["short", "malformed"])
+async def test_bad_responses_resolve_every_check(results):
+    moderator = Moderator(BrokenModerations(results))
+    checks = await asyncio.wait_for(
+        asyncio.gather(moderator.check("hola"), moderator.check("chau")), 1
+    )
+    assert all(result.error for result in checks)
+    assert moderator._in_flight == {}
+    # Later checks of the same texts are sent again instead of hanging
+    moderator._openai_client = FakeOpenAI()
+    assert not (await asyncio.wait_for(moderator.check("hola"), 1)).error
+
+
+class SlowHistory(ConversationManager):
+    async def get_messages(self, phone_number, conversation_id):
+        await asyncio.sleep(0.05)
+        return await super().get_messages(phone_number, conversation_id)
+
+
+@pytest.mark.asyncio
+async def test_generate_response_moderates_while_loading_the_history(tmp_path):
+    manager = SlowHistory(db_path=str(tmp_path / "conversations.db"))
+    client = FakeOpenAI(
+        lambda request: FakeReply("Hello"),
+        moderation_latency=constant_latency(0.05),
+        flagged_words=["idiot"],
+    )
+    moderator = Moderator(client)
+
+    async def ask(text):
+        return await ai_utils.generate_response(
+            phone_number="123",
+            message_text=text,
+            user_name="Test",
+            openai_client=client,
+            conversation_manager=manager,
+            moderator=moderator,
+        )
+
+    assert await ask("Hi") == [{"role": "assistant", "content": "Hello"}]
+    # The history and the moderation take 50ms each, but run concurrently
+    start = time.monotonic()
+    await ask("How are you?")
+    assert time.monotonic() - start < 0.09
+    assert await ask("You idiot") == [{"role": "assistant", "content": moderator.refusal}]
+    # The flagged message neither reached the model nor was stored
+    assert client.calls == 2
+    await ai_utils.wait_for_pending_writes()
+    cid = await manager.get_active_conversation_id("123")
+    stored = await manager.get_messages("123", cid)
+    assert [m["content"] for m in stored] == ["Hi", "Hello", "How are you?", "Hello"]
+    await manager.history.pool.close_all()
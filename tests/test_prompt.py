@@ -0,0 +1,75 @@
+from pywaai.prompt import MESSAGE_OVERHEAD_TOKENS, PromptBuilder
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+def _message(role: str, words: int, **fields) -> dict:
+    return {"role": role, "content": " ".join(["w"] * words), **fields}
+
+
+SYSTEM = _message("system", 6)  # 10 tokens with the overhead
+
+
+def test_keeps_most_recent_messages_within_budget():
+    history = [_message("user", 16), _message("assistant", 16), _message("user", 6)]
+    builder = PromptBuilder(max_tokens=10 + 20 + 10, count_tokens=count_words)
+    assert builder.build(SYSTEM, history) == [SYSTEM, history[1], history[2]]
+
+
+def test_keeps_everything_that_fits():
+    history = [_message("user", 1), _message("assistant", 1)]
+    builder = PromptBuilder(max_tokens=1000, count_tokens=count_words)
+    assert builder.build(SYSTEM, history) == [SYSTEM] + history
+
+
+def test_tool_results_stay_with_their_call():
+    call = {
+        "role": "assistant",
+        "content": None,
+        "tool_calls": [{"id": "c1", "type": "function", "function": {"name": "f", "arguments": "{}"}}],
+    }
+    history = [
+        _message("user", 2),
+        call,
+        _message("tool", 30, tool_call_id="c1"),
+        _message("assistant", 2),
+    ]
+    builder = PromptBuilder(max_tokens=10 + 6 + 34, count_tokens=count_words)
+    # The tool result fits on its own, but not with its call: both are dropped
+    assert builder.build(SYSTEM, history) == [SYSTEM, history[3]]
+
+
+def test_always_keeps_latest_message():
+    history = [_message("user", 1), _message("user", 500)]
+    builder = PromptBuilder(max_tokens=50, count_tokens=count_words)
+    assert builder.build(SYSTEM, history) == [SYSTEM, history[1]]
+
+
+def test_token_counts_are_cached_per_message():
+    calls = []
+
+    def counting(text):
+        calls.append(text)
+        return count_words(text)
+
+    builder = PromptBuilder(max_tokens=1000, count_tokens=counting)
+    history = [_message("user", 3), _message("assistant", 3)]
+    builder.build(SYSTEM, history)
+    assert len(calls) == 3
+    builder.build(SYSTEM, history + [_message("user", 4)])
+    assert len(calls) == 4
+    assert builder.message_tokens(history[0]) == 3 + MESSAGE_OVERHEAD_TOKENS
+
+
+def test_estimates_without_a_tokenizer():
+    builder = PromptBuilder()
+    assert builder.message_tokens({"role": "user", "content": "x" * 40}) >= 10
+
+
+def test_leading_system_messages_are_kept():
+    summary = {"role": "system", "content": "Summary of the earlier messages"}
+    history = [summary, _message("user", 30), _message("user", 6)]
+    builder = PromptBuilder(max_tokens=40, count_tokens=count_words)
+    assert builder.build(SYSTEM, history) == [SYSTEM, summary, history[2]]
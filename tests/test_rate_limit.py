@@ -0,0 +1,114 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from pywaai.rate_limit import LLMLimiter, ModelLimits, Priority, estimate_tokens
+
+
+async def _hold(limiter, model, order, name, priority=Priority.REPLY, tokens=0, delay=0.02):
+    async with limiter.acquire(model, priority, tokens):
+        order.append(name)
+        await asyncio.sleep(delay)
+
+
+@pytest.mark.asyncio
+async def test_concurrency_is_capped_per_model():
+    limiter = LLMLimiter({"gpt-4o": ModelLimits(max_concurrency=2)})
+    running = peak = 0
+
+    async def call(model):
+        nonlocal running, peak
+        async with limiter.acquire(model):
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+    await asyncio.gather(*(call("gpt-4o") for _ in range(6)))
+    assert peak == 2
+    # Models without limits are not capped
+    await asyncio.gather(*(call("gpt-4o-mini") for _ in range(6)))
+    assert peak == 6
+    assert limiter.stats("gpt-4o") == {"in_flight": 0, "queued": 0}
+
+
+@pytest.mark.asyncio
+async def test_replies_are_served_before_background_work():
+    limiter = LLMLimiter({"gpt-4o": ModelLimits(max_concurrency=1)})
+    order = []
+    first = asyncio.create_task(_hold(limiter, "gpt-4o", order, "first"))
+    await asyncio.sleep(0)
+    tasks = [
+        asyncio.create_task(_hold(limiter, "gpt-4o", order, "background", Priority.BACKGROUND)),
+        asyncio.create_task(_hold(limiter, "gpt-4o", order, "follow-up", Priority.FOLLOW_UP)),
+        asyncio.create_task(_hold(limiter, "gpt-4o", order, "reply-1")),
+        asyncio.create_task(_hold(limiter, "gpt-4o", order, "reply-2")),
+    ]
+    await asyncio.gather(first, *tasks)
+    assert order == ["first", "reply-1", "reply-2", "follow-up", "background"]
+
+
+@pytest.mark.asyncio
+async def test_request_and_token_rates_delay_calls():
+    limiter = LLMLimiter({"gpt-4o": ModelLimits(requests_per_minute=600)})
+    start = time.monotonic()
+    # A full bucket of 600 requests, then one every 0.1s
+    for _ in range(602):
+        async with limiter.acquire("gpt-4o"):
+            pass
+    assert 0.15 < time.monotonic() - start < 1
+
+    limiter = LLMLimiter({"gpt-4o": ModelLimits(tokens_per_minute=6000)})
+    async with limiter.acquire("gpt-4o", tokens=6000):
+        pass
+    start = time.monotonic()
+    async with limiter.acquire("gpt-4o", tokens=10):
+        pass
+    assert 0.05 < time.monotonic() - start < 1
+
+
+@pytest.mark.asyncio
+async def test_recorded_usage_corrects_the_estimate():
+    limiter = LLMLimiter({"gpt-4o": ModelLimits(tokens_per_minute=6000)})
+    async with limiter.acquire("gpt-4o", tokens=6000) as permit:
+        # The call used far fewer tokens than estimated
+        permit.record(SimpleNamespace(total_tokens=100))
+    start = time.monotonic()
+    async with limiter.acquire("gpt-4o", tokens=1000):
+        pass
+    assert time.monotonic() - start < 0.05
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiters_leave_the_queue():
+    limiter = LLMLimiter({"gpt-4o": ModelLimits(max_concurrency=1)})
+    order = []
+    first = asyncio.create_task(_hold(limiter, "gpt-4o", order, "first"))
+    await asyncio.sleep(0)
+    cancelled = asyncio.create_task(_hold(limiter, "gpt-4o", order, "cancelled"))
+    last = asyncio.create_task(_hold(limiter, "gpt-4o", order, "last"))
+    await asyncio.sleep(0)
+    assert limiter.stats("gpt-4o") == {"in_flight": 1, "queued": 2}
+    cancelled.cancel()
+    await asyncio.gather(first, last)
+    assert order == ["first", "last"]
+    assert limiter.stats("gpt-4o") == {"in_flight": 0, "queued": 0}
+
+
+@pytest.mark.asyncio
+async def test_paused_models_resume_after_the_delay():
+    limiter = LLMLimiter()
+    limiter.pause("gpt-4o", 0.1)
+    start = time.monotonic()
+    async with limiter.acquire("gpt-4o"):
+        pass
+    assert time.monotonic() - start >= 0.09
+    async with limiter.acquire("gpt-4o-mini"):
+        pass
+
+
+def test_estimate_tokens():
+    messages = [{"role": "user", "content": "a" * 400}]
+    assert estimate_tokens(messages, 800) == 900
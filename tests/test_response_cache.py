@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from pywaai.response_cache import CachedResponse, ResponseCache, normalize_message
+
+PROMPT = "You answer questions about our store."
+REPLY = CachedResponse("We open at 9.", ["We open at 9."])
+
+
+def test_normalize_message():
+    assert normalize_message("  ¿A qué HORA abren?? ") == "a que hora abren"
+
+
+@pytest.mark.asyncio
+async def test_exact_tier_matches_normalized_messages():
+    cache = ResponseCache()
+    await cache.put(PROMPT, "gpt-4o", "¿A qué hora abren?", REPLY)
+    assert await cache.get(PROMPT, "gpt-4o", "a que hora abren") == REPLY
+    assert await cache.get(PROMPT, "gpt-4o-mini", "a que hora abren") is None
+    assert await cache.get("Another prompt", "gpt-4o", "a que hora abren") is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+@pytest.mark.asyncio
+async def test_replies_are_only_reused_in_their_context():
+    cache = ResponseCache(embedder=bag_of_words)
+    await cache.put(PROMPT, "gpt-4o", "hora", REPLY, context="The user's name is: Ana.")
+    assert await cache.get(PROMPT, "gpt-4o", "hora") is None
+    assert await cache.get(PROMPT, "gpt-4o", "hora", context="The user's name is: Bob.") is None
+    assert await cache.get(PROMPT, "gpt-4o", "hora", context="The user's name is: Ana.") == REPLY
+    assert cache.invalidate(PROMPT) == 1
+
+
+@pytest.mark.asyncio
+async def test_entries_expire_and_are_evicted():
+    cache = ResponseCache(maxsize=2, ttl=0.05)
+    for question in ("one", "two", "three"):
+        await cache.put(PROMPT, "gpt-4o", question, REPLY)
+    assert await cache.get(PROMPT, "gpt-4o", "one") is None
+    assert await cache.get(PROMPT, "gpt-4o", "three") == REPLY
+    await asyncio.sleep(0.1)
+    assert await cache.get(PROMPT, "gpt-4o", "three") is None
+
+
+def bag_of_words(text):
+    vocabulary = ["hora", "abren", "cierran", "a", "que", "tienda", "la"]
+    return [float(word in text.split()) for word in vocabulary]
+
+
+@pytest.mark.asyncio
+async def test_embedding_tier_matches_similar_questions():
+    cache = ResponseCache(embedder=bag_of_words, similarity_threshold=0.8)
+    await cache.put(PROMPT, "gpt-4o", "¿A qué hora abren?", REPLY)
+    assert await cache.get(PROMPT, "gpt-4o", "¿A qué hora abren la tienda?") == REPLY
+    assert await cache.get(PROMPT, "gpt-4o", "¿A qué hora cierran?") is None
+
+
+@pytest.mark.asyncio
+async def test_invalidate_a_prompt():
+    cache = ResponseCache(embedder=bag_of_words)
+    await cache.put(PROMPT, "gpt-4o", "hora", REPLY)
+    await cache.put(PROMPT, "gpt-4o-mini", "hora", REPLY)
+    await cache.put("Other", "gpt-4o", "hora", REPLY)
+    assert cache.invalidate(PROMPT, model="gpt-4o-mini") == 1
+    assert cache.invalidate(PROMPT) == 1
+    assert await cache.get(PROMPT, "gpt-4o", "hora") is None
+    assert await cache.get("Other", "gpt-4o", "hora") == REPLY
+    assert cache.invalidate() == 1
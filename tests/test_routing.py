@@ -0,0 +1,149 @@
+import os
+
+import httpx
+import openai
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+from pywaai import ai_utils, routing
+from pywaai.conversation_db import ConversationManager
+from pywaai.fake_openai import FakeOpenAI, FakeReply
+from pywaai.metrics import MetricsRegistry
+from pywaai.routing import (
+    ModelRouter,
+    likely_tools,
+    long_prompts,
+    short_messages,
+    turn_features,
+)
+
+
+class GetWeather:
+    openai_schema = {"name": "GetWeather", "parameters": {"type": "object"}}
+
+
+def _features(text, tools=(), history=()):
+    messages = [{"role": "system", "content": "Be nice."}, *history]
+    return turn_features(text, messages + [{"role": "user", "content": text}], tools)
+
+
+def test_turn_features():
+    features = _features(
+        "What's the weather in Lima?",
+        tools=[GetWeather],
+        history=[{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}],
+    )
+    assert (features.words, features.is_question) == (6, True)
+    assert (features.history_messages, features.has_tools) == (2, True)
+    assert features.tools_likely
+    assert not _features("Thanks!", tools=[GetWeather]).tools_likely
+
+
+def test_rules_are_tried_in_order():
+    router = ModelRouter(
+        rules=[likely_tools("big"), short_messages("mini"), long_prompts("long", 1000)]
+    )
+    assert router.route(_features("ok, thanks"), "gpt-4o") == "mini"
+    assert router.route(_features("weather"), "gpt-4o") == "mini"
+    assert router.route(_features("weather", tools=[GetWeather]), "gpt-4o") == "big"
+    assert router.route(_features("Can you help me?"), "gpt-4o") == "gpt-4o"
+    history = [{"role": "user", "content": "palabra " * 1000}]
+    assert router.route(_features("Can you help me?", history=history), "x") == "long"
+    assert ModelRouter(default="mini").route(_features("Can you help me?"), "x") == "mini"
+
+
+class ModelResponder:
+    """Answers with the model's name; ``failing`` models raise and ``empty`` ones say nothing."""
+
+    def __init__(self, failing=(), empty=()):
+        self.failing = failing
+        self.empty = empty
+        self.models = []
+
+    def __call__(self, request):
+        model = request["model"]
+        self.models.append(model)
+        if model in self.failing:
+            raise openai.APIConnectionError(
+                request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+            )
+        return FakeReply("" if model in self.empty else model)
+
+
+async def _ask(manager, responder, text, **kwargs):
+    responses = await ai_utils.generate_response(
+        phone_number="123",
+        message_text=text,
+        user_name="Test",
+        openai_client=FakeOpenAI(responder),
+        conversation_manager=manager,
+        **kwargs,
+    )
+    return [response["content"] for response in responses]
+
+
+@pytest.mark.asyncio
+async def test_short_messages_go_to_the_small_model(tmp_path):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    router = ModelRouter(rules=[short_messages("gpt-4o-mini")])
+    registry = MetricsRegistry()
+    responder = ModelResponder()
+    assert await _ask(manager, responder, "ok", router=router, metrics=registry) == [
+        "gpt-4o-mini"
+    ]
+    assert await _ask(
+        manager, responder, "What can you do for me?", router=router, metrics=registry
+    ) == ["gpt-4o"]
+    # Turns are recorded under the model that answered them
+    assert set(registry.to_dict()["turns"]) == {"gpt-4o-mini", "gpt-4o"}
+    await ai_utils.wait_for_pending_writes()
+    await manager.history.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_failed_calls_fall_back_and_poor_replies_are_escalated(tmp_path):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    router = ModelRouter(
+        rules=[short_messages("gpt-4o-mini")],
+        fallbacks={"gpt-4o-mini": "gpt-4o"},
+        escalations={"gpt-4o-mini": "gpt-4o"},
+    )
+    responder = ModelResponder(failing=["gpt-4o-mini"])
+    assert await _ask(manager, responder, "ok", router=router) == ["gpt-4o"]
+    assert responder.models == ["gpt-4o-mini", "gpt-4o"]
+
+    responder = ModelResponder(empty=["gpt-4o-mini"])
+    assert await _ask(manager, responder, "ok", router=router) == ["gpt-4o"]
+    assert responder.models == ["gpt-4o-mini", "gpt-4o"]
+
+    # Without a fallback, the error is raised
+    with pytest.raises(openai.APIConnectionError):
+        await _ask(manager, ModelResponder(failing=["gpt-4o"]), "Hello there, how are you?")
+    await ai_utils.wait_for_pending_writes()
+    await manager.history.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_streams_use_the_shared_router(tmp_path, monkeypatch):
+    manager = ConversationManager(db_path=str(tmp_path / "conversations.db"))
+    monkeypatch.setattr(
+        routing,
+        "_model_router",
+        ModelRouter(rules=[short_messages("small")], fallbacks={"small": "gpt-4o"}),
+    )
+    responder = ModelResponder(failing=["small"])
+    messages = [
+        message["content"]
+        async for message in ai_utils.generate_response_stream(
+            phone_number="123",
+            message_text="thanks",
+            user_name="Test",
+            openai_client=FakeOpenAI(responder),
+            conversation_manager=manager,
+        )
+    ]
+    assert messages == ["gpt-4o"]
+    assert responder.models == ["small", "gpt-4o"]
+    await ai_utils.wait_for_pending_writes()
+    await manager.history.pool.close_all()
@@ -0,0 +1,205 @@
+import asyncio
+import time
+
+import pytest
+
+from pywaai.conversation_db import ConnectionPool
+from pywaai.models import ScheduledJobDB
+from pywaai.scheduler import FollowUpScheduler
+
+
+class Recorder:
+    def __init__(self, delay: float = 0.0, failures: int = 0):
+        self.delay = delay
+        self.failures = failures
+        self.fired = []
+        self.running = 0
+        self.peak = 0
+
+    async def __call__(self, job):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError("send failed")
+            self.fired.append((job.phone_number, job.payload.get("n")))
+        finally:
+            self.running -= 1
+
+
+async def _stored_jobs(pool: ConnectionPool) -> int:
+    session = await pool.get_connection()
+    try:
+        return session.query(ScheduledJobDB).count()
+    finally:
+        await pool.release_connection(session)
+
+
+@pytest.mark.asyncio
+async def test_jobs_fire_in_order_and_are_deleted(tmp_path):
+    handler = Recorder()
+    scheduler = FollowUpScheduler(handler, db_path=str(tmp_path / "jobs.db"))
+    await scheduler.start()
+    # Far enough apart that a slow write (e.g. a GC pause) doesn't swap them
+    await scheduler.schedule("1", 0.3, payload={"n": 2})
+    await scheduler.schedule("1", 0.05, payload={"n": 1})
+    await scheduler.schedule("2", 0.05, payload={"n": 1})
+    await asyncio.sleep(0.45)
+    assert sorted(handler.fired[:2]) == [("1", 1), ("2", 1)]
+    assert handler.fired[2] == ("1", 2)
+    await scheduler.stop()
+    assert await _stored_jobs(scheduler.pool) == 0
+    assert scheduler.pending() == 0
+    await scheduler.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_replies_cancel_pending_follow_ups(tmp_path):
+    handler = Recorder()
+    scheduler = FollowUpScheduler(handler, db_path=str(tmp_path / "jobs.db"))
+    await scheduler.start()
+    for n in range(3):
+        await scheduler.schedule("1", 0.05 * (n + 1), payload={"n": n})
+    await scheduler.schedule("1", 0.05, kind="reminder", payload={"n": "r"})
+    await scheduler.schedule("2", 0.05, payload={"n": 0})
+    assert await scheduler.cancel("1", kind="follow_up") == 3
+    assert scheduler.pending("1") == 1
+    await asyncio.sleep(0.15)
+    await scheduler.stop()
+    assert sorted(handler.fired) == [("1", "r"), ("2", 0)]
+    await scheduler.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_pending_jobs_are_recovered_at_startup(tmp_path):
+    pool = ConnectionPool(str(tmp_path / "jobs.db"))
+    scheduler = FollowUpScheduler(Recorder(), pool=pool)
+    await scheduler.schedule("1", 0.05, payload={"n": 1})
+    await scheduler.schedule("2", 10, payload={"n": 2})
+    # The process stops before the jobs are due
+    await asyncio.sleep(0.1)
+
+    handler = Recorder()
+    restarted = FollowUpScheduler(handler, pool=pool)
+    await restarted.start()
+    await asyncio.sleep(0.05)
+    await restarted.stop()
+    assert handler.fired == [("1", 1)]
+    assert await _stored_jobs(pool) == 1
+    await pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_due_jobs_fire_in_batches_within_the_concurrency_limit(tmp_path):
+    handler = Recorder(delay=0.02)
+    scheduler = FollowUpScheduler(
+        handler, db_path=str(tmp_path / "jobs.db"), max_concurrency=10, batch_size=25
+    )
+    for n in range(100):
+        await scheduler.schedule(str(n), 0, payload={"n": n})
+    start = time.monotonic()
+    await scheduler.start()
+    while len(handler.fired) < 100 and time.monotonic() - start < 5:
+        await asyncio.sleep(0.01)
+    await scheduler.stop()
+    assert len(handler.fired) == 100
+    assert handler.peak == 10
+    assert await _stored_jobs(scheduler.pool) == 0
+    await scheduler.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_failed_jobs_are_retried(tmp_path):
+    handler = Recorder(failures=1)
+    scheduler = FollowUpScheduler(
+        handler, db_path=str(tmp_path / "jobs.db"), retry_delay=0.05
+    )
+    await scheduler.start()
+    await scheduler.schedule("1", 0, payload={"n": 1})
+    await asyncio.sleep(0.15)
+    await scheduler.stop()
+    assert handler.fired == [("1", 1)]
+    await scheduler.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_later_jobs_are_loaded_as_they_get_closer(tmp_path):
+    handler = Recorder()
+    scheduler = FollowUpScheduler(
+        handler, db_path=str(tmp_path / "jobs.db"), horizon=0.1
+    )
+    await scheduler.start()
+    await scheduler.schedule("1", 0.3, payload={"n": 1})
+    # Beyond the horizon: only in the database for now
+    assert scheduler.pending() == 0
+    await asyncio.sleep(0.4)
+    await scheduler.stop()
+    assert handler.fired == [("1", 1)]
+    await scheduler.pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_cancelled_running_jobs_are_not_retried(tmp_path):
+    handler = Recorder(delay=0.05, failures=1)
+    scheduler = FollowUpScheduler(
+        handler, db_path=str(tmp_path / "jobs.db"), retry_delay=0.05
+    )
+    await scheduler.start()
+    await scheduler.schedule("1", 0, payload={"n": 1})
+    await asyncio.sleep(0.02)
+    # The user replies while the follow-up is being sent, and the send fails
+    assert await scheduler.cancel("1") == 0
+    await asyncio.sleep(0.15)
+    await scheduler.stop()
+    assert handler.fired == []
+    assert await _stored_jobs(scheduler.pool) == 0
+    assert scheduler.pending() == 0
+    await scheduler.pool.close_all()
+
+
+async def _locked():
+    raise RuntimeError("database is locked")
+
+
+@pytest.mark.asyncio
+async def test_jobs_that_cant_be_rescheduled_are_forgotten(tmp_path, monkeypatch):
+    pool = ConnectionPool(str(tmp_path / "jobs.db"))
+    scheduler = FollowUpScheduler(Recorder(failures=1), pool=pool, retry_delay=0.05)
+    await scheduler.start()
+    await scheduler.schedule("1", 0, payload={"n": 1})
+    with monkeypatch.context() as patch:
+        patch.setattr(pool, "get_connection", _locked)
+        await asyncio.sleep(0.05)
+    await scheduler.stop()
+    assert scheduler.pending() == 0
+    # Still stored, so it fires again after a restart
+    assert await _stored_jobs(pool) == 1
+    await pool.close_all()
+
+
+@pytest.mark.asyncio
+async def test_the_loop_survives_database_errors(tmp_path):
+    handler = Recorder()
+    scheduler = FollowUpScheduler(
+        handler, db_path=str(tmp_path / "jobs.db"), horizon=0.1, error_delay=0.05
+    )
+    await scheduler.start()
+    load = scheduler._load
+    failures = []
+
+    async def load_once_locked(until):
+        if not failures:
+            failures.append(until)
+            raise RuntimeError("database is locked")
+        await load(until)
+
+    scheduler._load = load_once_locked
+    await scheduler.schedule("1", 0.15, payload={"n": 1})
+    await asyncio.sleep(0.4)
+    assert failures
+    assert not scheduler._task.done()
+    await scheduler.stop()
+    assert handler.fired == [("1", 1)]
+    await scheduler.pool.close_all()
@@ -0,0 +1,69 @@
+from pywaai.splitter import (
+    MessageSplitter,
+    always_rewrite,
+    never_rewrite,
+    rewrite_if_more_than,
+    split_message,
+)
+
+
+def _words(messages):
+    return " ".join(messages).split()
+
+
+def test_short_text_is_a_single_message():
+    assert split_message("Hola, ¿cómo estás?") == ["Hola, ¿cómo estás?"]
+
+
+def test_prefers_paragraphs_then_sentences():
+    text = "First paragraph here.\n\n" + "One sentence. " * 10 + "Last words"
+    messages = split_message(text, max_chars=60)
+    assert messages[0] == "First paragraph here."
+    assert all(len(m) <= 60 for m in messages)
+    assert all(m.endswith(".") for m in messages[1:-1])
+    assert _words(messages) == text.split()
+
+
+def test_keeps_list_items_whole():
+    text = "Promociones disponibles:\n" + "\n".join(
+        f"- Promoción {i}: descuento del {i}0% en tiendas." for i in range(1, 7)
+    )
+    messages = split_message(text, max_chars=100)
+    for message in messages:
+        assert len(message) <= 100
+        for line in message.splitlines()[1:]:
+            assert line.startswith("- ")
+    assert _words(messages) == text.split()
+
+
+def test_never_cuts_through_formatting():
+    bold = "*" + " ".join(["importante"] * 5) + "*"
+    text = "Nota. " * 5 + bold + " fin."
+    for message in split_message(text, max_chars=70):
+        assert message.count("*") % 2 == 0
+
+
+def test_never_cuts_through_code_blocks():
+    code = "```\nline one\nline two\n```"
+    text = "Ejecuta esto. " * 3 + code + "\nListo."
+    messages = split_message(text, max_chars=60)
+    assert any(code in message for message in messages)
+
+
+def test_hard_cuts_long_words():
+    assert split_message("x" * 25, max_chars=10) == ["x" * 10, "x" * 10, "x" * 5]
+
+
+def test_streaming_emits_complete_paragraphs_early():
+    splitter = MessageSplitter(max_chars=100)
+    assert splitter.feed("Este es un párrafo bastante completo.") == []
+    assert splitter.feed("\n\nY otro") == ["Este es un párrafo bastante completo."]
+    assert splitter.flush() == ["Y otro"]
+
+
+def test_rewrite_policies():
+    assert not never_rewrite("x", ["x"])
+    assert always_rewrite("x", ["x"])
+    policy = rewrite_if_more_than(2)
+    assert not policy("x", ["a", "b"])
+    assert policy("x", ["a", "b", "c"])
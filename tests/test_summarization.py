@@ -0,0 +1,84 @@
+import pytest
+
+from pywaai.conversation_db import ConversationManager
+from pywaai.summarization import SUMMARY_PREFIX, RollingSummarizer
+
+
+class RecordingSummarize:
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, previous, messages):
+        self.calls.append((previous, [m["content"] for m in messages]))
+        return f"summary {len(self.calls)}"
+
+
+def _messages(*contents):
+    return [{"role": "user", "content": content} for content in contents]
+
+
+@pytest.fixture
+def manager(tmp_path):
+    summarize = RecordingSummarize()
+    manager = ConversationManager(
+        db_path=str(tmp_path / "conversations.db"),
+        rolling_summarizer=RollingSummarizer(summarize, max_messages=6, keep_messages=2),
+    )
+    manager.summarize = summarize
+    return manager
+
+
+@pytest.mark.asyncio
+async def test_older_messages_are_compacted_in_the_background(manager):
+    cid = await manager.get_active_conversation_id("123")
+    await manager.add_messages("123", _messages(*"abcdef"), cid)
+    assert manager.summarize.calls == []
+
+    assert await manager.add_messages("123", _messages("g", "h"), cid) == 8
+    updated_at = await manager.get_updated_at("123", cid)
+    await manager.rolling_summarizer.wait()
+    assert manager.summarize.calls == [(None, list("abcdef"))]
+    assert await manager.get_messages("123", cid) == [
+        {"role": "system", "content": SUMMARY_PREFIX + "summary 1"}
+    ] + _messages("g", "h")
+    assert await manager.get_updated_at("123", cid) == updated_at
+
+    # Counts stay absolute, and the next compaction extends the summary
+    assert await manager.add_messages("123", _messages(*"ijkl"), cid) == 12
+    await manager.rolling_summarizer.wait()
+    assert manager.summarize.calls[-1] == ("summary 1", list("ghij"))
+    compacted, messages = await manager.get_messages_with_offset("123", cid)
+    assert compacted == 10
+    assert [m["content"] for m in messages] == [SUMMARY_PREFIX + "summary 2", "k", "l"]
+
+
+@pytest.mark.asyncio
+async def test_compaction_keeps_tool_results_with_their_call(manager):
+    cid = await manager.get_active_conversation_id("123")
+    call = {"role": "assistant", "content": None, "tool_calls": [{"id": "c1"}]}
+    result = {"role": "tool", "content": "r", "tool_call_id": "c1"}
+    await manager.add_messages("123", _messages(*"abcde") + [call, result], cid)
+    await manager.rolling_summarizer.wait()
+    messages = await manager.get_messages("123", cid)
+    assert messages[-1] == result
+    assert messages[-2] == call
+
+
+@pytest.mark.asyncio
+async def test_compaction_is_a_compare_and_set(manager):
+    cid = await manager.get_active_conversation_id("123")
+    await manager.history.extend("123", _messages(*"abcd"), cid)
+    summary = {"role": "system", "content": "s"}
+    assert not await manager.history.compact("123", cid, 2, summary, expected_compacted=1)
+    assert await manager.history.compact("123", cid, 2, summary, expected_compacted=0)
+    # A second swap based on the same read loses
+    assert not await manager.history.compact("123", cid, 2, summary, expected_compacted=0)
+    assert await manager.get_messages_with_offset("123", cid) == (
+        2,
+        [summary] + _messages("c", "d"),
+    )
+
+
+def test_keep_messages_must_be_smaller_than_max_messages():
+    with pytest.raises(ValueError):
+        RollingSummarizer(lambda previous, messages: "", max_messages=5, keep_messages=5)